@@ -1,97 +1,64 @@
-import io
-import re
+import argparse
+import logging
+import os
+import time
 import tkinter as tk
-from tkinter import filedialog, ttk
-from PIL import Image, ImageTk, ImageFilter
-from google.cloud import vision
-from tkinter import ttk
-import threading
+from tkinter import filedialog, messagebox, simpledialog, ttk
+from PIL import Image, ImageTk
+from concurrent.futures import ThreadPoolExecutor
 import cv2
 import pyaudio
-import tempfile
-
-def detect_text(image_bytes):
-    """Google Vision API を使用して画像からテキストを抽出する."""
-    client = vision.ImageAnnotatorClient()
-    image = vision.Image(content=image_bytes)
-    response = client.text_detection(image=image)
-    texts = response.text_annotations
-    return texts[0].description.split('\n') if texts else []
-
-def group_players_by_team(player_names, prefix_length=1):
-    """プレイヤー名を接頭辞でグループ化し、チーム辞書を作成する."""
-    teams = {}
-    for name in player_names:
-        prefix = name[:prefix_length].lower()
-        if prefix not in teams:
-            teams[prefix] = []
-        teams[prefix].append(name)
-    return teams
-
-def calculate_team_scores(teams, race_scores):
-    """チームごとの合計得点を算出する."""
-    team_scores = {}
-    for team_name, player_names in teams.items():
-        team_scores[team_name] = 0
-        for player_name in player_names:
-            team_scores[team_name] += race_scores.get(player_name, 0)
-    return team_scores
-
-def extract_player_names(image_bytes):
-    """画像からプレイヤー名を抽出する."""
-    player_names = []
-    try:
-        image = Image.open(io.BytesIO(image_bytes))
-        print("a")
-        # プレイヤー名領域を定義 (画像サイズに合わせて調整が必要)
-        player_name_area = (1014, 80, 1431, 1000)
-
-        # 各プレイヤー名の画像からテキスト認識を行う (並列処理ではない)
-        for i in range(12):
-            try:
-                player_name_img = image.crop(
-                    (
-                        player_name_area[0],
-                        player_name_area[1]
-                        + i * (player_name_area[3] - player_name_area[1]) // 12,
-                        player_name_area[2],
-                        player_name_area[1]
-                        + (i + 1) * (player_name_area[3] - player_name_area[1]) // 12,
-                    )
-                )
-
-                print("クロップ")
-
-                # 画像をメモリ上に保存
-                img_byte_arr = io.BytesIO()
-                player_name_img.save(img_byte_arr, format="PNG")
-                img_byte_arr = img_byte_arr.getvalue()  # バイナリデータを取得
-                print("保存")
-
-                detected_texts = detect_text(img_byte_arr)
-                if detected_texts:
-                    player_names.append(detected_texts[0])
-
-                # ここでプログレスバーを更新
-                app.progress_bar["value"] += 1  # プログレスバーを1ステップ進める
-                app.update_idletasks()  # GUI を更新
-
-            except IndexError:
-                break
-    except Exception as e:
-        print(f"画像処理中にエラーが発生しました: {e}")
-    return player_names
+from session_journal import SessionJournal
+from scoring_formats import DEFAULT_PROFILE, SUPPORTED_PROFILES
+from scoring_engine import OcrStack, ScoringSession, frame_to_image, to_capture_size
+from async_ocr import TkAsyncBridge
+from image_history import ImageHistory, cleanup_sessions
+from frame_archive import FrameArchive
+from live_preview import FrameGrabber, LivePreview, area_downscale
+from standings_server import DEFAULT_PORT, StandingsServer
+from metrics import METRICS, configure_logging, span
+from sampling_profiler import SamplingProfiler
+from results_db import ResultsDB
+from analytics import PlayerStats, Season
+from stats_panel import PlayerStatsPanel
+from projection import WinProjection
+from standings_image import StandingsRenderer
+
+# セッションデータの保存先
+DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mkscan_data")
+JOURNAL_PATH = os.path.join(DATA_DIR, "session.journal")
+IMAGE_DIR = os.path.join(DATA_DIR, "images")
+ARCHIVE_DIR = os.path.join(DATA_DIR, "archive")
+OCR_BUDGET_PATH = os.path.join(DATA_DIR, "ocr_budget.json")
+STANDINGS_PORT = DEFAULT_PORT  # 配信オーバーレイ用サーバーのポート
+METRICS_PATH = os.path.join(DATA_DIR, "metrics.json")  # 段階ごとの所要時間とカウンター
+RESULTS_DB_PATH = os.path.join(DATA_DIR, "results.db")  # 確定したレースの履歴
+PROFILE_DIR = os.path.join(DATA_DIR, "profiles")  # レースごとの folded stacks
+PROFILE_RACES = 3  # F9 でプロファイルを取るレース数
+STATS_DAYS = 90  # 選手成績に使う履歴の日数
+STANDINGS_IMAGE_DIR = os.path.join(DATA_DIR, "standings")  # 交流戦ごとの順位表の画像
+
+log = logging.getLogger("mkscan")
+
+_archive_executor = ThreadPoolExecutor(max_workers=1)  # アーカイブへの書き込み (圧縮が重いので別スレッド)
+_stats_executor = ThreadPoolExecutor(max_workers=1)  # 起動時の選手成績の履歴の読み込み
+
+ocr_stack = OcrStack(OCR_BUDGET_PATH)  # レート制限・予算・ヘッジ・サーキットブレーカー付きの OCR
 
 class Application(tk.Frame):
-    def __init__(self, master=None):
+    def __init__(self, master=None, profile_races=0):
         super().__init__(master)
         self.master = master
         self.master.title("マリオカート チーム戦 集計アプリ")
         self.master.geometry("700x700")  # ウィンドウのサイズを設定 (幅x高さ)
         self.pack()
 
-        self.current_race = -1  # 現在のレース番号 (初期値は -1)
-        self.image_paths = []  # レース結果画像のパスを格納するリスト
+        # 集計は Tk に依存しないエンジンに任せる
+        self.session = ScoringSession(DEFAULT_PROFILE, ocr_stack)
+        self.history = ImageHistory(IMAGE_DIR)  # レース結果画像の保存とサムネイルのキャッシュ
+        self.image_paths = self.history.paths  # レース結果画像のパスを格納するリスト
+        self.archive = FrameArchive(ARCHIVE_DIR)  # 確定したレースの画像を重複なしで圧縮保存
+        self.results_db = ResultsDB(RESULTS_DB_PATH)  # レース結果の履歴 (書き込みは別スレッドでまとめて行う)
         self.current_image_index = -1  # 現在の表示画像のインデックス (初期値は -1)
 
         # ここに追加: device_index を初期化
@@ -101,8 +68,6 @@ class Application(tk.Frame):
 
         self.create_widgets()
 
-        self.team_total_scores = {}  # 全レースのチームごとの合計得点を格納
-        self.race_results = []  # 各レースの結果を格納
         self.undo_stack = []  # Undo 用のスタック
 
         # キャプチャーボードの初期化
@@ -112,10 +77,21 @@ class Application(tk.Frame):
         self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1920)
         self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
 
+        # 最新フレームを取り出せるようにしておき、メイン画面にライブ映像を表示する
+        self.grabber = FrameGrabber(self.cap)
+        self.live_preview = LivePreview(self.live_label, self.grabber)
+        if self.live_enabled.get():
+            self.live_preview.start()
+
         # キャプチャされた画像を格納する変数
         self.captured_image = None
         self.captured_image_fhd = None # FHD画像を保存する変数
         self.captured_image_preview = None # プレビュー用画像を保存する変数
+        self.capture_fingerprint = None  # 集計待ちの画像の名前欄の指紋 (二重キャプチャの判定用)
+
+        # OCR は Tk と同じスレッドで回す asyncio のタスクとして実行する
+        self.bridge = TkAsyncBridge(self.master)
+        self.ocr_task = None  # 実行中の OCR タスク
         
         # 確認ダイアログを生成
         self.confirm_window = tk.Toplevel(self)
@@ -142,55 +118,201 @@ class Application(tk.Frame):
         # 確認ダイアログにフォーカスが当たっている時のキーバインド
         self.confirm_window.bind("<space>", lambda event: self.capture_image(event))
         self.confirm_window.bind("<Escape>", lambda event: self.cancel_capture()) # キャンセル処理を実行
-        
-    def process_captured_image(self):
-            # 確認ダイアログを閉じる
-            self.confirm_window.withdraw()  # ダイアログを非表示
 
-            # プログレスバーをリセット
-            self.progress_bar["value"] = 0
-            self.progress_bar["maximum"] = 12  # 最大値を12に戻す
+        # クラッシュ時に備えてジャーナルを開き、前回のセッションがあれば復元する
+        self.journal = SessionJournal(JOURNAL_PATH)
+        self.session.journal = self.journal
+        session_name = None
+        if self.journal.has_data():
+            if messagebox.askyesno("再開", "前回のセッションが残っています。復元しますか？"):
+                state = self.journal.load()
+                session_name = state.get("session_name")
+                self.restore_session(state)
+            else:
+                self.journal.reset()
+        # 確定したレースの画像はアーカイブ済みなので、終わったセッションの画像は消す
+        cleanup_sessions(IMAGE_DIR, keep_dir=self.history.session_dir, archive=False)
+        self.journal.start()
+        if not session_name:
+            # 再開しても同じセッション名でレースを記録し続けるよう、名前をジャーナルに残す
+            self.journal.append("session", name=os.path.basename(self.history.session_dir))
+
+        # 配信オーバーレイ用の順位表サーバー (専用スレッドで動き、Tk のスレッドは待たせない)
+        self.standings_server = StandingsServer(port=STANDINGS_PORT)
+        try:
+            self.standings_server.start()
+        except OSError as e:
+            log.warning("順位表サーバーを起動できませんでした: %s", e)
+        self.standings_server.attach(self.session)
+
+        # カクつきの調査用に、F9 (または --profile-races) で次の数レースだけプロファイルを取る
+        self.profiler = SamplingProfiler(PROFILE_DIR)
+        self.session.listeners.append(self.profiler.on_session_event)
+        self.master.bind("<F9>", self.toggle_profiler)
+        if profile_races:
+            self.start_profiler(profile_races)
+
+        # 選手成績は起動時に履歴から一度だけ集計し、以降は確定したレースの分だけ足し込む
+        # (履歴の読み込みは別スレッドで行い、読み終わるまでに確定したレースは後から足す)
+        self.player_stats = PlayerStats()
+        self.stats_panel = PlayerStatsPanel(self.master, self.player_stats)
+        self.pending_stats = []  # 履歴の読み込み中に確定したレース (順位順の名前, 得点表)
+        self.season_future = _stats_executor.submit(
+            Season.from_db, self.results_db, since=time.time() - STATS_DAYS * 86400
+        )
+        self.master.after(100, self.poll_season)
+        # 投稿用の順位表の画像 (Tk を使わずに描く)
+        self.renderer = StandingsRenderer()
+        # 残りレースの優勝確率 (レースの確定・得点の編集のたびに見積もり直す)
+        self.projection = WinProjection()
+        self.session.listeners.append(self.on_session_event)
+        self.update_projection()
+        self.master.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    # 集計の状態はエンジンが持つ
+    @property
+    def profile(self):
+        return self.session.profile
+
+    @property
+    def current_race(self):
+        return self.session.current_race
+
+    @property
+    def team_total_scores(self):
+        return self.session.team_total_scores
+
+    @property
+    def race_results(self):
+        return self.session.race_results
+
+    def restore_session(self, state):
+        """ジャーナルから復元した状態をアプリに反映する."""
+        self.session.restore(state)
+        self.history.restore(state["image_paths"], state.get("session_name"))
+        self.current_image_index = len(self.image_paths) - 1
+        self.update_race_label()
+        self.update_result_display()
+        self.update_button_states()
+        self.show_current_image()
 
-            # FHD画像を一時ファイルとして保存
-            with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as temp_file:
-                self.captured_image_fhd.save(temp_file, format="PNG")
-                temp_file_path = temp_file.name
+    def on_close(self):
+        """ウィンドウを閉じる前にジャーナルを書き出す."""
+        self.bridge.close()
+        self.journal.close()
+        # 正常に閉じたときは次回の起動で再開を聞かないよう、ジャーナルを空にする
+        # (確定したレースは結果 DB とアーカイブに残っている)
+        self.journal.reset()
+        self.history.close()
+        _archive_executor.shutdown()
+        _stats_executor.shutdown()
+        self.results_db.close()
+        METRICS.write_file(METRICS_PATH)
+        ocr_stack.close()
+        self.standings_server.stop()
+        self.profiler.stop()
+        self.live_preview.stop()
+        self.grabber.stop()  # キャプチャボードも解放する
+        self.master.destroy()
 
+    def process_captured_image(self):
+            # 確認ダイアログを閉じる
+            self.confirm_window.withdraw()  # ダイアログを非表示
 
             # プレビュー画像を表示
             photo = ImageTk.PhotoImage(self.captured_image_preview)  # プレビュー用画像を使用
             self.preview_label.config(image=photo)
             self.preview_label.image = photo
 
-            # 一時ファイルを読み込んで bytes データを取得
-            with open(temp_file_path, "rb") as temp_file:
-                image_bytes = temp_file.read()
+            # OCR はキャプチャした時点で始まっているので、終わったら集計する
+            self.when_ocr_done(self.captured_image_fhd)
 
-            # プログレスバーを1/12進める
-            self.progress_bar["value"] = 1
-            self.update()  # GUI を更新
+    def start_ocr(self, image):
+        """画像の OCR を非同期に開始する (前のタスクが残っていれば取り消す)."""
+        if self.ocr_task is not None and not self.ocr_task.done():
+            self.ocr_task.cancel()
 
-            # 画像処理 (bytes データを渡す)
-            player_names = extract_player_names(image_bytes)
+        # プログレスバーをリセット
+        self.progress_bar["value"] = 0
+        self.progress_bar["maximum"] = self.profile.player_count  # 最大値をプレイヤー数に戻す
 
-            # プログレスバーを100%進める
-            self.progress_bar["value"] = 12
-            self.update()  # GUI を更新
+        self.ocr_task = self.bridge.submit(self.session.read_rows_async(image, on_progress=self.advance_progress))
 
-            # 集計結果の更新
-            self.process_race_results(player_names)
-            self.update_result_display()
+    def advance_progress(self, steps):
+        """プログレスバーを steps 行分進める."""
+        self.progress_bar["value"] += steps
 
-            # 矢印ボタンの状態を更新
-            self.current_image_index = len(self.image_paths) - 1  # インデックスを最新に更新
-            self.update_button_states() 
+    def when_ocr_done(self, image):
+        """実行中の OCR が終わったらレース結果として集計する."""
+        task = self.ocr_task
+        if task.done():
+            self.finish_race(task, image)
+        else:
+            task.add_done_callback(lambda task: self.finish_race(task, image))
 
-            # 処理した画像を表示
-            self.show_current_image()
+    def finish_race(self, task, image):
+        """OCR の結果を集計に反映する (Tk のスレッドで呼ばれる)."""
+        if task.cancelled():
+            return
+        try:
+            rows = task.result()
+        except Exception as e:
+            log.error("画像処理中にエラーが発生しました: %s", e)
+            rows = [None] * self.profile.player_count
+        player_names = [result.text if result else None for result in rows]
+
+        # プログレスバーを100%進める
+        self.progress_bar["value"] = self.profile.player_count
+
+        # 集計結果の更新
+        self.process_race_results(player_names, image)
+        self.update_result_display()
+
+        # 計測結果をファイルに書き出す
+        _archive_executor.submit(METRICS.write_file, METRICS_PATH)
+
+        # 画像をアーカイブし (同じ画像・ほぼ同じ画像は保存し直さない)、画像のハッシュ付きで履歴に残す
+        _archive_executor.submit(
+            self.archive_race,
+            image,
+            os.path.basename(self.history.session_dir),
+            self.current_race,
+            self.session.war,
+            self.profile,  # 別スレッドで読むと、その間に大会形式を切り替えたときに得点表がずれる
+            self.image_paths[-1] if self.image_paths else None,
+            player_names,
+            list(self.session.last_teams),
+            self.race_results[-1][1],
+            self.track_var.get().strip() or None,
+        )
+        self.track_var.set("")  # コースはレースごとに選び直す
+
+        # 矢印ボタンの状態を更新
+        self.current_image_index = len(self.image_paths) - 1  # インデックスを最新に更新
+        self.update_button_states()
+
+        # 処理した画像を表示
+        self.show_current_image()
+
+    def archive_race(self, image, session_name, race, war, profile, source, player_names, teams, race_scores,
+                     track=None):
+        """画像をアーカイブし、レース結果をデータベースに積む (アーカイブ用のスレッドで呼ばれる).
+
+        画像の保存に失敗してもレース結果は画像のハッシュ無しで記録する。
+        """
+        image_hash = None
+        try:
+            image_hash = self.archive.put(image, session_name, race, source)["hash"]
+        except Exception as e:
+            log.error("%dレース目の画像のアーカイブに失敗しました: %s", race + 1, e)
+        self.results_db.record_race(
+            session_name, race, profile, player_names, teams, race_scores, image_hash=image_hash, war=war,
+            track=track,
+        )
 
     def create_widgets(self):
         # レース番号表示ラベル
-        self.race_label = tk.Label(self, text=f"現在のレース: {self.current_race + 1}")
+        self.race_label = tk.Label(self, text=f"第1交流戦 現在のレース: {self.current_race + 1}")
         self.race_label.pack(pady=5)
 
         # 画像表示エリア
@@ -198,7 +320,16 @@ class Application(tk.Frame):
         self.image_frame.pack()  # ここで self.image_frame を配置
 
         self.image_label = tk.Label(self.image_frame)
-        self.image_label.pack()
+        self.image_label.pack(side=tk.LEFT)
+
+        # キャプチャ映像のライブ表示
+        self.live_label = tk.Label(self.image_frame)
+        self.live_label.pack(side=tk.LEFT, padx=5)
+        self.live_enabled = tk.BooleanVar(self, value=True)
+        self.live_check = tk.Checkbutton(
+            self, text="ライブ表示", variable=self.live_enabled, command=self.toggle_live_preview
+        )
+        self.live_check.pack()
 
         # 画像選択ボタン
         self.select_image_button = tk.Button(self, text="画像を選択", command=self.select_image)
@@ -208,6 +339,10 @@ class Application(tk.Frame):
         self.progress_bar = ttk.Progressbar(self, orient="horizontal", length=300, mode="determinate")
         self.progress_bar.pack(pady=5)
 
+        # OCR の使用量表示
+        self.ocr_usage_label = tk.Label(self, text="")
+        self.ocr_usage_label.pack()
+
         # 集計結果表示エリア
         self.result_frame = tk.Frame(self)
         self.result_frame.pack()
@@ -221,6 +356,10 @@ class Application(tk.Frame):
         self.score_treeview.column("Score", width=100, anchor="center")
         self.score_treeview.pack()
 
+        # 優勝確率の表示
+        self.projection_label = tk.Label(self.result_frame, text="", justify=tk.LEFT)
+        self.projection_label.pack()
+
         # Treeviewのアイテム編集
         self.score_treeview.bind("<Double-1>", self.edit_score)
 
@@ -257,6 +396,39 @@ class Application(tk.Frame):
         self.select_device_button = tk.Button(self.device_frame, text="選択", command=self.select_device)
         self.select_device_button.pack(side=tk.LEFT, padx=5)
         
+        # 大会形式の選択
+        self.format_frame = tk.Frame(self)
+        self.format_frame.pack()
+        tk.Label(self.format_frame, text="形式:").pack(side=tk.LEFT)
+        self.format_labels = {profile.label: key for key, profile in SUPPORTED_PROFILES.items()}
+        self.format_var = tk.StringVar(self.format_frame, value=self.profile.label)
+        self.format_dropdown = tk.OptionMenu(
+            self.format_frame, self.format_var, *self.format_labels, command=self.select_format
+        )
+        self.format_dropdown.pack(side=tk.LEFT)
+
+        # コース (選手成績のコース別の集計に使う。空欄ならコース不明として記録する)
+        tk.Label(self.format_frame, text="コース:").pack(side=tk.LEFT)
+        self.track_var = tk.StringVar(self.format_frame)
+        self.track_entry = ttk.Combobox(self.format_frame, textvariable=self.track_var, width=14)
+        self.track_entry.pack(side=tk.LEFT)
+
+        # チーム手動指定ボタン
+        self.override_button = tk.Button(self.format_frame, text="チーム指定", command=self.override_team)
+        self.override_button.pack(side=tk.LEFT, padx=5)
+
+        # 交流戦終了ボタン (12 レースに達すると次のレースで自動的に区切る)
+        self.war_button = tk.Button(self.format_frame, text="交流戦終了", command=self.end_war)
+        self.war_button.pack(side=tk.LEFT, padx=5)
+
+        # 順位表の画像の保存ボタン
+        self.export_button = tk.Button(self.format_frame, text="順位表画像", command=self.export_standings)
+        self.export_button.pack(side=tk.LEFT, padx=5)
+
+        # 選手成績ボタン
+        self.stats_button = tk.Button(self.format_frame, text="選手成績", command=self.show_player_stats)
+        self.stats_button.pack(side=tk.LEFT, padx=5)
+
         # スペースキーにキャプチャを割り当て
         self.master.bind("<space>", self.capture_image)
 
@@ -264,12 +436,26 @@ class Application(tk.Frame):
         self.capture_button = tk.Button(self, text="キャプチャ", command=self.capture_image)
         self.capture_button.pack(pady=10)
 
+    def is_duplicate_capture(self, image):
+        """直近に確定したレースと同じ画面なら確認し、読まないことにしたら True を返す (OCR の前に呼ぶ)."""
+        self.capture_fingerprint, duplicate = self.session.check_capture(image)
+        if duplicate is None:
+            return False
+        log.info("%d レース目と同じ画面をキャプチャしました", duplicate + 1)
+        return not messagebox.askyesno(
+            "二重キャプチャ", "直近に確定したレースと同じ画面のようです。\nそれでも集計しますか？", default=messagebox.NO
+        )
+
     def cancel_capture(self):
         """確認ダイアログでキャンセルまたは✕ボタンが押されたときの処理"""
         self.confirm_window.withdraw() # ダイアログを非表示にする
+        self.capture_fingerprint = None
+        if self.ocr_task is not None:
+            self.ocr_task.cancel()  # 先に始めていた OCR を取り消す
         if self.image_paths:  # リストが空でない場合のみ最後の要素を削除
-            self.image_paths.pop()
-            print("削除したわ。今は",self.image_paths)
+            self.history.pop()  # 保存した画像も削除する
+            self.journal.append("image_pop")
+            log.debug("削除したわ。今は %s", self.image_paths)
             self.update_button_states() # ボタンの状態を更新
             self.show_current_image()  # 最新の画像を表示
         
@@ -284,116 +470,91 @@ class Application(tk.Frame):
         if not file_path:
             return
 
-        # 画像のパスをリストに追加
-        self.image_paths.append(file_path)
-        print(file_path,"を追加ぁぁ！！")
-
-        # 現在の画像のインデックスを更新
-        self.current_image_index += 1
+        try:
+            image = Image.open(file_path)
+            image.load()
+        except Exception as e:
+            log.error("画像の読み込みに失敗しました: %s", e)
+            return
+        image = to_capture_size(image)  # 名前欄の座標は FHD に合わせてあるので 720p などは拡大する
 
-        # プログレスバーをリセット
-        self.progress_bar["value"] = 0
-        self.progress_bar["maximum"] = 12  # プレイヤーの数
+        # 直前に集計した画面と同じなら OCR を投げる前に止める
+        if self.is_duplicate_capture(image):
+            return
 
-        # 別のスレッドで画像処理を実行 (GUI をブロックしないように)
-        def process_image_thread():
-            try:
-                with open(file_path, "rb") as image_file:
-                    image_bytes = image_file.read()
-                player_names = extract_player_names(image_bytes)  # テキスト認識を行う
+        # 前の交流戦が規定のレース数に達していれば、ここで新しい交流戦にする
+        self.session.maybe_end_war()
 
-                # プログレスバーを更新
-                self.progress_bar["value"] = 12
+        # 画像のパスをリストに追加
+        self.history.add_path(file_path)
+        self.journal.append("image_add", path=file_path)
+        log.debug("%s を追加ぁぁ！！", file_path)
 
-                self.process_race_results(player_names)
-                self.show_current_image()  # 画像を表示
-            except Exception as e:
-                print(f"画像処理中にエラーが発生しました: {e}")
-                self.progress_bar["value"] = 12
+        # 現在の画像のインデックスを更新
+        self.current_image_index += 1
 
-        thread = threading.Thread(target=process_image_thread)
-        thread.start()
+        # OCR はイベントループ上で実行し、終わったら集計する (GUI をブロックしない)
+        self.start_ocr(image)
+        self.when_ocr_done(image)
 
         # 矢印ボタンの状態を更新
         self.update_button_states()
 
-    def process_race_results(self, player_names):
+    def process_race_results(self, player_names, image=None):
         """レース結果を処理し、チームごとの得点を計算する."""
-        race_scores = {}
-        for rank, name in enumerate(player_names):
-            if rank == 0:
-                score = 15
-            elif rank == 1:
-                score = 12
-            else:
-                score = 12 - rank
-            team_name = name[0].lower()  # チーム名は先頭1文字として取得
-            if team_name not in race_scores:
-                race_scores[team_name] = 0
-            race_scores[team_name] += score
-
-        # レース結果を保存
-        self.race_results.append((player_names, race_scores))  # race_results に追加
-
-        # チームごとの合計得点を更新
-        for team_name, score in race_scores.items():
-            if team_name in self.team_total_scores:
-                self.team_total_scores[team_name] += score
-            else:
-                self.team_total_scores[team_name] = score
-
-        self.current_race += 1  # レース番号をインクリメント
+        self.session.commit_race(player_names, image, self.capture_fingerprint)
+        self.capture_fingerprint = None
         self.update_race_label()  # レース番号のラベルを更新
+        self.update_ocr_usage()
         self.update_result_display()  # 集計結果を更新
 
     def update_race_label(self):
         """レース番号のラベルを更新する."""
-        self.race_label.config(text=f"現在のレース: {self.current_race + 1}")
+        text = f"第{self.session.war + 1}交流戦 現在のレース: {self.session.war_race + 1}"
+        if self.session.last_war is not None and not self.race_results:
+            war, standings, _ = self.session.last_war
+            if standings:
+                _, team_name, score, _ = standings[0]
+                text += f" (第{war + 1}交流戦 1位: {team_name} {score}点)"
+        self.race_label.config(text=text)
+
+    def update_ocr_usage(self):
+        """この交流戦の OCR 使用量を表示する."""
+        usage = ocr_stack.meter.summary()
+        remaining = ocr_stack.gate.budget.remaining()
+        text = f"OCR: {usage['requests']} 回 / {usage['bytes'] // 1024} KB / 約 ${usage['cost']:.3f}"
+        if remaining is not None:
+            text += f" (残り {remaining} 回)"
+        self.ocr_usage_label.config(text=text)
 
     def update_result_display(self):
         """集計結果表示を更新する."""
-        # Treeviewをクリア
-        for item in self.score_treeview.get_children():
-            self.score_treeview.delete(item)
-
-        # チームごとの合計得点を計算し、ソート
-        sorted_team_scores = sorted(self.team_total_scores.items(), key=lambda x: int(x[1]), reverse=True) # 修正: int(x[1]) で値を int 型に変換
-
-        # Treeviewのスタイル設定
-        style = ttk.Style()
-        style.configure("Treeview.Heading", font=("Helvetica", 12, "bold"))  # ヘッダーフォント
-        style.configure("Treeview", font=("Helvetica", 10))  # 通常のフォント
-        style.configure("PointDiff.Treeview", font=("Helvetica", 10, "bold"))  # 点差フォント
-
-        # 順位、チーム、得点を表示
-        previous_score = None
-        rank = 1
-        for i, (team_name, score) in enumerate(sorted_team_scores):
-            # 同点の場合は同じ順位を表示
-            if score == previous_score:
-                ranking_text = f"{rank}位"
-            else:
-                ranking_text = f"{i + 1}位"
-                rank = i + 1
-            previous_score = score
+        with span("ui_update"):
+            # Treeviewをクリア
+            for item in self.score_treeview.get_children():
+                self.score_treeview.delete(item)
+
+            # Treeviewのスタイル設定
+            style = ttk.Style()
+            style.configure("Treeview.Heading", font=("Helvetica", 12, "bold"))  # ヘッダーフォント
+            style.configure("Treeview", font=("Helvetica", 10))  # 通常のフォント
+            style.configure("PointDiff.Treeview", font=("Helvetica", 10, "bold"))  # 点差フォント
 
-            # 1番目のチームは点差行を挿入しない
-            if i > 0:
-                # 前のチームとの点差を計算
-                point_diff = score - sorted_team_scores[i - 1][1]
-                # 点差行の挿入 (スタイルを適用)
-                self.score_treeview.insert(
-                    "", "end", values=("", "", f"±{abs(point_diff)}"), tags=("PointDiff",)
-                )  # abs() で絶対値を取得
+            # 順位、チーム、得点を表示 (同点は同じ順位)
+            for rank, team_name, score, gap in self.session.standings():
+                # 1番目のチームは点差行を挿入しない
+                if gap is not None:
+                    # 点差行の挿入 (スタイルを適用)
+                    self.score_treeview.insert("", "end", values=("", "", f"±{gap}"), tags=("PointDiff",))
 
-            # チーム情報行の挿入
-            self.score_treeview.insert("", "end", values=(ranking_text, team_name, score))
+                # チーム情報行の挿入
+                self.score_treeview.insert("", "end", values=(f"{rank}位", team_name, score))
 
-        # タグのスタイル設定を適用
-        self.score_treeview.tag_configure("PointDiff", font=("Helvetica", 10, "bold"))
+            # タグのスタイル設定を適用
+            self.score_treeview.tag_configure("PointDiff", font=("Helvetica", 10, "bold"))
 
-        # Treeviewの縦幅を調整
-        self.score_treeview.config(height=11)  # 11行表示するように変更
+            # Treeviewの縦幅を調整
+            self.score_treeview.config(height=11)  # 11行表示するように変更
 
     def edit_score(self, event):
         """Treeviewのアイテムをダブルクリックした際に編集モードに移行"""
@@ -427,7 +588,7 @@ class Application(tk.Frame):
                         self.score_treeview.item(item, values=(self.score_treeview.item(item, "values")[0], self.score_treeview.item(item, "values")[1], new_score))
                         # チームごとの合計得点を更新
                         team_name = self.score_treeview.item(item, "values")[1]
-                        self.team_total_scores[team_name] = new_score
+                        self.session.set_score(team_name, new_score)
                         self.update_result_display()  # Treeviewを更新
                         self.undo_button.config(state=tk.NORMAL)  # Undo ボタンを有効化
                     except ValueError:
@@ -441,17 +602,14 @@ class Application(tk.Frame):
 
     def show_current_image(self):
         """現在のレース結果画像を表示する."""
-        print(self.current_image_index,"番目の画像を表示するよ～ん")
+        log.debug("%d 番目の画像を表示するよ～ん", self.current_image_index)
         if self.current_image_index >= 0 and self.current_image_index < len(self.image_paths):
-            image_path = self.image_paths[self.current_image_index]
             try:
-                image = Image.open(image_path)
-                image.thumbnail((300, 300))  # 画像のサイズ調整
-                photo = ImageTk.PhotoImage(image)
+                photo = self.history.photo(self.current_image_index)  # キャッシュ済みのサムネイル
                 self.image_label.config(image=photo)
                 self.image_label.image = photo
             except Exception as e:
-                print(f"画像の読み込みに失敗しました: {e}")
+                log.error("画像の読み込みに失敗しました: %s", e)
 
     def show_prev_image(self):
         """前のレース結果画像を表示する."""
@@ -490,53 +648,194 @@ class Application(tk.Frame):
                 if self.score_treeview.item(item, "values")[1] == team_name:
                     self.score_treeview.item(item, values=(self.score_treeview.item(item, "values")[0], team_name, old_score))
                     # 合計得点を元に戻す (ここで修正: old_score を int 型に変換)
-                    self.team_total_scores[team_name] = int(old_score)
+                    self.session.set_score(team_name, int(old_score))
                     break
 
-            # self.team_total_scores の値を int 型に変換してからソート
-            sorted_team_scores = sorted(
-                self.team_total_scores.items(), key=lambda x: int(x[1]), reverse=True
-            )
-
             self.update_result_display()  # Treeview を更新
             self.current_image_index = len(self.image_paths) - 1  # インデックスを最新に更新
             self.show_current_image()  # 最新の画像を表示
             if not self.undo_stack:  # スタックが空になったら Undo ボタンを無効化
                 self.undo_button.config(state=tk.DISABLED)
 
+    def select_format(self, label):
+        """選択された大会形式に切り替える."""
+        self.session.set_profile(SUPPORTED_PROFILES[self.format_labels[label]])
+        self.progress_bar["maximum"] = self.profile.player_count
+        self.update_projection()
+
+    def override_team(self):
+        """プレイヤーのチームを手動で指定する."""
+        name = simpledialog.askstring("チーム指定", "プレイヤー名:", parent=self.master)
+        if not name:
+            return
+        team_name = simpledialog.askstring("チーム指定", f"{name} のチーム:", parent=self.master)
+        if not team_name:
+            return
+        self.session.set_override(name, team_name)
+
+    def end_war(self):
+        """今の交流戦を手動で終える."""
+        if not self.race_results:
+            return
+        if messagebox.askyesno("交流戦終了", f"第{self.session.war + 1}交流戦を終了しますか？"):
+            self.session.end_war()
+
+    def save_standings_image(self, path, standings, adjustments, title):
+        """順位表を PNG で保存する (アーカイブ用のスレッドで呼ばれる)."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with span("render_png"):
+            self.renderer.render(standings, adjustments, title).save(path, format="PNG")
+        log.info("%s に順位表を保存しました", path)
+
+    def export_standings(self):
+        """今の順位表を画像で保存する."""
+        path = filedialog.asksaveasfilename(
+            title="順位表の画像を保存",
+            initialfile=f"war{self.session.war + 1:02d}.png",
+            defaultextension=".png",
+            filetypes=(("PNG", "*.png"),),
+        )
+        if not path:
+            return
+        subtitle = f"{self.session.war_race + 1} レース終了" if self.race_results else ""
+        self.renderer.render(
+            self.session.standings(), self.session.adjustments(), f"第{self.session.war + 1}交流戦", subtitle
+        ).save(path, format="PNG")
+
+    def poll_season(self):
+        """履歴の読み込みが終わっていれば選手成績を差し替える (Tk のスレッドで呼ばれる)."""
+        if not self.season_future.done():
+            self.master.after(100, self.poll_season)
+            return
+        try:
+            season = self.season_future.result()
+        except Exception as e:
+            log.error("選手成績の履歴を読み込めませんでした: %s", e)
+            self.pending_stats = None
+            return
+        stats = PlayerStats.from_season(season)
+        for player_names, points in self.pending_stats:
+            stats.add_race(player_names, points)
+        self.pending_stats = None
+        self.player_stats = self.stats_panel.stats = stats
+        self.track_entry.config(values=[name for name in season.track_names if name])
+        if self.stats_panel.visible:
+            self.stats_panel.refresh(self.stats_panel.items)
+        self.update_projection()
+
+    def on_session_event(self, session, event):
+        """確定したレースを選手成績に足し込み、優勝確率を見積もり直す."""
+        if event == "race":
+            if self.pending_stats is not None:
+                self.pending_stats.append((session.race_results[-1][0], session.profile.points))
+            names = self.player_stats.add_race(session.race_results[-1][0], session.profile.points)
+            if self.stats_panel.visible:
+                self.stats_panel.refresh(names)
+        elif event == "war":
+            # 終わった交流戦の順位表は画像にして残しておく (投稿用)
+            war, standings, adjustments = session.last_war
+            path = os.path.join(
+                STANDINGS_IMAGE_DIR, f"{os.path.basename(self.history.session_dir)}-war{war + 1:02d}.png"
+            )
+            _archive_executor.submit(self.save_standings_image, path, standings, adjustments, f"第{war + 1}交流戦")
+            # 終わった交流戦の画像・Undo はもう使わないので捨てる (画像はアーカイブ済み)
+            self.history.clear()
+            self.undo_stack.clear()
+            self.current_image_index = -1
+            self.undo_button.config(state=tk.DISABLED)
+            self.update_race_label()
+            self.update_result_display()
+            self.update_button_states()
+            self.show_current_image()
+        self.update_projection()
+
+    def team_distributions(self):
+        """直前のレースのチーム分けから、チームごとの過去の順位の分布を作る."""
+        if not self.race_results:
+            return None
+        members = {}
+        for name, team_name in zip(self.race_results[-1][0], self.session.last_teams):
+            if name and team_name:
+                members.setdefault(team_name, []).append(name)
+        return {
+            team_name: self.player_stats.placement_distribution(names, self.profile.player_count)
+            for team_name, names in members.items()
+        }
+
+    def update_projection(self):
+        """各チームの優勝確率と、勝つために必要な平均順位を表示する."""
+        with span("projection"):
+            rows = self.projection.project(
+                self.team_total_scores, self.session.war_race, self.profile, self.team_distributions(),
+                war=self.session.war,
+            )
+        lines = []
+        for team_name, _, probability, placement in rows:
+            if placement is None:
+                need = "逆転不可" if probability < 1 else ""
+            else:
+                need = f"必要平均 {placement:.1f}位"
+            lines.append(f"{team_name}: {probability * 100:.1f}% {need}".rstrip())
+        self.projection_label.config(text="\n".join(lines))
+
+    def show_player_stats(self):
+        """このセッションに出たプレイヤーの成績を表示する."""
+        names = dict.fromkeys(name for player_names, _ in self.race_results for name in player_names if name)
+        self.stats_panel.show(names)
+
+    def start_profiler(self, races=PROFILE_RACES):
+        """次の races レースのプロファイルを取り始める."""
+        self.profiler.start(races, self.current_race + 1, os.path.basename(self.history.session_dir))
+
+    def toggle_profiler(self, event=None):
+        """プロファイラのオン・オフを切り替える."""
+        if self.profiler.running:
+            self.profiler.stop()
+        else:
+            self.start_profiler()
+
+    def toggle_live_preview(self):
+        """ライブ表示のオン・オフを切り替える."""
+        if self.live_enabled.get():
+            self.live_preview.start()
+        else:
+            self.live_preview.stop()
+
     def select_device(self):
         """選択されたデバイスでキャプチャボードを更新する."""
         self.device_index = int(self.device_list.get())
-        self.cap.release()  # 以前のキャプチャボードを解放
         self.cap = cv2.VideoCapture(self.device_index)  # 新しいキャプチャボードを設定
+        self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, 1920)
+        self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, 1080)
+        self.grabber.set_capture(self.cap)  # 以前のキャプチャボードは解放される
 
     def capture_image(self, event=None):
-        # 最新のフレームを取得するために grab() と retrieve() を呼び出す
-        self.cap.grab()
-        self.cap.retrieve()
-
-        # フレームを取得
-        ret, frame = self.cap.read()
-        if ret:
-            # フレームを PIL Image に変換
-            self.captured_image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
-            self.captured_image_fhd = self.captured_image.copy()  # FHD画像を保存
-
-            # プレビュー用画像のサイズ調整 (アスペクト比を維持)
-            width, height = self.captured_image.size
-            aspect_ratio = width / height
-            new_width = 300
-            new_height = int(new_width / aspect_ratio)
-            self.captured_image_preview = self.captured_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-
-            # FHD画像を一時ファイルとして保存 (確認ダイアログ表示前に移動)
-            with tempfile.NamedTemporaryFile(suffix=".png", delete=False) as temp_file:
-                self.captured_image_fhd.save(temp_file, format="PNG")
-                temp_file_path = temp_file.name
-
-            # 画像のパスをリストに追加
-            self.image_paths.append(temp_file_path)
-            print(temp_file_path,"を追加ぁぁ！")
+        # 裏で grab し続けている最新のフレームを取得
+        start = time.perf_counter()
+        frame = self.grabber.retrieve()
+        if frame is not None:
+            # フレームを PIL Image に変換 (FHD 以外のキャプチャボードなら FHD に揃える)
+            self.captured_image = frame_to_image(frame)
+            self.captured_image_fhd = self.captured_image  # FHD画像を保存
+            METRICS.observe("capture", time.perf_counter() - start)
+
+            # 直前に集計した画面と同じなら OCR を投げる前に止める
+            if self.is_duplicate_capture(self.captured_image_fhd):
+                return
+
+            # プレビュー用画像は ndarray 上で面積平均で縮小する (アスペクト比を維持)
+            self.captured_image_preview = Image.fromarray(area_downscale(frame, 300))
+
+            # 前の交流戦が規定のレース数に達していれば、ここで新しい交流戦にする
+            self.session.maybe_end_war()
+
+            # FHD画像をセッション用ディレクトリに保存し、パスをリストに追加
+            temp_file_path = self.history.add(self.captured_image_fhd)
+            self.journal.append("image_add", path=temp_file_path)
+            log.debug("%s を追加ぁぁ！", temp_file_path)
+
+            # 確認を待たずに OCR を始めておく (キャンセルされたら取り消す)
+            self.start_ocr(self.captured_image_fhd)
 
             # 確認ダイアログを表示する直前にプレビュー画像を更新
             photo = ImageTk.PhotoImage(self.captured_image_preview)
@@ -555,10 +854,17 @@ class Application(tk.Frame):
             self.confirm_window.bind("<space>", lambda event: ok_button.invoke())
             self.confirm_window.bind("<Escape>", lambda event: cancel_button.invoke())
         else:
-            print("フレームの取得に失敗しました。")
+            log.warning("フレームの取得に失敗しました。")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="マリオカート チーム戦 集計アプリ")
+    parser.add_argument("--log-level", default="WARNING", help="DEBUG / INFO / WARNING / ERROR")
+    parser.add_argument("--log-file", default=None)
+    parser.add_argument("--profile-races", type=int, default=0, help="起動直後から N レース分のプロファイルを取る")
+    args = parser.parse_args()
+    configure_logging(args.log_level, args.log_file)
+
     root = tk.Tk()
-    app = Application(master=root)
+    app = Application(master=root, profile_races=args.profile_races)
     app.mainloop()
\ No newline at end of file
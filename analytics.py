@@ -0,0 +1,261 @@
+import time
+
+import numpy as np
+
+# 直近の調子 (form) を見るレース数 (1 交流戦)
+FORM_WINDOW = 12
+# 順位の分布を持つ最大の順位 (24 人戦)
+MAX_RANK = 24
+# トラックが分からないレースのトラック名
+UNKNOWN_TRACK = ""
+
+
+class Season:
+    """データベースから読み込んだシーズンの成績 (player × race の疎な配列).
+
+    1 行 = 1 人の 1 レースで、player・race・track・team は密な番号、rank・points は値。
+    行は時刻順に並んでいる。集計はすべて bincount などのベクトル演算で行う。
+    track・team を省くと、すべて UNKNOWN_TRACK・チーム無し ("") の行として扱う。
+    """
+
+    def __init__(self, player_names, player, race, rank, points, track=None, team=None,
+                 track_names=(UNKNOWN_TRACK,), team_names=("",)):
+        self.player_names = list(player_names)
+        self.track_names = list(track_names)
+        self.team_names = list(team_names)
+        self.player = np.asarray(player, dtype=np.int32)
+        self.race = np.asarray(race, dtype=np.int32)
+        self.rank = np.asarray(rank, dtype=np.int8)
+        self.points = np.asarray(points, dtype=np.int16)
+        self.track = np.zeros(len(self.player), dtype=np.int16) if track is None else np.asarray(track, dtype=np.int16)
+        self.team = np.zeros(len(self.player), dtype=np.int32) if team is None else np.asarray(team, dtype=np.int32)
+        self._index = {name: i for i, name in enumerate(self.player_names)}
+
+    @classmethod
+    def from_db(cls, db, since=None, until=None):
+        """ResultsDB から since 〜 until (UNIX 時刻) の結果を読み込む."""
+        where, params = [], []
+        if since is not None:
+            where.append("results.ts >= ?")
+            params.append(since)
+        if until is not None:
+            where.append("results.ts < ?")
+            params.append(until)
+        rows = db.connection.execute(
+            "SELECT results.player_id, results.race_id, results.rank, results.points, races.track, results.team "
+            "FROM results JOIN races ON races.id = results.race_id "
+            + ("WHERE " + " AND ".join(where) if where else "")
+            + " ORDER BY results.ts, results.race_id",
+            params,
+        ).fetchall()
+        names = dict(db.connection.execute("SELECT id, name FROM players"))
+        if not rows:
+            return cls([], [], [], [], [])
+        player_ids, race_ids, ranks, points, tracks, teams = zip(*rows)
+        player_keys, player = np.unique(np.asarray(player_ids), return_inverse=True)
+        _, race = np.unique(np.asarray(race_ids), return_inverse=True)
+        track_names, track = np.unique(np.array([t or UNKNOWN_TRACK for t in tracks]), return_inverse=True)
+        team_names, team = np.unique(np.array([t or "" for t in teams]), return_inverse=True)
+        return cls([names[int(k)] for k in player_keys], player, race, ranks, points, track, team,
+                   track_names.tolist(), team_names.tolist())
+
+    @property
+    def player_count(self):
+        return len(self.player_names)
+
+    def index(self, name):
+        """プレイヤー名の番号 (いなければ None)."""
+        return self._index.get(name)
+
+    def player_summary(self):
+        """プレイヤーごとのレース数・平均順位・順位の標準偏差 (安定度)・平均得点・平均との差."""
+        n_players = self.player_count
+        rank = self.rank.astype(np.float64)
+        points = self.points.astype(np.float64)
+        races = np.bincount(self.player, minlength=n_players)
+        safe = np.maximum(races, 1)
+        average_rank = np.bincount(self.player, weights=rank, minlength=n_players) / safe
+        mean_square = np.bincount(self.player, weights=rank * rank, minlength=n_players) / safe
+        # そのレースの参加者の平均得点との差 (人数の違うレースも同じ物差しで比べる)
+        race_mean = np.bincount(self.race, weights=points) / np.maximum(np.bincount(self.race), 1)
+        above = np.bincount(self.player, weights=points - race_mean[self.race], minlength=n_players) / safe
+        return {
+            "races": races,
+            "average_rank": average_rank,
+            "consistency": np.sqrt(np.maximum(mean_square - average_rank ** 2, 0.0)),
+            "average_points": np.bincount(self.player, weights=points, minlength=n_players) / safe,
+            "points_above_average": above,
+        }
+
+    def track_splits(self):
+        """(レース数, 平均順位) をそれぞれ (プレイヤー, トラック) の配列で返す (出ていないところは nan)."""
+        n_tracks = max(len(self.track_names), 1)
+        key = self.player.astype(np.int64) * n_tracks + self.track
+        size = self.player_count * n_tracks
+        counts = np.bincount(key, minlength=size).reshape(self.player_count, n_tracks)
+        sums = np.bincount(key, weights=self.rank.astype(np.float64), minlength=size).reshape(counts.shape)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return counts, sums / counts
+
+    def team_summary(self):
+        """チームごとの出たレース数と 1 レースあたりの平均得点 (個人戦のチーム名 "" も含む)."""
+        n_teams = max(len(self.team_names), 1)
+        key = self.race.astype(np.int64) * n_teams + self.team
+        # (レース, チーム) ごとの合計を作ってからチームで集計する
+        pairs, inverse = np.unique(key, return_inverse=True)
+        race_points = np.bincount(inverse, weights=self.points.astype(np.float64))
+        pair_team = pairs % n_teams
+        races = np.bincount(pair_team, minlength=n_teams)
+        return {
+            "races": races,
+            "average_points": np.bincount(pair_team, weights=race_points, minlength=n_teams) / np.maximum(races, 1),
+        }
+
+    def _sorted_by_player(self):
+        # プレイヤーごとにまとめ、プレイヤー内は時刻順 (安定ソート)
+        order = np.argsort(self.player, kind="stable")
+        player = self.player[order]
+        races = np.bincount(self.player, minlength=self.player_count)
+        starts = np.concatenate(([0], np.cumsum(races)[:-1]))
+        position = np.arange(len(order)) - starts[player]
+        return order, player, races, starts, position
+
+    def rolling_form(self, window=FORM_WINDOW):
+        """各プレイヤーの直近 window レースの平均順位の推移.
+
+        (行の並び, プレイヤー, 移動平均) を返す。行の並びは元の行番号で、プレイヤーごと・
+        時刻順にまとめてある。累積和の差で計算するので行数に比例した時間で済む。
+        """
+        order, player, _, starts, _ = self._sorted_by_player()
+        cumulative = np.concatenate(([0.0], np.cumsum(self.rank[order], dtype=np.float64)))
+        index = np.arange(len(order))
+        low = np.maximum(index - window + 1, starts[player])
+        return order, player, (cumulative[index + 1] - cumulative[low]) / (index + 1 - low)
+
+    def current_form(self, window=FORM_WINDOW):
+        """各プレイヤーの直近 window レースの平均順位 (出ていなければ nan)."""
+        _, _, rolling = self.rolling_form(window)
+        races = np.bincount(self.player, minlength=self.player_count)
+        ends = np.cumsum(races) - 1
+        form = np.full(self.player_count, np.nan)
+        played = races > 0
+        form[played] = rolling[ends[played]]
+        return form
+
+
+class PlayerStats:
+    """ライブで使う、レースごとに足し込むプレイヤー成績.
+
+    合計値と直近 window レースの順位 (リングバッファ) をプレイヤーごとに持つので、
+    レースが確定しても元の行を集計し直さずに、出たプレイヤーの分だけ更新できる。
+    """
+
+    def __init__(self, window=FORM_WINDOW, capacity=64):
+        self.window = window
+        self.names = []
+        self._index = {}
+        self.races = np.zeros(capacity, dtype=np.int64)
+        self.rank_sum = np.zeros(capacity)
+        self.rank_square_sum = np.zeros(capacity)
+        self.points_sum = np.zeros(capacity)
+        self.above_sum = np.zeros(capacity)
+        self.recent = np.zeros((capacity, window), dtype=np.int8)  # 直近の順位 (リングバッファ)
+        self.rank_counts = np.zeros((capacity, MAX_RANK), dtype=np.int32)  # 順位ごとの回数
+        self.updated = time.time()
+
+    @classmethod
+    def from_season(cls, season, window=FORM_WINDOW):
+        """Season の集計から作る (以降のレースは add_race で足していく)."""
+        stats = cls(window, max(64, season.player_count))
+        n = season.player_count
+        stats.names = list(season.player_names)
+        stats._index = {name: i for i, name in enumerate(stats.names)}
+        if not n:
+            return stats
+        summary = season.player_summary()
+        races = summary["races"]
+        stats.races[:n] = races
+        stats.rank_sum[:n] = summary["average_rank"] * races
+        stats.rank_square_sum[:n] = np.bincount(
+            season.player, weights=season.rank.astype(np.float64) ** 2, minlength=n)
+        stats.points_sum[:n] = summary["average_points"] * races
+        stats.above_sum[:n] = summary["points_above_average"] * races
+        key = season.player.astype(np.int64) * MAX_RANK + np.minimum(season.rank, MAX_RANK) - 1
+        stats.rank_counts[:n] = np.bincount(key, minlength=n * MAX_RANK).reshape(n, MAX_RANK)
+        # 直近 window レースをリングバッファに入れる (位置はレース数で割った余り)
+        order, player, races, _, position = season._sorted_by_player()
+        recent = position >= races[player] - window
+        stats.recent[player[recent], position[recent] % window] = season.rank[order][recent]
+        return stats
+
+    def _grow(self, size):
+        capacity = len(self.races)
+        if size <= capacity:
+            return
+        capacity = max(size, capacity * 2)
+        for name in ("races", "rank_sum", "rank_square_sum", "points_sum", "above_sum", "recent", "rank_counts"):
+            old = getattr(self, name)
+            new = np.zeros((capacity,) + old.shape[1:], dtype=old.dtype)
+            new[:len(old)] = old
+            setattr(self, name, new)
+
+    def index(self, name, create=False):
+        i = self._index.get(name)
+        if i is None and create:
+            i = self._index[name] = len(self.names)
+            self.names.append(name)
+            self._grow(len(self.names))
+        return i
+
+    def add_race(self, player_names, points_table):
+        """確定したレース (順位順の名前、空欄は None) を足し込み、出たプレイヤー名を返す."""
+        ranks = np.array([rank + 1 for rank, name in enumerate(player_names) if name], dtype=np.int64)
+        names = [name for name in player_names if name]
+        if not names:
+            return []
+        # 同じ名前が 2 回読めてしまったときは上の順位だけを使う
+        seen = {}
+        for name, rank in zip(names, ranks):
+            seen.setdefault(name, rank)
+        names = list(seen)
+        ranks = np.array(list(seen.values()), dtype=np.int64)
+        points = np.asarray(points_table, dtype=np.float64)[ranks - 1]
+        idx = np.array([self.index(name, create=True) for name in names], dtype=np.intp)
+
+        slot = self.races[idx] % self.window
+        self.recent[idx, slot] = ranks
+        self.rank_counts[idx, np.minimum(ranks, MAX_RANK) - 1] += 1
+        self.races[idx] += 1
+        self.rank_sum[idx] += ranks
+        self.rank_square_sum[idx] += ranks * ranks
+        self.points_sum[idx] += points
+        self.above_sum[idx] += points - points.mean()
+        self.updated = time.time()
+        return names
+
+    def stats(self, name):
+        """プレイヤーの成績 (記録が無ければ None)."""
+        i = self._index.get(name)
+        if i is None or not self.races[i]:
+            return None
+        n = self.races[i]
+        average = self.rank_sum[i] / n
+        recent_count = min(n, self.window)
+        return {
+            "name": name,
+            "races": int(n),
+            "average_rank": float(average),
+            "consistency": float(np.sqrt(max(self.rank_square_sum[i] / n - average ** 2, 0.0))),
+            "average_points": float(self.points_sum[i] / n),
+            "points_above_average": float(self.above_sum[i] / n),
+            "form": float(self.recent[i].sum() / recent_count),
+        }
+
+    def placement_distribution(self, names, player_count, prior=1.0):
+        """names (同じチームのプレイヤー) の順位の分布を合わせたもの (1 位から player_count 位まで).
+
+        記録の少ないプレイヤーに引きずられないよう、どの順位にも prior 回ずつ足しておく。
+        """
+        idx = [i for i in (self._index.get(name) for name in names) if i is not None]
+        counts = self.rank_counts[idx, :player_count].sum(axis=0) + prior
+        return counts / counts.sum()
@@ -0,0 +1,137 @@
+import asyncio
+import logging
+import threading
+
+from metrics import inc
+from ocr_backends import crop_row, match_roster, needs_retry, pick_better
+from ocr_limits import RequestCancelled
+from row_occupancy import row_occupancy
+
+log = logging.getLogger(__name__)
+
+
+class ExecutorBackend:
+    """同期の OCR バックエンドをスレッドプールで動かし、await できるようにする.
+
+    GUI の非同期経路もこれで OcrStack の同期経路 (レート制限・予算・ヘッジ・サーキットブレーカー)
+    をそのまま通すので、非同期だけ保護が抜けることはない。
+    cancellable=True なら backend.detect に取り消しの Event を渡し、await が取り消されたら
+    まだゲートを通っていない (予算を使っていない) リクエストは送らずに終わらせる。
+    """
+
+    def __init__(self, backend, executor=None, cancellable=False):
+        self.backend = backend
+        self.name = backend.name
+        self.executor = executor
+        self.cancellable = cancellable
+
+    def _detect(self, image_bytes, cancelled):
+        if cancelled.is_set():
+            raise RequestCancelled("OCR のリクエストが取り消されました")
+        if self.cancellable:
+            return self.backend.detect(image_bytes, cancelled)
+        return self.backend.detect(image_bytes)
+
+    async def detect(self, image_bytes):
+        loop = asyncio.get_running_loop()
+        cancelled = threading.Event()
+        try:
+            return await loop.run_in_executor(self.executor, self._detect, image_bytes, cancelled)
+        except asyncio.CancelledError:
+            cancelled.set()  # 順番待ち中・キューに残っているリクエストを止める
+            raise
+
+
+async def extract_player_rows_async(image, profile, backend, retry_backend=None, roster=None,
+                                    on_progress=None, executor=None):
+    """画像から行ごとの OcrResult を非同期に抽出する.
+
+    extract_player_rows と同じ手順 (空欄の足切り → 全行 → 怪しい行だけ再 OCR) を、
+    1 スレッドのイベントループ上で全行同時に待つ。クロップと PNG エンコードは
+    executor で行い、イベントループ (= Tk のスレッド) を止めない。
+    タスクがキャンセルされると、まだ返ってきていない行のリクエストも取り消される。
+    """
+    loop = asyncio.get_running_loop()
+    retry_backend = retry_backend or backend
+    roster = list(roster or [])
+    rows = [None] * profile.player_count
+
+    occupied = await loop.run_in_executor(executor, row_occupancy, image, profile)
+    if on_progress:
+        on_progress(profile.player_count - int(occupied.sum()))
+
+    async def read(i, row_backend, enhance):
+        image_bytes = await loop.run_in_executor(executor, crop_row, image, profile.row_boxes[i], enhance)
+        return await row_backend.detect(image_bytes)
+
+    async def first_pass(i):
+        try:
+            rows[i] = await read(i, backend, False)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("%d行目の認識に失敗しました: %s", i + 1, e)
+        if on_progress:
+            on_progress(1)
+
+    await asyncio.gather(*(first_pass(i) for i in range(profile.player_count) if occupied[i]))
+
+    async def second_pass(i):
+        try:
+            rows[i] = pick_better(rows[i], await read(i, retry_backend, True))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning("%d行目の再認識に失敗しました: %s", i + 1, e)
+
+    retry_rows = [i for i in range(profile.player_count) if occupied[i] and needs_retry(rows[i], roster)]
+    if retry_rows:
+        log.debug("%d 行を再認識します", len(retry_rows))
+        inc("ocr_retries", len(retry_rows))
+        await asyncio.gather(*(second_pass(i) for i in retry_rows))
+
+    # 名簿の名前に寄せる
+    if roster:
+        for result in rows:
+            if result is not None:
+                result.text = match_roster(result.text, roster) or result.text
+    return rows
+
+
+class TkAsyncBridge:
+    """Tk の mainloop と同じスレッドで asyncio のイベントループを回す.
+
+    interval ミリ秒ごとに after() からイベントループを 1 周だけ進めるので、
+    コルーチンの完了コールバックはそのまま Tk のウィジェットを触ってよい。
+    """
+
+    def __init__(self, root, interval=10):
+        self.root = root
+        self.interval = interval
+        self.loop = asyncio.new_event_loop()
+        self._after_id = None
+        self._tick()
+
+    def _tick(self):
+        self.loop.call_soon(self.loop.stop)
+        self.loop.run_forever()  # 実行可能なコールバックを 1 周分だけ処理する
+        self._after_id = self.root.after(self.interval, self._tick)
+
+    def submit(self, coro, on_done=None):
+        """コルーチンをタスクとして開始する。on_done(task) は Tk のスレッドで呼ばれる."""
+        task = self.loop.create_task(coro)
+        if on_done is not None:
+            task.add_done_callback(on_done)
+        return task
+
+    def close(self):
+        """残っているタスクを取り消してイベントループを閉じる."""
+        if self._after_id is not None:
+            self.root.after_cancel(self._after_id)
+            self._after_id = None
+        tasks = asyncio.all_tasks(self.loop)
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            self.loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        self.loop.close()
@@ -0,0 +1,96 @@
+from collections import deque
+
+import numpy as np
+
+from frame_archive import NEAR_DUPLICATE_DISTANCE, dhash, hamming_distances
+from metrics import inc, span
+from row_occupancy import EDGE_THRESHOLD
+
+# 比べる直近の確定済みレース数
+HISTORY = 4
+# 行ごとの文字幅をこの px 単位に丸めて比べる
+WIDTH_BUCKET = 8
+# 丸めた文字幅がこれ以下の差なら同じ名前とみなす
+MAX_WIDTH_DELTA = 1
+
+
+class DuplicateCapture(Exception):
+    """直近に確定したレースと同じリザルト画面を読もうとした."""
+
+    def __init__(self, race):
+        super().__init__(f"{race + 1}レース目と同じ画面です")
+        self.race = race
+
+
+class Fingerprint:
+    """名前欄の指紋 (知覚ハッシュと、行ごとの文字の有無・文字幅の粗い配置)."""
+
+    __slots__ = ("phash", "occupied", "widths")
+
+    def __init__(self, phash, occupied, widths):
+        self.phash = phash
+        self.occupied = occupied
+        self.widths = widths
+
+
+def fingerprint(image, profile):
+    """名前欄を指紋にする (OCR に投げる前に数 ms で済む計算だけを使う).
+
+    dHash だけだと背景とチームカラーが同じ別のレースを見分けにくいので、
+    行ごとに文字 (横方向のエッジ) がある範囲の幅を WIDTH_BUCKET px 単位で並べたものも持つ。
+    """
+    top = profile.name_area[1]
+    roi = image.crop(profile.name_area)
+    gray = np.asarray(roi.convert("L"), dtype=np.int16)
+    edges = np.abs(np.diff(gray, axis=1)) > EDGE_THRESHOLD
+
+    # 行ごとに、どこかの画素にエッジがある列
+    starts = np.array([box[1] - top for box in profile.row_boxes], dtype=np.intp)
+    columns = np.logical_or.reduceat(edges, starts, axis=0)
+    occupied = columns.any(axis=1)
+    first = columns.argmax(axis=1)
+    last = columns.shape[1] - 1 - columns[:, ::-1].argmax(axis=1)
+    widths = np.where(occupied, (last - first + 1) // WIDTH_BUCKET, 0)
+    return Fingerprint(dhash(roi), occupied, widths)
+
+
+class CaptureGuard:
+    """直近に確定したレースの名前欄と比べて、同じリザルト画面の二重キャプチャを見つける.
+
+    スペースキーの二度押しや自動キャプチャの誤爆では、ほぼ同じ画面をもう一度読むことになる。
+    OCR の前に check() で直近 history レースの指紋と比べ、確定したら remember() で覚えておく。
+    """
+
+    def __init__(self, profile, history=HISTORY, max_distance=NEAR_DUPLICATE_DISTANCE,
+                 max_width_delta=MAX_WIDTH_DELTA):
+        self.profile = profile
+        self.max_distance = max_distance
+        self.max_width_delta = max_width_delta
+        self.recent = deque(maxlen=history)  # (レース番号, Fingerprint)
+
+    def set_profile(self, profile):
+        """大会形式が変わったら名前欄の位置も変わるので、覚えた指紋を捨てる."""
+        if profile is not self.profile:
+            self.profile = profile
+            self.recent.clear()
+
+    def check(self, image):
+        """(指紋, 同じ画面と判断したレース番号 or None) を返す."""
+        with span("capture_guard"):
+            value = fingerprint(image, self.profile)
+            if not self.recent:
+                return value, None
+            hashes = np.array([fp.phash for _, fp in self.recent], dtype=np.uint64)
+            distances = hamming_distances(hashes, value.phash)
+            # 新しいレースから順に比べる
+            for (race, fp), distance in zip(reversed(self.recent), distances[::-1]):
+                if (distance <= self.max_distance
+                        and np.array_equal(fp.occupied, value.occupied)
+                        and np.abs(fp.widths - value.widths).max() <= self.max_width_delta):
+                    inc("duplicate_captures")
+                    return value, race
+        return value, None
+
+    def remember(self, value, race):
+        """確定したレースの指紋を覚える."""
+        self.recent.append((race, value))
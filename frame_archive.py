@@ -0,0 +1,197 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+from PIL import Image, features
+
+# これ以下のハミング距離ならほぼ同じ画像とみなす (64 ビットの dHash)
+NEAR_DUPLICATE_DISTANCE = 3
+# ほぼ同じ画像を探す直近のオブジェクト数 (撮り直し・取り消した後の再キャプチャはすぐ後に来る)
+RECENT_FRAMES = 32
+# 比べる縮小画像の縮小率と、差の平均を取るブロックの大きさ (縮小画像の px)
+THUMBNAIL_SCALE = 8
+BLOCK_SIZE = 8
+# ブロックごとの平均の差 (画素値) の最大がこれ以下ならほぼ同じ画像とみなす
+# (キャプチャのノイズは縮小とブロックの平均で 1 未満に均され、名前が 1 行違えば数十になる)
+NEAR_DUPLICATE_BLOCK_DIFF = 4.0
+
+
+def content_hash(image):
+    """画素データの SHA-256 (ファイル形式やメタデータが違っても同じ画像なら同じ値)."""
+    image = image.convert("RGB")
+    digest = hashlib.sha256(f"{image.size[0]}x{image.size[1]}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def dhash(image, size=8):
+    """差分ハッシュ (dHash) を 64 ビット整数で返す."""
+    small = image.convert("L").resize((size + 1, size), Image.Resampling.BILINEAR)
+    pixels = np.asarray(small, dtype=np.int16)
+    bits = (pixels[:, 1:] > pixels[:, :-1]).ravel()
+    return int(np.packbits(bits).view(">u8")[0])
+
+
+def thumbnail(image, scale=THUMBNAIL_SCALE):
+    """面積平均で縮小したグレースケールの画素 (ほぼ同じ画像の判定用)."""
+    return np.asarray(image.convert("L").reduce(scale), dtype=np.uint8)
+
+
+def max_block_difference(a, b, block=BLOCK_SIZE):
+    """2 枚の縮小画像を block px 四方ごとに比べた、差の平均の最大値."""
+    if a.shape != b.shape:
+        return float("inf")
+    diff = np.abs(a.astype(np.int16) - b.astype(np.int16))
+    height = diff.shape[0] - diff.shape[0] % block
+    width = diff.shape[1] - diff.shape[1] % block
+    blocks = diff[:height, :width].reshape(height // block, block, width // block, block)
+    return float(blocks.mean(axis=(1, 3)).max())
+
+
+def hamming_distances(hashes, value):
+    """uint64 配列の各要素と value のハミング距離をまとめて求める."""
+    xor = np.bitwise_xor(hashes, np.uint64(value))
+    return np.unpackbits(xor.view(np.uint8).reshape(-1, 8), axis=1).sum(axis=1)
+
+
+class FrameArchive:
+    """リザルト画像の内容アドレス型アーカイブ.
+
+    画像は画素のハッシュをファイル名にして 1 回だけ保存し (可逆 WebP、無ければ最適化 PNG)、
+    同じ画像は既存のオブジェクトを指すだけにする。直近 RECENT_FRAMES 個のオブジェクトと
+    縮小画像をブロックごとに比べ、ノイズしか違わない画像 (同じ画面の撮り直し・取り消した後の
+    再キャプチャ) もレースをまたいで既存のオブジェクトを指す。リザルト画面はどれも配置が同じなので
+    画像全体の dHash では比べず、名前・得点が 1 行でも違えば別の画像として保存する。
+    index.jsonl に (セッション, レース) -> ハッシュ の対応を追記し、起動時にメモリへ読み込む
+    (比べる縮小画像はメモリにだけ持つので、再起動後はその後に保存した画像と比べる)。
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.objects_dir = os.path.join(root_dir, "objects")
+        self.index_path = os.path.join(root_dir, "index.jsonl")
+        self.extension = ".webp" if features.check("webp") else ".png"
+        self.entries = {}  # (session, race) -> エントリ
+        self.objects = {}  # ハッシュ -> パス
+        self.recent = deque(maxlen=RECENT_FRAMES)  # (ハッシュ, 縮小画像) 新しいものが後ろ
+        self._lock = threading.Lock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self.index_path):
+            return
+        with open(self.index_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue  # 書き込み途中の行
+                self.entries[(entry["session"], entry["race"])] = entry
+                self.objects.setdefault(entry["hash"], entry["path"])
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest + self.extension)
+
+    def find_near_duplicate(self, small):
+        """直近のオブジェクトにノイズしか違わない画像があればそのハッシュを返す (無ければ None)."""
+        for digest, other in reversed(self.recent):
+            if max_block_difference(small, other) <= NEAR_DUPLICATE_BLOCK_DIFF:
+                return digest
+        return None
+
+    def put(self, image, session, race, source=None):
+        """画像をアーカイブしてエントリを返す (同じ画像は保存し直さない)."""
+        digest = content_hash(image)
+        value = dhash(image)
+        small = thumbnail(image)
+        with self._lock:
+            duplicate_of = None
+            if digest not in self.objects:
+                duplicate_of = self.find_near_duplicate(small)
+            stored = duplicate_of or digest
+            if stored not in self.objects:
+                path = self._object_path(digest)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                tmp_path = path + ".tmp"
+                if self.extension == ".webp":
+                    image.save(tmp_path, format="WEBP", lossless=True, quality=100, method=4)
+                else:
+                    image.save(tmp_path, format="PNG", optimize=True)
+                os.replace(tmp_path, path)
+                self.objects[stored] = path
+                self.recent.append((stored, small))
+
+            entry = {
+                "session": session,
+                "race": race,
+                "hash": stored,
+                "path": self.objects[stored],
+                "dhash": value,
+                "near_duplicate": duplicate_of is not None,
+                "source": source,
+                "ts": time.time(),
+            }
+            os.makedirs(self.root_dir, exist_ok=True)
+            with open(self.index_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self.entries[(session, race)] = entry
+        return entry
+
+    def path(self, session, race):
+        """(セッション, レース) の画像ファイルのパスを返す (無ければ None)."""
+        entry = self.entries.get((session, race))
+        return entry["path"] if entry else None
+
+    def get(self, session, race):
+        """(セッション, レース) の画像を開いて返す (無ければ None)."""
+        path = self.path(session, race)
+        return Image.open(path) if path else None
+
+    def races(self, session):
+        """セッションに含まれるレース番号の一覧."""
+        return sorted(race for s, race in self.entries if s == session)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="リザルト画像のアーカイブ")
+    parser.add_argument("--root", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "mkscan_data", "archive"))
+    sub = parser.add_subparsers(dest="command", required=True)
+    import_parser = sub.add_parser("import", help="ディレクトリの画像をまとめて取り込む")
+    import_parser.add_argument("pattern", help="ディレクトリまたは glob パターン")
+    import_parser.add_argument("--session", required=True)
+    get_parser = sub.add_parser("get", help="レースの画像を書き出す")
+    get_parser.add_argument("session")
+    get_parser.add_argument("race", type=int)
+    get_parser.add_argument("output")
+    args = parser.parse_args()
+
+    archive = FrameArchive(args.root)
+    if args.command == "import":
+        pattern = os.path.join(args.pattern, "*") if os.path.isdir(args.pattern) else args.pattern
+        paths = sorted(p for p in glob.glob(pattern) if p.lower().endswith((".png", ".jpg", ".jpeg", ".webp")))
+        before = sum(os.path.getsize(p) for p in paths)
+        stored = set()
+        for race, path in enumerate(paths):
+            with Image.open(path) as image:
+                entry = archive.put(image, args.session, race, source=path)
+            stored.add(entry["path"])
+        after = sum(os.path.getsize(p) for p in stored)
+        print(f"{len(paths)} 枚を取り込みました ({len(stored)} オブジェクト, {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB)")
+    else:
+        start = time.perf_counter()
+        image = archive.get(args.session, args.race)
+        if image is None:
+            print("見つかりませんでした")
+            return
+        image.save(args.output)
+        print(f"{args.output} に書き出しました ({(time.perf_counter() - start) * 1000:.1f} ms)")
+
+
+if __name__ == "__main__":
+    main()
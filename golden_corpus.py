@@ -0,0 +1,453 @@
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+
+from PIL import Image
+
+from async_ocr import ExecutorBackend
+from ocr_backends import OcrResult, VisionBackend, local_backend
+from ocr_limits import CostMeter
+from scoring_engine import ScoringSession, compute_standings, decode_image
+from scoring_formats import DEFAULT_PROFILE, PROFILES, RACES_PER_WAR
+from synthetic_frames import RESOLUTIONS, StubOcrBackend, SyntheticScenario
+
+# リポジトリに入れておく正解付きのリザルト画面
+GOLDEN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "test", "golden")
+MANIFEST_NAME = "manifest.json"
+RESPONSES_NAME = "ocr_responses.json"
+MANIFEST_VERSION = 1
+
+# ベースラインからの許容幅 (正解率は下がってよい幅、CPU 時間と OCR 回数は増えてよい割合)
+TOLERANCES = {
+    "name_accuracy": 0.0,
+    "standings_accuracy": 0.0,
+    "cpu_ms_per_race": 0.25,
+    "ocr_calls_per_race": 0.0,
+}
+# CPU 時間は揺れるので何回か通して一番速い回を使う
+REPEAT = 3
+
+
+def response_key(image_bytes):
+    """行画像の画素から記録のキーを作る (PNG の圧縮設定が変わっても同じキーになる)."""
+    image = Image.open(io.BytesIO(image_bytes))
+    image.load()
+    header = f"{image.mode}{image.size}".encode()
+    return hashlib.sha1(header + image.tobytes()).hexdigest()
+
+
+class RecordingBackend:
+    """本物の OCR の応答を行画像ごとに responses に書き留めるラッパー."""
+
+    def __init__(self, backend, responses):
+        self.backend = backend
+        self.name = backend.name
+        self.responses = responses
+        self._lock = threading.Lock()
+
+    def detect(self, image_bytes):
+        result = self.backend.detect(image_bytes)
+        value = None if result is None else {"text": result.text, "confidence": result.confidence}
+        key = response_key(image_bytes)
+        with self._lock:
+            self.responses[key] = value
+        return result
+
+
+class ReplayBackend:
+    """記録した応答を返すだけの OCR (ネットワークを使わない).
+
+    calls は呼ばれた回数 (本物なら API を呼んだ回数)、unrecorded は記録に無い行画像の数。
+    unrecorded が増えたら行画像の切り出し方が変わっているので、記録を取り直す。
+    """
+
+    name = "replay"
+
+    def __init__(self, responses):
+        self.responses = responses
+        self.calls = 0
+        self.unrecorded = 0
+        self._lock = threading.Lock()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.unrecorded = 0
+
+    def detect(self, image_bytes):
+        key = response_key(image_bytes)
+        with self._lock:
+            self.calls += 1
+            if key not in self.responses:
+                self.unrecorded += 1
+                return None
+            value = self.responses[key]
+        return None if value is None else OcrResult(value["text"], value["confidence"], backend=self.name)
+
+
+class GoldenCorpus:
+    """正解付きのリザルト画面の一式 (manifest.json と記録した OCR 応答).
+
+    manifest の sessions は [{"name", "format", "races": [{"image", "player_names", "standings"}]}]。
+    player_names はそのレースの順位順の名前 (空欄は null)、standings はそのレースを確定した後の
+    [順位, チーム, 得点] (チーム名は小文字)。画像のパスは manifest からの相対パス。
+    """
+
+    def __init__(self, directory=GOLDEN_DIR):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, MANIFEST_NAME)
+        self.responses_path = os.path.join(directory, RESPONSES_NAME)
+        self.sessions = []
+        self.baseline = None
+        self.tolerances = dict(TOLERANCES)
+        self.responses = {}
+
+    @classmethod
+    def load(cls, directory=GOLDEN_DIR):
+        corpus = cls(directory)
+        with open(corpus.manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") != MANIFEST_VERSION:
+            raise ValueError(f"manifest のバージョンが違います: {manifest.get('version')}")
+        corpus.sessions = manifest["sessions"]
+        corpus.baseline = manifest.get("baseline")
+        corpus.tolerances.update(manifest.get("tolerances", {}))
+        if os.path.exists(corpus.responses_path):
+            with open(corpus.responses_path, "r", encoding="utf-8") as f:
+                corpus.responses = json.load(f)
+        return corpus
+
+    def save(self):
+        os.makedirs(self.directory, exist_ok=True)
+        manifest = {
+            "version": MANIFEST_VERSION,
+            "sessions": self.sessions,
+            "baseline": self.baseline,
+            "tolerances": self.tolerances,
+        }
+        # git の差分を読みやすくするため、どちらも 1 項目 1 行で書く (応答はキーの順も固定する)
+        with open(self.manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+            f.write("\n")
+        with open(self.responses_path, "w", encoding="utf-8") as f:
+            json.dump(self.responses, f, ensure_ascii=False, indent=0, sort_keys=True)
+            f.write("\n")
+
+    def image_path(self, entry):
+        return os.path.join(self.directory, entry["image"])
+
+    def race_count(self):
+        return sum(len(session["races"]) for session in self.sessions)
+
+
+def expected_standings(team_total_scores):
+    """合計得点から manifest に書く順位表を作る."""
+    return [[rank, str(team).lower(), score] for rank, team, score, _ in compute_standings(team_total_scores)]
+
+
+def standings_match(expected, actual):
+    """順位表が一致するか (チーム名の大文字・小文字は区別しない)."""
+    return [(rank, str(team).lower(), score) for rank, team, score in expected] == \
+        [(rank, str(team).lower(), score) for rank, team, score, _ in actual]
+
+
+class DirectOcr:
+    """ヘッジもフォールバックも無しに backend を直接呼ぶ OcrStack の代わり.
+
+    OcrStack を通すと遅い応答へのヘッジやサーキットブレーカーの切り替えで呼ばれる回数と
+    応答の出どころが揺れるので、記録と再生では行の読み取り 1 回を backend の 1 回にする。
+    """
+
+    def __init__(self, backend):
+        self.meter = CostMeter()
+        self.backend = backend
+        self.retry_backend = backend
+        self.async_backend = ExecutorBackend(backend)
+
+    def async_retry_backend(self):
+        return self.async_backend
+
+    def close(self):
+        pass
+
+
+def _new_session(profile, backend):
+    return ScoringSession(profile, DirectOcr(backend))
+
+
+def record_session(corpus, session_entry, backend, prepare=None):
+    """1 セッション分の画像を backend で読み、応答を corpus.responses に記録する.
+
+    prepare(image, entry) はレースごとに OCR の前に呼ばれる (合成画像のスタブに正解を登録するなど)。
+    戻り値はレースごとの (読めた名前, 確定後の順位表)。
+    """
+    profile = PROFILES[session_entry["format"]]
+    session = _new_session(profile, RecordingBackend(backend, corpus.responses))
+    read = []
+    try:
+        for entry in session_entry["races"]:
+            with open(corpus.image_path(entry), "rb") as f:
+                image = decode_image(f.read())
+            if prepare is not None:
+                prepare(image, entry)
+            player_names, _ = session.ingest_image(image, allow_duplicate=True)
+            read.append((player_names, expected_standings(session.team_total_scores)))
+    finally:
+        session.ocr.close()
+    return read
+
+
+def seed_synthetic(directory=GOLDEN_DIR, sessions=2, races=RACES_PER_WAR, profile=DEFAULT_PROFILE,
+                   noise=2.0, missing_rate=0.1, jpeg_quality=85, lossless=True):
+    """合成リザルト画面でコーパスを作る (本物のスクリーンショットが集まるまでの種).
+
+    セッションごとに解像度・タグの付け方・圧縮を変え、正解は SyntheticScenario のものを使う。
+    lossless=False なら全セッションを JPEG にする (ノイズ入りの PNG は 1 枚数 MB になるため)。
+    OCR の応答は StubOcrBackend を通して記録する。
+    """
+    corpus = GoldenCorpus(directory)
+    stub = StubOcrBackend()
+    tag_styles = ("prefix", "suffix", "mixed")
+    resolutions = sorted(RESOLUTIONS)
+    for s in range(sessions):
+        scenario = SyntheticScenario(profile, seed=s, tag_style=tag_styles[s % len(tag_styles)])
+        resolution = resolutions[s % len(resolutions)]
+        name = f"synthetic-{s + 1:02d}"
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+        totals = {}
+        entries = []
+        for race in range(races):
+            missing = int(scenario.rng.random() < missing_rate) * scenario.rng.randint(1, max(1, profile.team_size))
+            quality = jpeg_quality if s % 2 or not lossless else None
+            data, truth = scenario.frame(missing, resolution, noise, quality)
+            image = f"{name}/race-{race + 1:02d}.{'jpg' if quality else 'png'}"
+            with open(os.path.join(directory, image), "wb") as f:
+                f.write(data)
+            for team, score in truth["race_scores"].items():
+                totals[team] = totals.get(team, 0) + score
+            entries.append({
+                "image": image,
+                "player_names": truth["player_names"],
+                "standings": expected_standings(totals),
+            })
+        session_entry = {"name": name, "format": profile.key, "races": entries}
+        corpus.sessions.append(session_entry)
+        record_session(corpus, session_entry, stub,
+                       prepare=lambda image, entry: stub.register(image, profile, entry["player_names"]))
+    corpus.save()
+    return corpus
+
+
+def add_session(corpus, name, paths, profile, backend):
+    """スクリーンショットをセッションとして追加し、backend の応答を記録する.
+
+    正解は読み取り結果で仮に埋めるので、manifest を開いて目で確かめて直すこと。
+    """
+    session_entry = {
+        "name": name,
+        "format": profile.key,
+        "races": [{"image": os.path.relpath(path, corpus.directory), "player_names": [], "standings": []}
+                  for path in paths],
+    }
+    for entry, (player_names, standings) in zip(session_entry["races"], record_session(corpus, session_entry, backend)):
+        entry["player_names"] = player_names
+        entry["standings"] = standings
+    corpus.sessions.append(session_entry)
+    corpus.baseline = None  # レースが増えたのでベースラインは取り直す
+    corpus.save()
+    return session_entry
+
+
+def _reference_cpu(images):
+    # マシンの速さの目安 (リポジトリのコードを通さない、画像のデコードだけの CPU 時間)
+    start = time.process_time()
+    for data in images:
+        Image.open(io.BytesIO(data)).convert("RGB")
+    return time.process_time() - start
+
+
+def replay(corpus, repeat=REPEAT):
+    """記録した OCR 応答でコーパスを通し、正解率・1 レースの CPU 時間・OCR 回数を測る.
+
+    CPU 時間は time.process_time (OCR のワーカースレッドの分も含む) で、repeat 回のうち最小の回を使う。
+    """
+    backend = ReplayBackend(corpus.responses)
+    sessions = []
+    for session_entry in corpus.sessions:
+        images = []
+        for entry in session_entry["races"]:
+            with open(corpus.image_path(entry), "rb") as f:
+                images.append(f.read())
+        sessions.append((session_entry, images))
+    races = corpus.race_count()
+    if not races:
+        raise ValueError("コーパスにレースがありません")
+
+    best = None
+    for _ in range(repeat):
+        backend.reset()
+        cpu = 0.0
+        slowest = 0.0
+        rows = correct_names = correct_standings = 0
+        failures = []
+        for session_entry, images in sessions:
+            session = _new_session(PROFILES[session_entry["format"]], backend)
+            for race, (entry, data) in enumerate(zip(session_entry["races"], images)):
+                start = time.process_time()
+                player_names, _ = session.ingest_bytes(data, allow_duplicate=True)
+                spent = time.process_time() - start
+                cpu += spent
+                slowest = max(slowest, spent)
+
+                expected = entry["player_names"]
+                rows += len(expected)
+                correct_names += sum(a == b for a, b in zip(player_names, expected))
+                if standings_match(entry["standings"], session.standings()):
+                    correct_standings += 1
+                else:
+                    failures.append(f"{session_entry['name']} {race + 1}レース目: {entry['image']}")
+            session.ocr.close()
+        if best is None or cpu < best["cpu"]:
+            best = {
+                "cpu": cpu,
+                "slowest": slowest,
+                "rows": rows,
+                "correct_names": correct_names,
+                "correct_standings": correct_standings,
+                "calls": backend.calls,
+                "unrecorded": backend.unrecorded,
+                "failures": failures,
+            }
+
+    reference = min(sum(_reference_cpu(images) for _, images in sessions) for _ in range(repeat))
+    return {
+        "races": races,
+        "name_accuracy": best["correct_names"] / max(best["rows"], 1),
+        "standings_accuracy": best["correct_standings"] / races,
+        "cpu_ms_per_race": best["cpu"] * 1000 / races,
+        "cpu_ms_slowest_race": best["slowest"] * 1000,
+        "reference_ms": reference * 1000,
+        "ocr_calls_per_race": best["calls"] / races,
+        "unrecorded_crops": best["unrecorded"],
+        "mismatched_races": best["failures"],
+    }
+
+
+def gate(baseline, result, tolerances=None):
+    """ベースラインと比べて、劣化していれば理由のリストを返す (問題無ければ空).
+
+    CPU 時間は画像のデコードにかかる時間 (reference_ms) の比で別のマシンの速さに合わせる。
+    """
+    tolerances = dict(TOLERANCES, **(tolerances or {}))
+    problems = []
+    for key in ("name_accuracy", "standings_accuracy"):
+        if result[key] < baseline[key] - tolerances[key] - 1e-9:
+            problems.append(f"{key} が下がりました: {baseline[key]:.4f} -> {result[key]:.4f}")
+
+    scale = 1.0
+    if baseline.get("reference_ms") and result.get("reference_ms"):
+        scale = result["reference_ms"] / baseline["reference_ms"]
+    limit = baseline["cpu_ms_per_race"] * scale * (1 + tolerances["cpu_ms_per_race"])
+    if result["cpu_ms_per_race"] > limit:
+        problems.append(
+            f"1 レースの CPU 時間が増えました: {baseline['cpu_ms_per_race'] * scale:.1f} -> "
+            f"{result['cpu_ms_per_race']:.1f} ms (上限 {limit:.1f} ms)"
+        )
+
+    limit = baseline["ocr_calls_per_race"] * (1 + tolerances["ocr_calls_per_race"])
+    if result["ocr_calls_per_race"] > limit + 1e-9:
+        problems.append(
+            f"1 レースの OCR 回数が増えました: {baseline['ocr_calls_per_race']:.2f} -> {result['ocr_calls_per_race']:.2f}"
+        )
+    if result["unrecorded_crops"]:
+        problems.append(f"記録に無い行画像が {result['unrecorded_crops']} 件あります (--record で取り直してください)")
+    return problems
+
+
+def format_report(result, baseline=None):
+    lines = [f"{result['races']} レース"]
+    for key in ("name_accuracy", "standings_accuracy", "cpu_ms_per_race", "ocr_calls_per_race"):
+        line = f"{key:<22}{result[key]:>10.4f}"
+        if baseline:
+            line += f"   (ベースライン {baseline[key]:.4f})"
+        lines.append(line)
+    lines.append(f"{'cpu_ms_slowest_race':<22}{result['cpu_ms_slowest_race']:>10.4f}")
+    lines.append(f"{'reference_ms':<22}{result['reference_ms']:>10.4f}")
+    for race in result["mismatched_races"]:
+        lines.append(f"順位表が合わない: {race}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="正解付きのリザルト画面で正解率と速さの劣化を調べる")
+    parser.add_argument("--corpus", default=GOLDEN_DIR, help="manifest.json のあるディレクトリ")
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--update-baseline", action="store_true", help="今の結果をベースラインとして保存する")
+    mode.add_argument("--seed-synthetic", type=int, metavar="SESSIONS", help="合成リザルト画面でコーパスを作る")
+    parser.add_argument("--races", type=int, default=RACES_PER_WAR, help="--seed-synthetic の 1 セッションのレース数")
+    parser.add_argument("--jpeg-only", action="store_true", help="--seed-synthetic の画像を全て JPEG にする")
+    mode.add_argument("--add", nargs="+", metavar="IMAGE", help="スクリーンショットをセッションとして追加する")
+    mode.add_argument("--record", action="store_true", help="全画像の OCR 応答を取り直す")
+    parser.add_argument("--name", help="--add するセッションの名前")
+    parser.add_argument("--format", choices=sorted(PROFILES), default=DEFAULT_PROFILE.key)
+    parser.add_argument("--backend", choices=("vision", "local"), default="vision", help="--add / --record で使う OCR")
+    args = parser.parse_args()
+
+    if args.seed_synthetic:
+        corpus = seed_synthetic(args.corpus, args.seed_synthetic, args.races, PROFILES[args.format],
+                                lossless=not args.jpeg_only)
+        corpus.baseline = replay(corpus, args.repeat)
+        corpus.save()
+        print(format_report(corpus.baseline))
+        return
+
+    manifest_path = os.path.join(args.corpus, MANIFEST_NAME)
+    if os.path.exists(manifest_path):
+        corpus = GoldenCorpus.load(args.corpus)
+    elif args.add:
+        corpus = GoldenCorpus(args.corpus)  # 最初のセッションでコーパスを作る
+    else:
+        print(f"{manifest_path} がありません。--seed-synthetic で合成コーパスを作るか、"
+              "--add でスクリーンショットを追加してください", file=sys.stderr)
+        sys.exit(2)
+    if args.add or args.record:
+        backend = local_backend() if args.backend == "local" else VisionBackend()
+        if backend is None:
+            parser.error("ローカル OCR が使えません")
+        if args.add:
+            name = args.name or f"session-{len(corpus.sessions) + 1:02d}"
+            add_session(corpus, name, args.add, PROFILES[args.format], backend)
+            print(f"{name} を追加しました。{corpus.manifest_path} の正解を確かめてから --update-baseline してください")
+        else:
+            corpus.responses.clear()
+            for session_entry in corpus.sessions:
+                record_session(corpus, session_entry, backend)
+            corpus.save()
+            print(f"{len(corpus.responses)} 件の応答を記録しました")
+        return
+
+    result = replay(corpus, args.repeat)
+    if args.update_baseline or corpus.baseline is None:
+        corpus.baseline = result
+        corpus.save()
+        print(format_report(result))
+        print("ベースラインを保存しました")
+        return
+
+    print(format_report(result, corpus.baseline))
+    problems = gate(corpus.baseline, result, corpus.tolerances)
+    for problem in problems:
+        print("NG:", problem)
+    if problems:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+import os
+import shutil
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image, ImageTk
+
+
+class ImageHistory:
+    """レース結果画像の履歴.
+
+    キャプチャした画像はセッション用ディレクトリに 1 回だけ保存し (書き込みは別スレッド)、
+    表示用のサムネイル (PhotoImage) は件数上限付きの LRU に持っておく。
+    << / >> での切り替えはキャッシュに当たればディスクを読まない。
+    """
+
+    def __init__(self, root_dir, thumb_size=(300, 300), cache_size=32):
+        self.root_dir = root_dir
+        self.thumb_size = thumb_size
+        self.cache_size = cache_size
+        self.session_dir = os.path.join(root_dir, time.strftime("session-%Y%m%d-%H%M%S"))
+        self.paths = []  # 表示順の画像パス
+        self._thumbnails = OrderedDict()  # パス -> PhotoImage
+        self._pending = {}  # パス -> 書き込み中の Future
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._counter = 0
+
+    def add(self, image):
+        """キャプチャした画像を履歴に追加し、保存先のパスを返す."""
+        os.makedirs(self.session_dir, exist_ok=True)
+        self._counter += 1
+        # 書き終わった Future は捨てる
+        self._pending = {p: f for p, f in self._pending.items() if not f.done()}
+        path = os.path.join(self.session_dir, f"capture_{self._counter:04d}.png")
+        self._pending[path] = self._writer.submit(image.save, path, format="PNG")
+        self.paths.append(path)
+
+        # サムネイルはメモリ上の画像から作っておく (後でディスクから読み直さない)
+        thumbnail = image.copy()
+        thumbnail.thumbnail(self.thumb_size)
+        self._remember(path, ImageTk.PhotoImage(thumbnail))
+        return path
+
+    def add_path(self, path):
+        """既存の画像ファイルを (コピーせずに) 履歴に追加する."""
+        self.paths.append(path)
+        return path
+
+    def restore(self, paths, session_name=None):
+        """ジャーナルから復元した画像パスで履歴を置き換える.
+
+        session_name があれば前回と同じセッション用ディレクトリを使う (交流戦の終わりで
+        画像パスが空になっていても、セッション名が変わらない)。無ければ画像パスから探す。
+        前回のセッション用ディレクトリが残っていれば、続きもそこに保存する。
+        """
+        self.paths[:] = paths
+        self._thumbnails.clear()
+        root = os.path.abspath(self.root_dir)
+        if session_name:
+            # ディレクトリが消えていても、セッション名は引き継ぐ
+            self.session_dir = os.path.join(root, session_name)
+        else:
+            for path in reversed(paths):
+                directory = os.path.dirname(os.path.abspath(path))
+                if os.path.dirname(directory) == root and os.path.isdir(directory):
+                    self.session_dir = directory
+                    break
+        if os.path.isdir(self.session_dir):
+            numbers = [
+                int(name[8:12]) for name in os.listdir(self.session_dir)
+                if name.startswith("capture_") and name[8:12].isdigit()
+            ]
+            self._counter = max(numbers, default=0)
+
+    def pop(self):
+        """最後の画像を履歴から外し、セッション用ディレクトリのファイルなら削除する."""
+        if not self.paths:
+            return None
+        path = self.paths.pop()
+        self._thumbnails.pop(path, None)
+        future = self._pending.pop(path, None)
+        if future is not None:
+            future.result()
+        if self._is_managed(path) and os.path.exists(path):
+            os.remove(path)
+        return path
+
+    def clear(self):
+        """交流戦が終わったときに履歴とサムネイルを捨てる (保存した画像ファイルは残す)."""
+        self.paths.clear()
+        self._thumbnails.clear()
+
+    def photo(self, index):
+        """index 番目の画像のサムネイル (PhotoImage) を返す."""
+        path = self.paths[index]
+        photo = self._thumbnails.get(path)
+        if photo is not None:
+            self._thumbnails.move_to_end(path)
+            return photo
+        future = self._pending.pop(path, None)
+        if future is not None:
+            future.result()
+        with Image.open(path) as image:
+            image.draft("RGB", self.thumb_size)  # JPEG は縮小デコードする
+            image.thumbnail(self.thumb_size)
+            photo = ImageTk.PhotoImage(image)
+        self._remember(path, photo)
+        return photo
+
+    def _remember(self, path, photo):
+        self._thumbnails[path] = photo
+        self._thumbnails.move_to_end(path)
+        while len(self._thumbnails) > self.cache_size:
+            self._thumbnails.popitem(last=False)
+
+    def _is_managed(self, path):
+        return os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.session_dir)
+
+    def flush(self):
+        """書き込み中の画像をすべて書き終える."""
+        for future in list(self._pending.values()):
+            future.result()
+        self._pending.clear()
+
+    def close(self):
+        """書き込みを終えてスレッドを止める (画像は再開用に残す)."""
+        self.flush()
+        self._writer.shutdown()
+        self._thumbnails.clear()
+
+
+def cleanup_sessions(root_dir, keep_dir=None, archive=True, max_archives=10):
+    """終わったセッションの画像ディレクトリを zip にまとめて (または消して) 片付ける.
+
+    zip は新しいものから max_archives 個だけ残す。
+    """
+    if not os.path.isdir(root_dir):
+        return
+    archive_dir = os.path.join(root_dir, "archive")
+    for name in sorted(os.listdir(root_dir)):
+        path = os.path.join(root_dir, name)
+        if not name.startswith("session-") or not os.path.isdir(path):
+            continue
+        if keep_dir and os.path.abspath(path) == os.path.abspath(keep_dir):
+            continue
+        if archive and os.listdir(path):
+            os.makedirs(archive_dir, exist_ok=True)
+            shutil.make_archive(os.path.join(archive_dir, name), "zip", path)
+        shutil.rmtree(path, ignore_errors=True)
+
+    if os.path.isdir(archive_dir):
+        archives = sorted(f for f in os.listdir(archive_dir) if f.endswith(".zip"))
+        for name in archives[:-max_archives] if max_archives else []:
+            os.remove(os.path.join(archive_dir, name))
@@ -0,0 +1,146 @@
+import threading
+import time
+
+import cv2
+import numpy as np
+from PIL import Image, ImageTk
+
+
+class FrameGrabber:
+    """キャプチャボードから最新フレームを取り出せるようにしておくスレッド.
+
+    裏では grab() (デコードしない) だけを回し続け、画像が必要なときだけ
+    次に grab したフレームを同じスレッドで retrieve() して 1 枠の受け渡し場所に置く。
+    キャプチャデバイスに触るのはこのスレッドだけなので、ブロックする grab() の間も
+    ロックを持たず、Tk のスレッドが待たされるのは長くても 1 フレーム分になる。
+    """
+
+    def __init__(self, cap, timeout=0.5):
+        self.cap = cap
+        self.timeout = timeout  # retrieve() で次のフレームを待つ上限 (秒)
+        self.frame_count = 0  # grab できたフレーム数
+        self._lock = threading.Lock()
+        self._wanted = threading.Event()  # 次のフレームのデコードを頼まれている
+        self._ready = threading.Event()  # 頼まれたフレームを _frame に置いた
+        self._frame = None
+        self._next_cap = None
+        self._running = True
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        while self._running:
+            with self._lock:
+                next_cap, self._next_cap = self._next_cap, None
+            if next_cap is not None:
+                self.cap.release()
+                self.cap = next_cap
+            ok = self.cap.grab()  # 次のフレームが来るまでブロックする (ロックは持たない)
+            if not ok:
+                time.sleep(0.05)  # デバイスが無い・切断中
+                continue
+            self.frame_count += 1
+            if self._wanted.is_set():
+                self._wanted.clear()
+                ok, frame = self.cap.retrieve()
+                with self._lock:
+                    self._frame = frame if ok else None
+                self._ready.set()
+
+    def retrieve(self):
+        """次に grab したフレームを BGR の ndarray で返す (timeout 秒以内に取れなければ None)."""
+        self._ready.clear()
+        self._wanted.set()
+        if not self._ready.wait(self.timeout):
+            return None
+        with self._lock:
+            return self._frame
+
+    def latest(self):
+        """最後にデコードしたフレームを待たずに返し、次のフレームのデコードを頼んでおく (プレビュー用)."""
+        with self._lock:
+            frame = self._frame
+        self._wanted.set()
+        return frame
+
+    def set_capture(self, cap):
+        """キャプチャデバイスを差し替える (古いデバイスは grab するスレッドが解放する)."""
+        with self._lock:
+            self._next_cap = cap
+
+    def stop(self):
+        self._running = False
+        self._thread.join(timeout=1.0)
+        self.cap.release()
+        if self._next_cap is not None:
+            self._next_cap.release()
+
+
+def area_downscale(frame, width, dst=None):
+    """面積平均で縮小し RGB の ndarray を返す (LANCZOS よりずっと軽い)."""
+    height = frame.shape[0] * width // frame.shape[1]
+    small = cv2.resize(frame, (width, height), interpolation=cv2.INTER_AREA)
+    return cv2.cvtColor(small, cv2.COLOR_BGR2RGB, dst=dst)
+
+
+class LivePreview:
+    """キャプチャ映像を低 CPU で表示するプレビュー.
+
+    fps の上限で after() から更新し、縮小は ndarray 上の面積平均、表示は
+    同じ PhotoImage への paste() で行うのでフレームごとに画像オブジェクトを作らない。
+    1 フレームの処理時間が cpu_budget (1 コアに対する割合) を超えそうなら間隔を広げる。
+    """
+
+    def __init__(self, label, grabber, width=320, fps=12, cpu_budget=0.05):
+        self.label = label
+        self.grabber = grabber
+        self.width = width
+        self.min_interval = 1.0 / fps
+        self.cpu_budget = cpu_budget
+        self.interval = self.min_interval
+        self.photo = None
+        self._small = None  # cv2.resize の出力先
+        self._rgba = None  # cv2.cvtColor の出力先 (PIL とメモリを共有する)
+        self._image = None
+        self._last_count = -1
+        self._after_id = None
+        self.running = False
+
+    def start(self):
+        if not self.running:
+            self.running = True
+            self._tick()
+
+    def stop(self):
+        self.running = False
+        if self._after_id is not None:
+            self.label.after_cancel(self._after_id)
+            self._after_id = None
+
+    def _tick(self):
+        if not self.running:
+            return
+        start = time.thread_time()  # Tk のスレッドが使った CPU 時間だけを測る
+        if self.grabber.frame_count != self._last_count:  # 新しいフレームが来たときだけ描く
+            self._last_count = self.grabber.frame_count
+            frame = self.grabber.latest()  # Tk のスレッドは次のフレームを待たない
+            if frame is not None:
+                self._show(frame)
+        cost = time.thread_time() - start
+        # CPU 予算に収まるよう、重ければ更新間隔を広げ、軽ければ fps の上限まで戻す
+        self.interval = max(self.min_interval, cost / self.cpu_budget)
+        self._after_id = self.label.after(int(self.interval * 1000), self._tick)
+
+    def _show(self, frame):
+        height = frame.shape[0] * self.width // frame.shape[1]
+        if self._rgba is None or self._rgba.shape[:2] != (height, self.width):
+            # 解像度が変わったときだけバッファと PhotoImage を作り直す
+            # (PIL がメモリを共有できるのは 4 バイト/画素の形式なので RGBA にする)
+            self._small = np.empty((height, self.width, 3), dtype=np.uint8)
+            self._rgba = np.empty((height, self.width, 4), dtype=np.uint8)
+            self._image = Image.frombuffer("RGBA", (self.width, height), self._rgba, "raw", "RGBA", 0, 1)
+            self.photo = ImageTk.PhotoImage(self._image)
+            self.label.config(image=self.photo)
+        cv2.resize(frame, (self.width, height), dst=self._small, interpolation=cv2.INTER_AREA)
+        cv2.cvtColor(self._small, cv2.COLOR_BGR2RGBA, dst=self._rgba)
+        self.photo.paste(self._image)  # 既存の PhotoImage をその場で書き換える
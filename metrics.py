@@ -0,0 +1,193 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+
+# ヒストグラムのバケットの上限 (秒)。Prometheus の le に使う
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# ログの書式
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class Histogram:
+    """固定バケットの所要時間ヒストグラム."""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # 最後は +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """q 分位点を含むバケットの上限 (サンプルが無ければ None)."""
+        if not self.count:
+            return None
+        target = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= target:
+                return self.buckets[i] if i < len(self.buckets) else float("inf")
+        return float("inf")
+
+
+class _Span:
+    __slots__ = ("metrics", "name", "start")
+
+    def __init__(self, metrics, name):
+        self.metrics = metrics
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class _TrackedSpan(_Span):
+    # プロファイラが動いている間だけ使う (スレッドごとの今の段階を知らせる)
+    __slots__ = ()
+
+    def __enter__(self):
+        tracker = self.metrics.tracker
+        if tracker is not None:
+            tracker.enter_stage(self.name)
+        return _Span.__enter__(self)
+
+    def __exit__(self, *exc):
+        _Span.__exit__(self, *exc)
+        tracker = self.metrics.tracker
+        if tracker is not None:
+            tracker.exit_stage(self.name)
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Metrics:
+    """段階ごとの所要時間 (span) とカウンター.
+
+    with span("crop"): ... で所要時間をヒストグラムに入れ、inc("ocr_calls") で数える。
+    enabled が False のときは span が共有の何もしないオブジェクトを返すので計測の費用はかからない。
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.tracker = None  # 段階の出入りを知りたいもの (サンプリングプロファイラ)
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def span(self, name):
+        if self.tracker is not None:
+            return _TrackedSpan(self, name)
+        return _Span(self, name) if self.enabled else _NULL_SPAN
+
+    def observe(self, name, seconds):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.observe(seconds)
+
+    def inc(self, name, value=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+    def snapshot(self):
+        """カウンターとヒストグラムの集計を JSON にできる辞書で返す."""
+        with self._lock:
+            return {
+                "time": time.time(),
+                "counters": dict(self.counters),
+                "stages": {
+                    name: {
+                        "count": h.count,
+                        "sum": h.sum,
+                        "p50": h.quantile(0.5),
+                        "p95": h.quantile(0.95),
+                        "buckets": dict(zip([str(b) for b in h.buckets] + ["+Inf"], h.counts)),
+                    }
+                    for name, h in self.histograms.items()
+                },
+            }
+
+    def write_file(self, path):
+        """集計をファイルに書き出す (途中で落ちても壊れないよう置き換えで書く)."""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f, ensure_ascii=False, indent=1)
+        os.replace(tmp_path, path)
+
+    def prometheus_text(self, prefix="mkscan"):
+        """Prometheus のテキスト形式で返す."""
+        lines = []
+        with self._lock:
+            for name, value in sorted(self.counters.items()):
+                metric = f"{prefix}_{name}_total"
+                lines.append(f"# TYPE {metric} counter")
+                lines.append(f"{metric} {value}")
+            metric = f"{prefix}_stage_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for name, h in sorted(self.histograms.items()):
+                cumulative = 0
+                for bound, n in zip(list(h.buckets) + ["+Inf"], h.counts):
+                    cumulative += n
+                    lines.append(f'{metric}_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{stage="{name}"}} {h.sum}')
+                lines.append(f'{metric}_count{{stage="{name}"}} {h.count}')
+        return "\n".join(lines) + "\n"
+
+
+# プロセス全体で共有する既定の集計先
+METRICS = Metrics()
+
+
+def span(name):
+    """既定の集計先で所要時間を測る (with で使う)."""
+    return METRICS.span(name)
+
+
+def inc(name, value=1):
+    """既定の集計先のカウンターを増やす."""
+    METRICS.inc(name, value)
+
+
+def configure_logging(level="WARNING", path=None):
+    """ログの出力先とレベルを設定する (既定は警告以上だけを標準エラーに出す)."""
+    handler = logging.FileHandler(path, encoding="utf-8") if path else logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level.upper() if isinstance(level, str) else level)
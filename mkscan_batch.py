@@ -0,0 +1,304 @@
+import argparse
+import glob
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from frame_archive import content_hash
+from ocr_backends import CachedBackend, local_backend
+from ocr_limits import BACKFILL, RequestBudget
+from results_db import ResultsDB
+from scoring_engine import (
+    OCR_BURST,
+    OCR_DAILY_LIMIT,
+    OCR_RATE,
+    OcrStack,
+    ScoringSession,
+    decode_image,
+    extract_player_rows,
+)
+from scoring_formats import DEFAULT_PROFILE, PROFILES, SUPPORTED_PROFILES
+from standings_image import StandingsRenderer
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp")
+# アプリと同じ OCR の予算ファイル (1 日の上限をアプリと一括処理で分け合う)
+BUDGET_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "mkscan_data", "ocr_budget.json")
+
+# ワーカープロセスごとの状態 (_init_worker で作る)
+_worker = {}
+
+
+def expand_inputs(patterns):
+    """ディレクトリ (再帰) と glob パターンを画像パスの一覧にする (重複を除いて名前順)."""
+    paths = set()
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for directory, _, names in os.walk(pattern):
+                paths.update(os.path.join(directory, name) for name in names if name.lower().endswith(IMAGE_EXTENSIONS))
+        else:
+            paths.update(p for p in glob.glob(pattern, recursive=True) if p.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(paths)
+
+
+def load_records(output_path):
+    """前回までの出力からレースの行を読む (書き込み途中の行は捨てる)."""
+    if not output_path or not os.path.exists(output_path):
+        return []
+    records = []
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("type") == "race":
+                records.append(record)
+    return records
+
+
+def _init_worker(profile_key, backend_name, workers, done_hashes, budget_share):
+    """ワーカープロセスごとに OCR 一式と行画像のキャッシュを用意する.
+
+    budget_share はこのワーカーが使ってよいリクエスト数 (今日の残りをワーカーの数で割った分、None は上限なし)。
+    """
+    backend = local_backend() if backend_name == "local" else None
+    # レート制限はプロセスの数で割って、全体で 1 プロセスのときと同じにする
+    # 過去画像の一括処理なので、優先度は今のレースより低くする
+    ocr = OcrStack(backend=backend, rate=OCR_RATE / workers, burst=max(1, OCR_BURST // workers), daily_limit=None,
+                   session_limit=budget_share, priority=BACKFILL)
+    _worker["profile"] = PROFILES[profile_key]
+    _worker["ocr"] = ocr
+    _worker["cache"] = CachedBackend(ocr.backend)
+    _worker["done"] = done_hashes
+
+
+def _process(path):
+    """1 枚の画像を OCR して名前を返す (ワーカープロセスで実行する)."""
+    start = time.perf_counter()
+    with open(path, "rb") as f:
+        image = decode_image(f.read())
+    digest = content_hash(image)
+    if digest in _worker["done"]:
+        return {"type": "skip", "path": path, "hash": digest}
+
+    # 1 枚の途中で予算が尽きると空欄だらけのレースになるので、読み始める前に止める
+    ocr = _worker["ocr"]
+    remaining = ocr.gate.budget.remaining()
+    if remaining is not None and remaining <= ocr.gate.backfill_reserve + 2 * _worker["profile"].player_count:
+        return {"type": "error", "path": path, "error": "OCR の予算を使い切りました"}
+
+    cache = _worker["cache"]
+    calls = _worker["ocr"].meter.summary()["requests"]
+    hits = cache.hits
+    rows = extract_player_rows(image, _worker["profile"], cache)
+    return {
+        "type": "race",
+        "path": path,
+        "hash": digest,
+        "player_names": [result.text if result else None for result in rows],
+        "confidences": [round(result.confidence, 3) if result else None for result in rows],
+        "ocr_calls": _worker["ocr"].meter.summary()["requests"] - calls,
+        "cache_hits": cache.hits - hits,
+        "ms": round((time.perf_counter() - start) * 1000, 1),
+    }
+
+
+class BatchStats:
+    """スループットの集計."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.processed = 0
+        self.skipped = 0
+        self.duplicates = 0
+        self.errors = 0
+        self.ocr_calls = 0
+        self.cache_hits = 0
+
+    def add(self, record):
+        if record["type"] == "race":
+            self.processed += 1
+            self.ocr_calls += record["ocr_calls"]
+            self.cache_hits += record["cache_hits"]
+        elif record["type"] == "skip":
+            self.skipped += 1
+        elif record["type"] == "duplicate":
+            # 同じ実行の中の重複は OCR した後に見つかるので、呼び出しは使った分として数える
+            self.duplicates += 1
+            self.ocr_calls += record["ocr_calls"]
+            self.cache_hits += record["cache_hits"]
+        else:
+            self.errors += 1
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        total = self.processed + self.skipped + self.duplicates + self.errors
+        # 前回までに処理済みで読み飛ばした画像は、実際に読んだ画像の平均呼び出し数だけ節約したとみなす
+        read = self.processed + self.duplicates
+        per_image = (self.ocr_calls + self.cache_hits) / read if read else 0
+        saved = self.cache_hits + round(per_image * self.skipped)
+        return (
+            f"{total} 枚 / {elapsed:.1f} 秒 ({total / elapsed if elapsed else 0:.2f} 枚/秒, "
+            f"OCR {self.processed / elapsed if elapsed else 0:.2f} 枚/秒) | "
+            f"処理 {self.processed}, 処理済み {self.skipped}, 重複 {self.duplicates}, 失敗 {self.errors} | "
+            f"OCR 呼び出し {self.ocr_calls} 回, キャッシュで節約 {saved} 回"
+        )
+
+
+def run(paths, profile, out, workers, backend_name="vision", window=None, previous=(), db=None, session_name=None,
+        png_dir=None, budget=None):
+    """画像をプロセスプールで処理し、レースごとの結果を JSON Lines で書き出す.
+
+    結果は入力の順に (= レース順に) 書き出す。処理待ち・書き出し待ちの画像は
+    window 枚までに抑えるので、枚数が多くてもメモリは増えない。
+    previous (前回までの race レコード) にある画像は読み直さず、そのレコードを入力の順の位置で
+    確定し直して書き出す (前回失敗した画像が今回読めても、レース番号と交流戦が入力の順になる)。
+    同じ画像が入力に 2 枚あれば入力の順で先の方をレースにし、後の方は duplicate として書き出す
+    (実行中の重複は OCR した後に分かるので、duplicate の呼び出しも使った分として数える)。
+    db (ResultsDB) を渡すと確定したレースをデータベースにも記録する。
+    交流戦が終わるたびに、その交流戦の順位表を standings レコードとして書き出す
+    (png_dir を渡すと war-NN.png の画像にもする)。
+    budget (RequestBudget) を渡すと、その残りをワーカーで分け合い、使った分を最後に budget に足して保存する。
+    """
+    window = window or workers * 2
+    session = ScoringSession(profile)
+    by_path = {record["path"]: record for record in previous}
+    by_hash = {record["hash"]: record for record in previous}
+    seen = set()
+    stats = BatchStats()
+
+    def write(record):
+        out.write(json.dumps(record, ensure_ascii=False) + "\n")
+        out.flush()
+
+    renderer = StandingsRenderer()
+
+    def write_standings(war, standings, adjustments):
+        write({
+            "type": "standings",
+            "war": war + 1,
+            "standings": [
+                {"rank": rank, "team": team_name, "score": score, "gap": gap}
+                for rank, team_name, score, gap in standings
+            ],
+            "adjustments": adjustments,
+        })
+        if png_dir:
+            os.makedirs(png_dir, exist_ok=True)
+            image = renderer.render(standings, adjustments, f"第{war + 1}交流戦")
+            image.save(os.path.join(png_dir, f"war-{war + 1:02d}.png"))
+
+    def on_session_event(session, event):
+        if event == "war":
+            write_standings(*session.last_war)
+
+    session.listeners.append(on_session_event)
+
+    remaining = budget.remaining() if budget is not None else None
+    budget_share = None if remaining is None else max(0, remaining) // workers
+    initargs = (profile.key, backend_name, workers, set(by_hash), budget_share)
+    with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=initargs) as pool:
+        pending = {}  # 入力の位置 -> Future
+        submitted = 0
+        for index in range(len(paths)):
+            while submitted < len(paths) and len(pending) < window:
+                if paths[submitted] not in by_path:
+                    pending[submitted] = pool.submit(_process, paths[submitted])
+                submitted += 1
+            reused = paths[index] in by_path
+            if reused:
+                record = dict(by_path[paths[index]])
+            else:
+                try:
+                    record = pending.pop(index).result()
+                except Exception as e:
+                    record = {"type": "error", "path": paths[index], "error": str(e)}
+                if record["type"] == "skip":
+                    # 名前を変えた処理済みの画像 (画素のハッシュで見つけた)
+                    record = dict(by_hash[record["hash"]], path=paths[index])
+                    reused = True
+            if record["type"] == "race":
+                if record["hash"] in seen:
+                    record = {"type": "duplicate", "path": record["path"], "hash": record["hash"],
+                              "ocr_calls": 0 if reused else record["ocr_calls"],
+                              "cache_hits": 0 if reused else record["cache_hits"]}
+                    reused = False
+                else:
+                    seen.add(record["hash"])
+                    record["race_scores"] = session.commit_race(record["player_names"])
+                    record["race"] = session.current_race
+                    record["war"] = session.war + 1
+                    if db is not None:
+                        db.record_race(session_name, session.current_race, profile, record["player_names"],
+                                       session.last_teams, record["race_scores"], image_hash=record["hash"],
+                                       war=session.war)
+            stats.add({"type": "skip"} if reused else record)
+            write(record)
+            if (index + 1) % 100 == 0:
+                print(stats.summary(), file=sys.stderr)
+
+    write_standings(session.war, session.standings(), session.adjustments())
+    if budget is not None:
+        # 実行中にアプリが使った分を消さないよう、予算ファイルを読み直してから足す
+        latest = RequestBudget(budget.daily_limit, budget.session_limit, budget.state_path)
+        latest.spend(stats.ocr_calls)
+        latest.save()
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description="リザルト画像をまとめて集計し、JSON Lines で書き出す")
+    parser.add_argument("inputs", nargs="+", help="ディレクトリまたは glob パターン")
+    parser.add_argument("-o", "--output", default="-", help="出力先 (- は標準出力)")
+    parser.add_argument("--format", choices=sorted(SUPPORTED_PROFILES), default=DEFAULT_PROFILE.key)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--window", type=int, default=None, help="同時に抱える画像の上限 (既定: workers の 2 倍)")
+    parser.add_argument("--backend", choices=("vision", "local"), default="vision")
+    parser.add_argument("--resume", action="store_true", help="出力ファイルにある画像を読み飛ばして続きから処理する")
+    parser.add_argument("--db", default=None, help="レース結果を記録する SQLite データベース")
+    parser.add_argument("--session", default=None, help="データベースに記録するセッション名 (既定: 出力ファイル名)")
+    parser.add_argument("--png-dir", default=None, help="交流戦ごとの順位表の画像を書き出すディレクトリ")
+    parser.add_argument("--budget", default=BUDGET_PATH, help="アプリと共有する OCR の予算ファイル")
+    parser.add_argument("--daily-limit", type=int, default=OCR_DAILY_LIMIT, help="1 日の OCR リクエストの上限")
+    args = parser.parse_args()
+
+    if args.resume and args.output == "-":
+        parser.error("--resume には --output でファイルを指定してください")
+    if args.backend == "local" and local_backend() is None:
+        parser.error("ローカル OCR (pytesseract) が使えません")
+
+    paths = expand_inputs(args.inputs)
+    if not paths:
+        parser.error("画像が見つかりませんでした")
+
+    # 続きから処理するときは、前回の分もレース番号を振り直して一時ファイルに書き直し、
+    # 最後まで終わったら置き換える (途中で止まったら次の --resume は一時ファイルの分も読む)
+    resume_path = args.output + ".tmp"
+    previous = load_records(args.output) + load_records(resume_path) if args.resume else []
+    if previous:
+        print(f"処理済みの {len({record['path'] for record in previous})} 枚を読み飛ばします", file=sys.stderr)
+    if args.output == "-":
+        out = sys.stdout
+    else:
+        out = open(resume_path if args.resume else args.output, "w", encoding="utf-8")
+    db = ResultsDB(args.db) if args.db else None
+    # ローカル OCR は料金がかからないので予算を使わない
+    budget = RequestBudget(args.daily_limit, None, args.budget) if args.backend == "vision" else None
+    try:
+        session_name = args.session or (os.path.basename(args.output) if args.output != "-" else time.strftime("batch-%Y%m%d-%H%M%S"))
+        stats = run(paths, PROFILES[args.format], out, args.workers, args.backend, args.window, previous, db, session_name,
+                    args.png_dir, budget)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        if db is not None:
+            db.close()
+    if args.resume:
+        os.replace(resume_path, args.output)
+    print(stats.summary(), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
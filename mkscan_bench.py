@@ -0,0 +1,152 @@
+import argparse
+import json
+import time
+
+import numpy as np
+
+from ocr_backends import encode_png
+from scoring_engine import OcrStack, ScoringSession, decode_image
+from scoring_formats import DEFAULT_PROFILE, PROFILES
+from standings_image import StandingsRenderer
+from standings_server import session_snapshot
+from synthetic_frames import RESOLUTIONS, StubOcrBackend, SyntheticScenario
+
+# 計測する段階 (crop と encode は ocr の内訳を単独で測ったもの、image は順位表の PNG)
+STAGES = ("decode", "crop", "encode", "ocr", "scoring", "render", "image")
+# 1 レースの合計に入れる段階
+PIPELINE_STAGES = ("decode", "ocr", "scoring", "render")
+
+
+def grouping_matches(profile, predicted, truth):
+    """チーム名の付け方によらず、チームごとの得点が正解と一致するか."""
+    if not profile.is_team_mode:
+        return predicted == truth
+    return sorted(predicted.values()) == sorted(truth.values())
+
+
+def run_benchmark(profile=DEFAULT_PROFILE, races=48, resolution="1080p", ocr_latency=0.05, ocr_jitter=0.02,
+                  missing_rate=0.1, noise=2.0, jpeg_quality=None, tag_style="prefix", seed=0, warmup=2):
+    """合成リザルト画面でパイプラインを通し、段階ごとの所要時間と正解率を測る.
+
+    OCR はアプリと同じ OcrStack (ゲート・ヘッジ・サーキットブレーカー) を通してスタブに投げる。
+    画像の生成と OCR スタブへの正解の登録は計測に含めない。
+    戻り値は段階ごとの p50 / p95 / 平均 (ms)、スループット、正解率の辞書。
+    """
+    scenario = SyntheticScenario(profile, seed, tag_style)
+    backend = StubOcrBackend(ocr_latency, ocr_jitter, seed)
+    # 1 日の予算はベンチマークでは使い切らないよう外す (レート制限はアプリと同じ)
+    ocr = OcrStack(backend=backend, daily_limit=None)
+    session = ScoringSession(profile, ocr)
+    renderer = StandingsRenderer()
+    timings = {stage: [] for stage in STAGES}
+    totals = []
+    correct_names = correct_scores = rows_total = 0
+
+    for race in range(warmup + races):
+        missing = int(scenario.rng.random() < missing_rate) * scenario.rng.randint(1, max(1, profile.team_size))
+        data, truth = scenario.frame(missing, resolution, noise, jpeg_quality)
+        spent = {}
+
+        start = time.perf_counter()
+        image = decode_image(data)
+        spent["decode"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        crops = [image.crop(box) for box in profile.row_boxes]
+        spent["crop"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for crop in crops:
+            encode_png(crop)
+        spent["encode"] = time.perf_counter() - start
+        del crops
+
+        backend.register(image, profile, truth["player_names"])
+        # 実際のレースは数分おきでトークンは溜まりきっているので、連続で回す分のレート待ちは入れない
+        ocr.gate.bucket.tokens = ocr.gate.bucket.burst
+        start = time.perf_counter()
+        rows = session.read_rows(image)
+        spent["ocr"] = time.perf_counter() - start
+        player_names = [result.text if result else None for result in rows]
+
+        start = time.perf_counter()
+        race_scores = session.commit_race(player_names, image)
+        spent["scoring"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        snapshot = session_snapshot(session, race)
+        json.dumps(snapshot, ensure_ascii=False)
+        spent["render"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        renderer.snapshot_png(snapshot)
+        spent["image"] = time.perf_counter() - start
+
+        if race < warmup:
+            continue
+        for stage, seconds in spent.items():
+            timings[stage].append(seconds)
+        totals.append(sum(spent[stage] for stage in PIPELINE_STAGES))
+        rows_total += profile.player_count
+        correct_names += sum(a == b for a, b in zip(player_names, truth["player_names"]))
+        correct_scores += grouping_matches(profile, race_scores, truth["race_scores"])
+
+    def summarize(values):
+        ms = np.asarray(values) * 1000
+        return {"p50": float(np.percentile(ms, 50)), "p95": float(np.percentile(ms, 95)), "mean": float(ms.mean())}
+
+    return {
+        "format": profile.key,
+        "resolution": resolution,
+        "races": races,
+        "ocr_latency": ocr_latency,
+        "stages": {stage: summarize(values) for stage, values in timings.items()},
+        "total": summarize(totals),
+        "races_per_second": races / sum(totals),
+        "ocr_calls_per_race": backend.calls / (warmup + races),
+        "name_accuracy": correct_names / rows_total,
+        "score_accuracy": correct_scores / races,
+    }
+
+
+def format_report(result):
+    lines = [
+        f"{result['format']} / {result['resolution']} / {result['races']} レース (OCR 遅延 {result['ocr_latency'] * 1000:.0f} ms)",
+        f"{'段階':<10}{'p50':>10}{'p95':>10}{'平均':>10}  (ms)",
+    ]
+    for stage, stats in list(result["stages"].items()) + [("合計", result["total"])]:
+        lines.append(f"{stage:<10}{stats['p50']:>10.2f}{stats['p95']:>10.2f}{stats['mean']:>10.2f}")
+    lines.append(
+        f"スループット {result['races_per_second']:.2f} レース/秒, OCR {result['ocr_calls_per_race']:.1f} 回/レース, "
+        f"名前の正解率 {result['name_accuracy']:.3f}, 得点の正解率 {result['score_accuracy']:.3f}"
+    )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="合成リザルト画面によるパイプラインのベンチマーク")
+    parser.add_argument("--format", choices=sorted(PROFILES), default=DEFAULT_PROFILE.key)
+    parser.add_argument("--races", type=int, default=48)
+    parser.add_argument("--resolution", choices=sorted(RESOLUTIONS), default="1080p")
+    parser.add_argument("--ocr-latency", type=float, default=0.05, help="スタブ OCR の応答時間 (秒)")
+    parser.add_argument("--ocr-jitter", type=float, default=0.02)
+    parser.add_argument("--missing-rate", type=float, default=0.1, help="空欄の行があるレースの割合")
+    parser.add_argument("--noise", type=float, default=2.0)
+    parser.add_argument("--jpeg-quality", type=int, default=None)
+    parser.add_argument("--tag-style", choices=("prefix", "suffix", "mixed"), default="prefix")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="結果を JSON で書き出すパス")
+    args = parser.parse_args()
+
+    result = run_benchmark(
+        PROFILES[args.format], args.races, args.resolution, args.ocr_latency, args.ocr_jitter,
+        args.missing_rate, args.noise, args.jpeg_quality, args.tag_style, args.seed,
+    )
+    print(format_report(result))
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
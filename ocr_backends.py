@@ -0,0 +1,200 @@
+import difflib
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+
+from PIL import Image, ImageFilter, ImageOps
+from google.cloud import vision
+
+from metrics import inc, span
+
+try:
+    import pytesseract
+except ImportError:  # ローカル OCR は任意
+    pytesseract = None
+
+# この信頼度を下回った行だけ拡大画像で再 OCR する
+RETRY_CONFIDENCE = 0.8
+# 名簿の名前とみなす類似度
+ROSTER_CUTOFF = 0.75
+
+
+class OcrResult:
+    """1 行分の OCR 結果 (テキスト・信頼度・外接矩形)."""
+
+    def __init__(self, text, confidence=1.0, box=None, backend=""):
+        self.text = text
+        self.confidence = confidence
+        self.box = box  # ((x, y), ...) 行画像内の座標
+        self.backend = backend
+
+    def __repr__(self):
+        return f"OcrResult({self.text!r}, confidence={self.confidence:.2f}, backend={self.backend!r})"
+
+
+class VisionBackend:
+    """Google Vision API による OCR."""
+
+    name = "vision"
+
+    def __init__(self):
+        self._client = None
+
+    @property
+    def client(self):
+        # クライアントは使い回す (毎回の接続確立を避ける)
+        if self._client is None:
+            self._client = vision.ImageAnnotatorClient()
+        return self._client
+
+    def detect(self, image_bytes):
+        """画像の先頭行のテキストを OcrResult で返す (何も読めなければ None)."""
+        image = vision.Image(content=image_bytes)
+        # document_text_detection は単語ごとの信頼度を返す
+        response = self.client.document_text_detection(image=image)
+        return result_from_response(response, self.name)
+
+
+def result_from_response(response, backend_name):
+    """Vision API の AnnotateImageResponse を OcrResult にする."""
+    if response.error.message:
+        raise RuntimeError(response.error.message)
+    texts = response.text_annotations
+    if not texts:
+        return None
+    text = texts[0].description.split("\n")[0]
+    box = tuple((v.x, v.y) for v in texts[0].bounding_poly.vertices)
+    return OcrResult(text, _first_line_confidence(response.full_text_annotation), box, backend_name)
+
+
+def _first_line_confidence(annotation):
+    # 先頭の段落に含まれる単語の信頼度の平均
+    for page in annotation.pages:
+        for block in page.blocks:
+            for paragraph in block.paragraphs:
+                confidences = [word.confidence for word in paragraph.words]
+                if confidences:
+                    return sum(confidences) / len(confidences)
+    return 0.0
+
+
+class TesseractBackend:
+    """Tesseract によるローカル OCR (pytesseract がある場合のみ)."""
+
+    name = "tesseract"
+
+    def __init__(self, lang="jpn+eng"):
+        if pytesseract is None:
+            raise RuntimeError("pytesseract がインストールされていません")
+        self.lang = lang
+
+    def detect(self, image_bytes):
+        image = Image.open(io.BytesIO(image_bytes))
+        data = pytesseract.image_to_data(
+            image, lang=self.lang, config="--psm 7", output_type=pytesseract.Output.DICT
+        )
+        words = [
+            (word, float(conf))
+            for word, conf in zip(data["text"], data["conf"])
+            if word.strip() and float(conf) >= 0
+        ]
+        if not words:
+            return None
+        text = " ".join(word for word, _ in words)
+        confidence = sum(conf for _, conf in words) / len(words) / 100.0
+        return OcrResult(text, confidence, None, self.name)
+
+
+def local_backend():
+    """使えるローカル OCR バックエンドを返す (無ければ None)."""
+    return TesseractBackend() if pytesseract is not None else None
+
+
+class CachedBackend:
+    """同じ行画像 (PNG のバイト列が同じ) の OCR 結果を使い回すラッパー.
+
+    件数上限付きの LRU。hits は OCR を呼ばずに済んだ回数。
+    """
+
+    def __init__(self, backend, max_entries=4096):
+        self.backend = backend
+        self.name = backend.name
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()  # ダイジェスト -> OcrResult
+        self._lock = threading.Lock()
+
+    def detect(self, image_bytes):
+        key = hashlib.sha1(image_bytes).digest()
+        with self._lock:
+            result = self._cache.get(key)
+            if result is not None:
+                self._cache.move_to_end(key)
+                self.hits += 1
+        if result is not None:
+            inc("ocr_cache_hits")
+        if result is None:
+            result = self.backend.detect(image_bytes)
+            if result is None:
+                return None
+            with self._lock:
+                self.misses += 1
+                self._cache[key] = result
+                while len(self._cache) > self.max_entries:
+                    self._cache.popitem(last=False)
+        # 呼び出し側が text を名簿に寄せて書き換えるので複製を返す
+        return OcrResult(result.text, result.confidence, result.box, result.backend)
+
+
+def encode_png(image):
+    """PIL 画像を PNG のバイト列にする."""
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def crop_row(image, box, enhance=False):
+    """1 行分をクロップし、OCR に送る PNG のバイト列にする."""
+    with span("crop"):
+        row_image = image.crop(box)
+        if enhance:
+            row_image = enhance_crop(row_image)
+    with span("encode"):
+        return encode_png(row_image)
+
+
+def match_roster(text, roster):
+    """名簿の中から OCR 結果に一致する名前を探す (見つからなければ None)."""
+    if text in roster:
+        return text
+    matches = difflib.get_close_matches(text, roster, n=1, cutoff=ROSTER_CUTOFF)
+    return matches[0] if matches else None
+
+
+def needs_retry(result, roster):
+    """再 OCR が必要な行か (信頼度が低い、または名簿のどの名前にも寄せられない名前).
+
+    名簿の名前と 1, 2 文字違うだけの読み取りは後で match_roster で寄せるので読み直さない。
+    """
+    if result is None:
+        return True
+    if result.confidence < RETRY_CONFIDENCE:
+        return True
+    return bool(roster) and match_roster(result.text, roster) is None
+
+
+def pick_better(current, retried):
+    """1 回目と再 OCR の結果のうち信頼度の高い方を返す."""
+    if retried is not None and (current is None or retried.confidence > current.confidence):
+        return retried
+    return current
+
+
+def enhance_crop(image, scale=2):
+    """再 OCR 用に行画像を拡大・コントラスト補正・シャープ化する."""
+    width, height = image.size
+    image = image.resize((width * scale, height * scale), Image.Resampling.LANCZOS)
+    image = ImageOps.autocontrast(ImageOps.grayscale(image), cutoff=1)
+    return image.filter(ImageFilter.SHARPEN)
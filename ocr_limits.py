@@ -0,0 +1,253 @@
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+
+from metrics import inc, span
+from ocr_backends import OcrResult
+
+# 優先度 (小さいほど先に通す)
+LIVE = 0  # 今のレース
+BACKFILL = 1  # 過去画像の一括処理など
+
+# 順番待ちの間に取り消されていないか確かめる間隔 (秒)
+CANCEL_POLL = 0.05
+
+# Vision API の 1 リクエストあたりの概算料金 (USD)
+COST_PER_REQUEST = 1.5 / 1000
+
+
+class BudgetExceeded(Exception):
+    """OCR リクエストの予算を使い切った."""
+
+
+class RequestCancelled(Exception):
+    """ゲートを通る前にリクエストが取り消された (予算は使っていない)."""
+
+
+class QuotaExceeded(Exception):
+    """OCR エンドポイントがクォータ超過を返した."""
+
+
+class TokenBucket:
+    """トークンバケットによるレート制限 (rate 回/秒、最大 burst 回まで溜まる)."""
+
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, now=None):
+        """トークンを 1 つ取る。足りなければ次に取れるまでの秒数を返す (取れたら 0)."""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RequestBudget:
+    """1 日あたり・セッションあたりのリクエスト上限.
+
+    state_path を指定すると日ごとの消費数をファイルに残し、再起動しても引き継ぐ。
+    """
+
+    def __init__(self, daily_limit=None, session_limit=None, state_path=None):
+        self.daily_limit = daily_limit
+        self.session_limit = session_limit
+        self.state_path = state_path
+        self.session_used = 0
+        self.day = time.strftime("%Y-%m-%d")
+        self.daily_used = 0
+        if state_path and os.path.exists(state_path):
+            try:
+                with open(state_path, "r", encoding="utf-8") as f:
+                    self.daily_used = json.load(f).get(self.day, 0)
+            except (OSError, ValueError):
+                pass
+
+    def remaining(self):
+        """残りのリクエスト数 (上限なしなら None)."""
+        today = time.strftime("%Y-%m-%d")
+        if today != self.day:
+            self.day = today
+            self.daily_used = 0
+        limits = []
+        if self.daily_limit is not None:
+            limits.append(self.daily_limit - self.daily_used)
+        if self.session_limit is not None:
+            limits.append(self.session_limit - self.session_used)
+        return min(limits) if limits else None
+
+    def spend(self, count=1):
+        before = self.session_used
+        self.session_used += count
+        self.daily_used += count
+        if before // 20 != self.session_used // 20:
+            self.save()
+
+    def save(self):
+        if not self.state_path:
+            return
+        directory = os.path.dirname(self.state_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({self.day: self.daily_used}, f)
+        os.replace(tmp_path, self.state_path)
+
+
+class OcrGate:
+    """全 OCR リクエストの前に置くゲート.
+
+    トークンバケットで速度を、RequestBudget で総数を抑える。待っているリクエストは
+    優先度順に通すので、バックフィルが詰まっていても今のレースが先に処理される。
+    バックフィルは予算の残りが backfill_reserve 以下になると止める。
+    """
+
+    def __init__(self, bucket, budget, backfill_reserve=0):
+        self.bucket = bucket
+        self.budget = budget
+        self.backfill_reserve = backfill_reserve
+        self._cond = threading.Condition()
+        self._waiting = []  # (優先度, 到着順)
+        self._counter = itertools.count()
+
+    def acquire(self, priority=LIVE, timeout=None, cancelled=None):
+        """通ってよければ戻る。予算切れなら BudgetExceeded、タイムアウトなら TimeoutError.
+
+        cancelled (threading.Event) がセットされたら、予算を使わずに RequestCancelled を投げる。
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        ticket = (priority, next(self._counter))
+        with self._cond:
+            heapq.heappush(self._waiting, ticket)
+            try:
+                while True:
+                    if cancelled is not None and cancelled.is_set():
+                        raise RequestCancelled("OCR のリクエストが取り消されました")
+                    remaining = self.budget.remaining()
+                    reserve = self.backfill_reserve if priority > LIVE else 0
+                    if remaining is not None and remaining <= reserve:
+                        raise BudgetExceeded(f"OCR の予算を使い切りました (残り {remaining})")
+                    wait = None
+                    if self._waiting[0] == ticket:
+                        wait = self.bucket.try_take()
+                        if wait == 0:
+                            self.budget.spend()
+                            return
+                    if deadline is not None:
+                        left = deadline - time.monotonic()
+                        if left <= 0:
+                            raise TimeoutError("OCR の順番待ちがタイムアウトしました")
+                        wait = left if wait is None else min(wait, left)
+                    if cancelled is not None:
+                        wait = CANCEL_POLL if wait is None else min(wait, CANCEL_POLL)  # 取り消しは通知されない
+                    self._cond.wait(wait)
+            finally:
+                self._waiting.remove(ticket)
+                heapq.heapify(self._waiting)
+                self._cond.notify_all()
+
+
+class CostMeter:
+    """交流戦ごとの OCR リクエスト数・送信バイト数・概算料金."""
+
+    def __init__(self, cost_per_request=COST_PER_REQUEST):
+        self.cost_per_request = cost_per_request
+        self.war = 0
+        self.wars = {}
+        self._lock = threading.Lock()
+
+    def set_war(self, war):
+        self.war = war
+
+    def record(self, sent_bytes, failed=False):
+        with self._lock:
+            counters = self.wars.setdefault(self.war, {"requests": 0, "bytes": 0, "failures": 0})
+            counters["requests"] += 1
+            counters["bytes"] += sent_bytes
+            counters["failures"] += int(failed)
+        inc("ocr_calls")
+        inc("ocr_bytes", sent_bytes)
+        if failed:
+            inc("ocr_failures")
+
+    def summary(self, war=None):
+        """交流戦の集計 (requests, bytes, failures, cost) を返す."""
+        with self._lock:
+            counters = dict(self.wars.get(self.war if war is None else war, {"requests": 0, "bytes": 0, "failures": 0}))
+        counters["cost"] = counters["requests"] * self.cost_per_request
+        return counters
+
+
+class LimitedBackend:
+    """OCR バックエンドの前に OcrGate と CostMeter を挟むラッパー."""
+
+    def __init__(self, backend, gate, meter, priority=LIVE):
+        self.backend = backend
+        self.gate = gate
+        self.meter = meter
+        self.priority = priority
+        self.name = backend.name
+
+    def with_priority(self, priority):
+        """同じゲート・メーターを共有し、優先度だけ違うラッパーを返す."""
+        return LimitedBackend(self.backend, self.gate, self.meter, priority)
+
+    def acquire(self, cancelled=None):
+        """ゲートを通る (予算切れなら BudgetExceeded、取り消されたら RequestCancelled)."""
+        self.gate.acquire(self.priority, cancelled=cancelled)
+
+    def request(self, image_bytes, cancelled=None):
+        """ゲートを通った後に 1 回だけリクエストを送る (予算を使った後なので取り消しは見ない)."""
+        try:
+            with span("ocr_request"):
+                result = self.backend.detect(image_bytes)
+        except Exception:
+            self.meter.record(len(image_bytes), failed=True)
+            raise
+        self.meter.record(len(image_bytes))
+        return result
+
+    def detect(self, image_bytes, cancelled=None):
+        self.acquire(cancelled)
+        return self.request(image_bytes)
+
+
+class FakeQuotaEndpoint:
+    """クォータを強制するローカルの OCR スタンドイン (動作確認用).
+
+    per_minute 回/分、total 回を超えると QuotaExceeded を投げる。
+    """
+
+    name = "fake"
+
+    def __init__(self, per_minute=1800, total=None, text="player", latency=0.0):
+        self.per_minute = per_minute
+        self.total = total
+        self.text = text
+        self.latency = latency
+        self.calls = []
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def detect(self, image_bytes):
+        now = time.monotonic()
+        with self._lock:
+            recent = [t for t in self.calls if now - t < 60]
+            if len(recent) >= self.per_minute or (self.total is not None and len(self.calls) >= self.total):
+                self.rejected += 1
+                raise QuotaExceeded("429 Quota exceeded")
+            self.calls.append(now)
+        if self.latency:
+            time.sleep(self.latency)
+        return OcrResult(self.text, 1.0, None, self.name)
@@ -0,0 +1,266 @@
+import bisect
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from metrics import inc
+from ocr_backends import OcrResult
+from ocr_limits import BudgetExceeded, RequestCancelled
+
+log = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    """サーキットブレーカーが開いていて、代わりのバックエンドも無い."""
+
+
+class LatencyHistogram:
+    """対数間隔のバケットで数えるレイテンシのヒストグラム.
+
+    decay_every 件ごとに全バケットを半分にし、最近の傾向を強く反映させる。
+    """
+
+    def __init__(self, smallest=0.001, largest=60.0, factor=1.2, decay_every=500):
+        self.bounds = []
+        bound = smallest
+        while bound < largest:
+            self.bounds.append(bound)
+            bound *= factor
+        self.bounds.append(largest)
+        self.counts = [0.0] * (len(self.bounds) + 1)
+        self.total = 0.0
+        self.observed = 0
+        self.decay_every = decay_every
+        self._lock = threading.Lock()
+
+    def observe(self, seconds):
+        with self._lock:
+            self.counts[bisect.bisect_left(self.bounds, seconds)] += 1
+            self.total += 1
+            self.observed += 1
+            if self.decay_every and self.observed % self.decay_every == 0:
+                self.counts = [c / 2 for c in self.counts]
+                self.total /= 2
+
+    def quantile(self, q):
+        """q 分位点 (バケット上端) を返す。まだ観測が無ければ None."""
+        with self._lock:
+            if not self.total:
+                return None
+            target = q * self.total
+            running = 0.0
+            for i, count in enumerate(self.counts):
+                running += count
+                if running >= target:
+                    return self.bounds[min(i, len(self.bounds) - 1)]
+            return self.bounds[-1]
+
+
+class HedgedBackend:
+    """遅いリクエストに保険の重複リクエストを送るラッパー.
+
+    最初のリクエストが観測した p95 を過ぎても返ってこなければ同じ内容をもう一度送り、
+    先に成功した方を使う。backend が acquire() / request() に分かれていれば (LimitedBackend)、
+    レート制限の順番待ちは測らず、リクエストを送ってからの時間だけで p95 と保険の時機を決める。
+    自身も acquire() / request() に分かれているので、CircuitBreaker も順番待ちを測らない。
+    max_workers は同時に読む行数の 2 倍 (保険の分) 以上にする。
+    """
+
+    def __init__(self, backend, histogram=None, quantile=0.95, min_samples=20,
+                 default_delay=1.0, min_delay=0.05, max_workers=48):
+        self.backend = backend
+        self.name = backend.name
+        self.histogram = histogram or LatencyHistogram()
+        self.quantile = quantile
+        self.min_samples = min_samples
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.hedges = 0
+        self._acquire = getattr(backend, "acquire", None)
+        self._send = getattr(backend, "request", backend.detect)
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def hedge_delay(self):
+        """保険のリクエストを送るまでの待ち時間."""
+        if self.histogram.total < self.min_samples:
+            return self.default_delay
+        return max(self.min_delay, self.histogram.quantile(self.quantile))
+
+    def _timed(self, image_bytes, acquire, cancelled=None):
+        if acquire and self._acquire is not None:
+            self._acquire(cancelled)  # 保険の分の順番待ち (測らない)
+        start = time.perf_counter()
+        result = self._send(image_bytes)
+        self.histogram.observe(time.perf_counter() - start)
+        return result
+
+    def acquire(self, cancelled=None):
+        """最初のリクエストの分だけゲートを通る (backend にゲートが無ければ何もしない)."""
+        if self._acquire is not None:
+            self._acquire(cancelled)
+
+    def request(self, image_bytes, cancelled=None):
+        """acquire() の後に送り、p95 を過ぎたら保険のリクエストを送る (取り消されていれば送らない)."""
+        first = self._executor.submit(self._timed, image_bytes, False)
+        pending = {first}
+        done, pending = wait(pending, timeout=self.hedge_delay())
+        if not done and not (cancelled is not None and cancelled.is_set()):
+            self.hedges += 1
+            inc("ocr_hedges")
+            pending.add(self._executor.submit(self._timed, image_bytes, True, cancelled))
+        error = None
+        while True:
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if error is None or not isinstance(e, (BudgetExceeded, RequestCancelled)):
+                        error = e  # 保険が予算切れでも、最初のリクエストの失敗の方を返す
+                    continue
+                for other in pending:
+                    other.cancel()  # 遅い方は結果を捨てる
+                return result
+            if not pending:
+                raise error
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+    def detect(self, image_bytes, cancelled=None):
+        self.acquire(cancelled)
+        return self.request(image_bytes, cancelled)
+
+
+class CircuitBreaker:
+    """エラーが続いたら代わりのバックエンドに切り替えるサーキットブレーカー.
+
+    直近 window 件の失敗率が error_rate を超えると開き、cooldown 秒後に 1 件だけ
+    本来のバックエンドで試す (半開)。ヒストグラムの p99 の slow_factor 倍より遅い
+    呼び出しも失敗として数える。backend が acquire() / request() に分かれていれば
+    レート制限の順番待ちは測らず、予算切れ (BudgetExceeded) も失敗に数えずにそのまま投げる。
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, backend, fallback=None, histogram=None, window=20, min_calls=5,
+                 error_rate=0.5, cooldown=30.0, slow_factor=4.0, min_slow=2.0):
+        self.backend = backend
+        self.fallback = fallback
+        self.name = backend.name
+        self.histogram = histogram or LatencyHistogram()
+        self.outcomes = deque(maxlen=window)
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.cooldown = cooldown
+        self.slow_factor = slow_factor
+        self.min_slow = min_slow
+        self.state = self.CLOSED
+        self.opened_at = 0.0
+        self._trial_running = False
+        self._split = hasattr(backend, "acquire") and hasattr(backend, "request")
+        self._lock = threading.Lock()
+
+    def slow_threshold(self):
+        p99 = self.histogram.quantile(0.99)
+        return self.min_slow if p99 is None else max(self.min_slow, p99 * self.slow_factor)
+
+    def _allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+                self.state = self.HALF_OPEN
+            if self.state == self.HALF_OPEN and not self._trial_running:
+                self._trial_running = True
+                return True
+            return False
+
+    def _release(self):
+        # 結果を数えずに半開の試行枠を返す (予算切れなどバックエンドのせいではない場合)
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trial_running = False
+
+    def _record(self, ok):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trial_running = False
+                self.outcomes.clear()
+                if ok:
+                    self.state = self.CLOSED
+                else:
+                    self.state = self.OPEN
+                    self.opened_at = time.monotonic()
+                return
+            if self.state == self.OPEN:
+                return  # 開く前に出ていた呼び出しの結果は数えない
+            self.outcomes.append(ok)
+            failures = self.outcomes.count(False)
+            if len(self.outcomes) >= self.min_calls and failures / len(self.outcomes) > self.error_rate:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                log.warning("OCR のエラー率が高いため %.0f 秒間代わりのバックエンドに切り替えます", self.cooldown)
+
+    def detect(self, image_bytes, cancelled=None):
+        """cancelled (threading.Event) がセットされていれば、ゲートを通らずに RequestCancelled を投げる.
+
+        cancelled は backend が acquire() / request() に分かれているときだけ使う。
+        """
+        if not self._allow():
+            if self.fallback is None:
+                raise CircuitOpen("OCR バックエンドが停止中です")
+            inc("ocr_fallbacks")
+            return self.fallback.detect(image_bytes)
+        try:
+            if self._split:
+                self.backend.acquire(cancelled)  # 順番待ち (測らない)
+            threshold = self.slow_threshold()
+            start = time.perf_counter()
+            if self._split:
+                result = self.backend.request(image_bytes, cancelled)
+            else:
+                result = self.backend.detect(image_bytes)
+        except (BudgetExceeded, RequestCancelled, TimeoutError):
+            self._release()
+            raise
+        except Exception:
+            self._record(False)
+            if self.fallback is None:
+                raise
+            inc("ocr_fallbacks")
+            return self.fallback.detect(image_bytes)
+        elapsed = time.perf_counter() - start
+        self.histogram.observe(elapsed)
+        self._record(elapsed <= threshold)
+        return result
+
+
+class FaultInjectingBackend:
+    """遅延・エラー・障害を注入できるローカルの OCR スタンドイン (動作確認用)."""
+
+    name = "faulty"
+
+    def __init__(self, text="player", latency=0.01, tail_latency=0.5, tail_rate=0.05,
+                 error_rate=0.0, seed=None):
+        self.text = text
+        self.latency = latency
+        self.tail_latency = tail_latency
+        self.tail_rate = tail_rate
+        self.error_rate = error_rate
+        self.outage = False
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def detect(self, image_bytes):
+        with self._lock:
+            self.calls += 1
+            slow = self._random.random() < self.tail_rate
+            failed = self.outage or self._random.random() < self.error_rate
+        time.sleep(self.tail_latency if slow else self.latency)
+        if failed:
+            raise ConnectionError("503 Service Unavailable")
+        return OcrResult(self.text, 1.0, None, self.name)
@@ -0,0 +1,182 @@
+import argparse
+import time
+
+import numpy as np
+
+from scoring_formats import DEFAULT_PROFILE, PROFILES, RACES_PER_WAR
+
+# 1 回の見積もりで回す試行数
+SIMULATIONS = 100_000
+# あらかじめ作っておくレース結果の数 (試行ではここから選ぶ)
+BANK_SIZE = 16384
+
+
+def remaining_races(current_race, races_per_war=RACES_PER_WAR):
+    """交流戦の残りレース数 (current_race は確定済みの最後のレース番号、0 始まり)."""
+    done = current_race + 1
+    if done <= 0:
+        return races_per_war
+    return -done % races_per_war
+
+
+def slot_teams(profile, team_count):
+    """順位表の各枠 (プレイヤー) がどのチームかを返す (余った枠は team_count = その他).
+
+    枠は profile.team_count チーム分しかない。それより多いチームを渡すと、
+    あふれたチームには枠が割り当てられず、残りレースの得点は常に 0 として扱われる。
+    """
+    slots = np.full(profile.player_count, team_count, dtype=np.intp)
+    for team in range(min(team_count, profile.player_count // profile.team_size)):
+        slots[team * profile.team_size:(team + 1) * profile.team_size] = team
+    return slots
+
+
+def required_placement(profile, totals, team, races):
+    """そのチームが 1 位になるのに必要な、残りレースでの平均順位.
+
+    ほかのチームは残りの得点を人数で均等に分け合うとみなす。
+    どの順位でも足りなければ None、最下位でも勝てるなら player_count を返す。
+    """
+    if races <= 0:
+        return None
+    others = np.delete(totals, team)
+    if not len(others):
+        return float(profile.player_count)
+    size = profile.team_size
+    race_total = float(profile.points.sum())
+    share = size / max(profile.player_count - size, 1)  # ほかの 1 チームが得る割合
+    # totals[team] + races * s > max(others) + races * (race_total - s) * share を s について解く
+    need = (others.max() - totals[team] + races * race_total * share) / (races * (1 + share))
+    per_player = need / size
+    points = profile.points.astype(np.float64)
+    if per_player > points[0]:
+        return None
+    if per_player <= points[-1]:
+        return float(profile.player_count)
+    # 得点表は順位について単調減少なので、反転して補間する
+    ranks = np.arange(1, profile.player_count + 1, dtype=np.float64)
+    return float(np.interp(per_player, points[::-1], ranks[::-1]))
+
+
+class WinProjection:
+    """交流戦の残りレースをモンテカルロで回し、チームごとの優勝確率を見積もる.
+
+    レース 1 回分の結果 (チームごとの得点) を bank_size 個だけ先に作っておき、
+    試行では残りレース数だけ bank から選んで足す。bank は交流戦・チームの顔ぶれが
+    変わったときだけ作り直すので、レースごとの見積もりは選んで足すだけで済む。
+
+    順位の分布 (distributions) を渡すと、各枠がそのチームの過去の順位の分布から順位を引き、
+    引いた順位の順 (同じなら乱数) に並べてレース結果にする。渡さなければ全員が同じ強さになる。
+    """
+
+    def __init__(self, simulations=SIMULATIONS, bank_size=BANK_SIZE, seed=None):
+        self.simulations = simulations
+        self.bank_size = bank_size
+        self.rng = np.random.default_rng(seed)
+        self._bank = None
+        self._bank_key = None
+
+    def _race_bank(self, profile, teams, distributions, war):
+        # 順位の分布はレースのたびに少しずつ変わるので、交流戦の番号が分かれば交流戦ごとに 1 回だけ作る
+        if war is not None:
+            key = (profile.key, tuple(teams), war, distributions is None)
+        else:
+            key = (profile.key, tuple(teams), None if distributions is None else
+                   tuple(np.asarray(distributions.get(team, ()), dtype=np.float64).tobytes() for team in teams))
+        if key == self._bank_key:
+            return self._bank
+
+        n_teams = len(teams)
+        slots = slot_teams(profile, n_teams)
+        n_slots = profile.player_count
+        if distributions is None:
+            # 同じ強さなら順位は一様な並べ替え
+            keys = self.rng.random((self.bank_size, n_slots))
+        else:
+            uniform = np.full(n_slots, 1.0 / n_slots)
+            probabilities = np.array([
+                _normalize(distributions.get(teams[team]), n_slots) if team < n_teams else uniform
+                for team in slots
+            ])
+            cdf = np.cumsum(probabilities, axis=1)
+            u = self.rng.random((self.bank_size, n_slots, 1))
+            drawn = (u > cdf[None, :, :-1]).sum(axis=2)  # 枠ごとに引いた順位 (0 始まり)
+            keys = drawn + self.rng.random((self.bank_size, n_slots))
+        order = np.argsort(keys, axis=1)  # order[k, 順位] = その順位の枠
+
+        # 順位の得点をチームごとに合計する ((試行, チーム) の番号で bincount)
+        team_of_rank = slots[order]
+        index = np.arange(self.bank_size)[:, None] * (n_teams + 1) + team_of_rank
+        weights = np.broadcast_to(profile.points, order.shape)
+        bank = np.bincount(index.ravel(), weights=weights.ravel(), minlength=self.bank_size * (n_teams + 1))
+        self._bank = bank.reshape(self.bank_size, n_teams + 1)[:, :n_teams].astype(np.int16)
+        self._bank_key = key
+        return self._bank
+
+    def project(self, team_total_scores, current_race, profile, distributions=None, war=None):
+        """[(チーム, 得点, 優勝確率, 必要な平均順位)] を優勝確率の高い順に返す.
+
+        distributions は {チーム: 順位ごとの確率 (1 位から)}。同点で終わった試行は同点のチームで分ける。
+        war (交流戦の番号) を渡すと、交流戦の途中で distributions が変わっても bank は作り直さない。
+        profile.team_count より多いチームは、残りレースで得点しないものとして扱う (slot_teams)。
+        """
+        teams = list(team_total_scores)
+        if not teams:
+            return []
+        totals = np.array([team_total_scores[team] for team in teams], dtype=np.int32)
+        races = remaining_races(current_race)
+
+        if races:
+            bank = self._race_bank(profile, teams, distributions, war)
+            picks = self.rng.integers(len(bank), size=(races, self.simulations))
+            final = np.broadcast_to(totals, (self.simulations, len(teams))).copy()
+            for race_picks in picks:
+                final += bank[race_picks]
+        else:
+            final = totals[None, :]
+        winners = final == final.max(axis=1, keepdims=True)
+        probability = (winners / winners.sum(axis=1, keepdims=True)).mean(axis=0)
+
+        rows = [
+            (team, int(totals[i]), float(probability[i]), required_placement(profile, totals, i, races))
+            for i, team in enumerate(teams)
+        ]
+        return sorted(rows, key=lambda row: (-row[2], -row[1]))
+
+
+def _normalize(distribution, n):
+    if distribution is None:
+        return np.full(n, 1.0 / n)
+    p = np.zeros(n)
+    values = np.asarray(distribution, dtype=np.float64)[:n]
+    p[:len(values)] = values
+    total = p.sum()
+    return p / total if total > 0 else np.full(n, 1.0 / n)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="優勝確率の見積もりにかかる時間を測る")
+    parser.add_argument("--format", choices=sorted(PROFILES), default=DEFAULT_PROFILE.key)
+    parser.add_argument("--race", type=int, default=3, help="確定済みのレース数")
+    parser.add_argument("--simulations", type=int, default=SIMULATIONS)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    profile = PROFILES[args.format]
+    rng = np.random.default_rng(0)
+    teams = [f"team{i + 1}" for i in range(profile.team_count)]
+    totals = dict(zip(teams, (rng.integers(0, profile.points.sum() // profile.team_count, len(teams)) * args.race).tolist()))
+    projection = WinProjection(args.simulations, seed=0)
+    projection.project(totals, args.race - 1, profile)  # bank を作っておく
+    start = time.perf_counter()
+    for _ in range(args.repeat):
+        rows = projection.project(totals, args.race - 1, profile)
+    elapsed = (time.perf_counter() - start) / args.repeat
+    for team, score, probability, placement in rows:
+        need = "-" if placement is None else f"{placement:.1f}"
+        print(f"{team:<8}{score:>6}{probability * 100:>8.1f}%  必要平均 {need}")
+    print(f"{args.simulations} 試行 x 残り {remaining_races(args.race - 1)} レース: {elapsed * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
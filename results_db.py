@@ -0,0 +1,355 @@
+import argparse
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+
+from scoring_formats import RACES_PER_WAR
+
+log = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    started REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS players (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS races (
+    id INTEGER PRIMARY KEY,
+    session_id INTEGER NOT NULL REFERENCES sessions(id),
+    race INTEGER NOT NULL,
+    war INTEGER NOT NULL,
+    format TEXT NOT NULL,
+    track TEXT,
+    ts REAL NOT NULL,
+    image_hash TEXT,
+    UNIQUE (session_id, race)
+);
+CREATE TABLE IF NOT EXISTS results (
+    race_id INTEGER NOT NULL REFERENCES races(id),
+    player_id INTEGER NOT NULL REFERENCES players(id),
+    session_id INTEGER NOT NULL,
+    war INTEGER NOT NULL,
+    rank INTEGER NOT NULL,
+    team TEXT,
+    points INTEGER NOT NULL,
+    ts REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS race_teams (
+    race_id INTEGER NOT NULL REFERENCES races(id),
+    session_id INTEGER NOT NULL,
+    war INTEGER NOT NULL,
+    team TEXT NOT NULL,
+    points INTEGER NOT NULL
+);
+-- 交流戦ごとのチームの合計 (対戦成績をレースの行を集計せずに引く)
+CREATE TABLE IF NOT EXISTS war_teams (
+    team TEXT NOT NULL,
+    session_id INTEGER NOT NULL,
+    war INTEGER NOT NULL,
+    points INTEGER NOT NULL,
+    PRIMARY KEY (team, session_id, war)
+) WITHOUT ROWID;
+-- 交流戦ごとのプレイヤーの合計 (直近 N 交流戦の平均をレースの行を集計せずに引く)
+CREATE TABLE IF NOT EXISTS player_wars (
+    player_id INTEGER NOT NULL,
+    session_id INTEGER NOT NULL,
+    war INTEGER NOT NULL,
+    last_ts REAL NOT NULL,
+    races INTEGER NOT NULL,
+    rank_sum INTEGER NOT NULL,
+    points_sum INTEGER NOT NULL,
+    PRIMARY KEY (player_id, session_id, war)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS player_wars_recent ON player_wars (player_id, last_ts);
+CREATE INDEX IF NOT EXISTS results_player ON results (player_id, ts);
+CREATE INDEX IF NOT EXISTS results_player_war ON results (player_id, session_id, war);
+CREATE INDEX IF NOT EXISTS results_team ON results (team, ts);
+CREATE INDEX IF NOT EXISTS results_race ON results (race_id);
+CREATE INDEX IF NOT EXISTS races_session ON races (session_id, race);
+CREATE INDEX IF NOT EXISTS races_ts ON races (ts);
+CREATE INDEX IF NOT EXISTS races_hash ON races (image_hash);
+CREATE INDEX IF NOT EXISTS race_teams_race ON race_teams (race_id);
+"""
+
+
+def _connect(path):
+    connection = sqlite3.connect(path, timeout=30)
+    connection.execute("PRAGMA journal_mode=WAL")  # 書き込み中も読める
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute("PRAGMA foreign_keys=ON")
+    return connection
+
+
+class ResultsDB:
+    """確定したレース結果を残す SQLite のデータベース.
+
+    record_race() はキューに積むだけで、書き込みは専用スレッドが batch_size 件ずつ
+    1 つのトランザクションにまとめて行う (集計中の GUI を待たせない)。
+    検索はスレッドごとの読み取り用接続で行う。
+    """
+
+    def __init__(self, path, batch_size=256):
+        self.path = path
+        self.batch_size = batch_size
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with _connect(path) as connection:
+            connection.executescript(SCHEMA)
+        connection.close()
+        self._queue = queue.Queue()
+        self._local = threading.local()
+        self._running = True
+        self._thread = threading.Thread(target=self._writer, name="results-db", daemon=True)
+        self._thread.start()
+
+    # ---- 書き込み ----
+
+    def record_race(self, session, race, profile, player_names, teams, race_scores, image_hash=None, ts=None,
+                    track=None, war=None):
+        """1 レース分の結果を書き込み待ちに積む.
+
+        player_names と teams は順位順 (空欄は None)。race はセッションを通した 0 始まりのレース番号。
+        war を省くと RACES_PER_WAR レースごとに区切った交流戦の番号にする。
+        """
+        self._queue.put({
+            "session": session,
+            "race": race,
+            "war": race // RACES_PER_WAR if war is None else war,
+            "format": profile.key,
+            "points": [int(p) for p in profile.points[:len(player_names)]],
+            "player_names": list(player_names),
+            "teams": list(teams),
+            "race_scores": dict(race_scores),
+            "image_hash": image_hash,
+            "ts": ts or time.time(),
+            "track": track,
+        })
+
+    def flush(self):
+        """積んであるレースをすべて書き終えるまで待つ."""
+        self._queue.join()
+
+    def close(self):
+        self.flush()
+        self._running = False
+        self._queue.put(None)
+        self._thread.join(timeout=5.0)
+
+    def _writer(self):
+        connection = _connect(self.path)
+        sessions = {}
+        players = {}
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                break
+            batch = [item]
+            # 溜まっている分をまとめて 1 回のコミットにする
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)  # 終了は次の周で処理する
+                    self._queue.task_done()
+                    break
+                batch.append(item)
+            try:
+                with connection:
+                    for record in batch:
+                        self._insert(connection, record, sessions, players)
+            except sqlite3.Error as e:
+                log.error("レース結果の保存に失敗しました: %s", e)
+                sessions.clear()
+                players.clear()
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+        connection.close()
+
+    def _insert(self, connection, record, sessions, players):
+        session_id = sessions.get(record["session"])
+        if session_id is None:
+            connection.execute("INSERT OR IGNORE INTO sessions (name, started) VALUES (?, ?)",
+                               (record["session"], record["ts"]))
+            session_id = sessions[record["session"]] = connection.execute(
+                "SELECT id FROM sessions WHERE name = ?", (record["session"],)).fetchone()[0]
+        war = record["war"]
+        # 取り消して同じレース番号を確定し直したときは古い結果を消す
+        old = connection.execute("SELECT id, war FROM races WHERE session_id = ? AND race = ?",
+                                 (session_id, record["race"])).fetchone()
+        if old is not None:
+            old_id, old_war = old
+            connection.execute(
+                """
+                UPDATE war_teams SET points = points - (
+                    SELECT points FROM race_teams
+                    WHERE race_teams.race_id = ? AND race_teams.team = war_teams.team
+                )
+                WHERE session_id = ? AND war = ? AND team IN (SELECT team FROM race_teams WHERE race_id = ?)
+                """,
+                (old_id, session_id, old_war, old_id),
+            )
+            connection.execute(
+                """
+                UPDATE player_wars SET races = races - 1,
+                    rank_sum = rank_sum - (SELECT rank FROM results WHERE race_id = ? AND player_id = player_wars.player_id),
+                    points_sum = points_sum - (SELECT points FROM results WHERE race_id = ? AND player_id = player_wars.player_id)
+                WHERE session_id = ? AND war = ? AND player_id IN (SELECT player_id FROM results WHERE race_id = ?)
+                """,
+                (old_id, old_id, session_id, old_war, old_id),
+            )
+            connection.execute("DELETE FROM results WHERE race_id = ?", (old_id,))
+            connection.execute("DELETE FROM race_teams WHERE race_id = ?", (old_id,))
+            connection.execute("DELETE FROM races WHERE id = ?", (old_id,))
+        race_id = connection.execute(
+            "INSERT INTO races (session_id, race, war, format, track, ts, image_hash) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (session_id, record["race"], war, record["format"], record["track"], record["ts"], record["image_hash"]),
+        ).lastrowid
+        rows = []
+        for rank, (name, team) in enumerate(zip(record["player_names"], record["teams"])):
+            if not name:
+                continue
+            player_id = players.get(name)
+            if player_id is None:
+                connection.execute("INSERT OR IGNORE INTO players (name) VALUES (?)", (name,))
+                player_id = players[name] = connection.execute(
+                    "SELECT id FROM players WHERE name = ?", (name,)).fetchone()[0]
+            rows.append((race_id, player_id, session_id, war, rank + 1, team.lower() if team else None,
+                         record["points"][rank], record["ts"]))
+        connection.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        connection.executemany(
+            """
+            INSERT INTO player_wars VALUES (?, ?, ?, ?, 1, ?, ?)
+            ON CONFLICT (player_id, session_id, war) DO UPDATE SET
+                last_ts = MAX(last_ts, excluded.last_ts), races = races + 1,
+                rank_sum = rank_sum + excluded.rank_sum, points_sum = points_sum + excluded.points_sum
+            """,
+            [(player_id, session_id, war, ts, rank, points) for _, player_id, session_id, war, rank, _, points, ts in rows],
+        )
+        team_rows = [(team.lower(), session_id, war, int(points)) for team, points in record["race_scores"].items()]
+        connection.executemany(
+            "INSERT INTO race_teams VALUES (?, ?, ?, ?, ?)",
+            [(race_id, session_id, war, team, points) for team, session_id, war, points in team_rows],
+        )
+        connection.executemany(
+            """
+            INSERT INTO war_teams VALUES (?, ?, ?, ?)
+            ON CONFLICT (team, session_id, war) DO UPDATE SET points = points + excluded.points
+            """,
+            team_rows,
+        )
+
+    # ---- 検索 ----
+
+    @property
+    def connection(self):
+        """このスレッドの読み取り用接続."""
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = self._local.connection = _connect(self.path)
+        return connection
+
+    def has_image(self, image_hash):
+        """同じ画像のレースが記録済みか."""
+        return self.connection.execute(
+            "SELECT 1 FROM races WHERE image_hash = ? LIMIT 1", (image_hash,)).fetchone() is not None
+
+    def player_average(self, name, wars=100):
+        """プレイヤーの直近 wars 交流戦の平均順位・平均得点・レース数."""
+        row = self.connection.execute(
+            """
+            WITH recent AS (
+                SELECT races, rank_sum, points_sum FROM player_wars
+                WHERE player_id = (SELECT id FROM players WHERE name = ?)
+                ORDER BY last_ts DESC
+                LIMIT ?
+            )
+            SELECT 1.0 * SUM(rank_sum) / SUM(races), 1.0 * SUM(points_sum) / SUM(races), COALESCE(SUM(races), 0)
+            FROM recent
+            """,
+            (name, wars),
+        ).fetchone()
+        return {"average_rank": row[0], "average_points": row[1], "races": row[2]}
+
+    def player_history(self, name, limit=100):
+        """プレイヤーの直近のレース (新しい順) の (日時, 順位, 得点, チーム)."""
+        return self.connection.execute(
+            """
+            SELECT results.ts, results.rank, results.points, results.team FROM results
+            JOIN players ON players.id = results.player_id
+            WHERE players.name = ?
+            ORDER BY results.ts DESC LIMIT ?
+            """,
+            (name, limit),
+        ).fetchall()
+
+    def team_head_to_head(self, team_a, team_b):
+        """2 チームが同じ交流戦に出たときの勝敗と得点の合計."""
+        row = self.connection.execute(
+            """
+            SELECT COUNT(*),
+                   SUM(a.points > b.points), SUM(a.points < b.points), SUM(a.points = b.points),
+                   SUM(a.points), SUM(b.points)
+            FROM war_teams a JOIN war_teams b
+                ON b.team = ? AND b.session_id = a.session_id AND b.war = a.war
+            WHERE a.team = ?
+            """,
+            (team_b.lower(), team_a.lower()),
+        ).fetchone()
+        wars, wins, losses, draws, points_for, points_against = (value or 0 for value in row)
+        return {"wars": wars, "wins": wins, "losses": losses, "draws": draws,
+                "points_for": points_for, "points_against": points_against}
+
+    def session_races(self, session):
+        """セッションのレースごとのチーム得点 {レース番号: {チーム: 得点}}."""
+        races = {}
+        for race, team, points in self.connection.execute(
+            """
+            SELECT races.race, race_teams.team, race_teams.points FROM race_teams
+            JOIN races ON races.id = race_teams.race_id
+            JOIN sessions ON sessions.id = races.session_id
+            WHERE sessions.name = ? ORDER BY races.race
+            """,
+            (session,),
+        ):
+            races.setdefault(race, {})[team] = points
+        return races
+
+    def race_count(self):
+        return self.connection.execute("SELECT COUNT(*) FROM races").fetchone()[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="レース結果データベースの検索")
+    parser.add_argument("--db", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "mkscan_data", "results.db"))
+    sub = parser.add_subparsers(dest="command", required=True)
+    player_parser = sub.add_parser("player", help="プレイヤーの直近の平均")
+    player_parser.add_argument("name")
+    player_parser.add_argument("--wars", type=int, default=100)
+    h2h_parser = sub.add_parser("h2h", help="2 チームの対戦成績")
+    h2h_parser.add_argument("team_a")
+    h2h_parser.add_argument("team_b")
+    args = parser.parse_args()
+
+    db = ResultsDB(args.db)
+    start = time.perf_counter()
+    if args.command == "player":
+        result = db.player_average(args.name, args.wars)
+    else:
+        result = db.team_head_to_head(args.team_a, args.team_b)
+    elapsed = (time.perf_counter() - start) * 1000
+    print(f"{result} ({elapsed:.1f} ms)")
+    db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,31 @@
+import numpy as np
+
+# 空欄とみなす輝度の分散の上限
+MIN_VARIANCE = 60.0
+# 横方向の輝度差がこれを超える画素をエッジとして数える
+EDGE_THRESHOLD = 40
+# 文字がある行のエッジ画素の最小割合
+MIN_EDGE_RATIO = 0.01
+
+
+def row_occupancy(image, profile):
+    """各行にプレイヤーが表示されているかを bool 配列で返す.
+
+    OCR に投げる前の足切りなので、輝度の分散と横方向のエッジ数だけを見る。
+    名前欄全体を一度だけ配列にし、行ごとの集計は reduceat でまとめて行う。
+    """
+    left, top, right, bottom = profile.name_area
+    gray = np.asarray(image.convert("L"), dtype=np.float32)[top:bottom, left:right]
+    edges = np.abs(np.diff(gray, axis=1)) > EDGE_THRESHOLD
+
+    starts = np.array([box[1] - top for box in profile.row_boxes], dtype=np.intp)
+    heights = np.diff(np.append(starts, bottom - top))
+    pixels = heights * gray.shape[1]
+
+    row_sum = np.add.reduceat(gray.sum(axis=1), starts)
+    row_sq_sum = np.add.reduceat((gray * gray).sum(axis=1), starts)
+    mean = row_sum / pixels
+    variance = row_sq_sum / pixels - mean * mean
+
+    edge_ratio = np.add.reduceat(edges.sum(axis=1), starts) / (heights * edges.shape[1])
+    return (variance > MIN_VARIANCE) & (edge_ratio > MIN_EDGE_RATIO)
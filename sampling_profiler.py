@@ -0,0 +1,145 @@
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import METRICS
+
+log = logging.getLogger(__name__)
+
+# サンプリング間隔 (秒)
+DEFAULT_INTERVAL = 0.005
+# どの段階 (span) にもいないときの段階名
+NO_STAGE = "other"
+
+
+def _frame_name(code):
+    # flame graph の区切り文字 (;) と空白は名前に入れない
+    module = os.path.splitext(os.path.basename(code.co_filename))[0]
+    name = getattr(code, "co_qualname", code.co_name)
+    return f"{module}.{name}".replace(";", ":").replace(" ", "_")
+
+
+class SamplingProfiler:
+    """次の N レースだけ動かすサンプリングプロファイラ.
+
+    別スレッドが interval 秒ごとに全スレッドのスタックを sys._current_frames() で集め、
+    レースが確定するたびに「段階;スレッド;関数...」形式の folded stacks を
+    race-NNN.folded に書き出す (flamegraph.pl や speedscope でそのまま読める)。
+    段階は metrics の span から取るので、動いている間だけ span がスレッドごとの段階を記録する。
+    止まっている間はスレッドも無く、span も普段どおりなので処理には何も足さない。
+    書き出しは専用のスレッドで行うので、レース確定の listener (Tk のスレッド) は待たされない。
+    """
+
+    def __init__(self, output_dir, interval=DEFAULT_INTERVAL, metrics=METRICS):
+        self.output_dir = output_dir
+        self.interval = interval
+        self.metrics = metrics
+        self.race = 0
+        self.remaining = 0
+        self.samples = 0
+        self._counts = {}  # (段階, スレッド名, 関数の並び) -> サンプル数
+        self._stages = {}  # スレッド ID -> 入っている段階のスタック (OCR のワーカーからも書き換わる)
+        self._lock = threading.Lock()
+        self._stage_lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._thread = None
+        self._running = False
+        self._race_dir = output_dir
+
+    @property
+    def running(self):
+        return self._running
+
+    def start(self, races=1, first_race=0, session_name=None):
+        """first_race (0 始まり) から races レース分の計測を始める."""
+        if self._running:
+            return
+        self.race = first_race
+        self.remaining = races
+        self._race_dir = os.path.join(self.output_dir, session_name) if session_name else self.output_dir
+        self._counts = {}
+        with self._stage_lock:
+            self._stages = {}
+        self._running = True
+        self.metrics.tracker = self
+        self._thread = threading.Thread(target=self._loop, name="sampling-profiler", daemon=True)
+        self._thread.start()
+        log.info("プロファイラを開始しました (%d レース, %s)", races, self._race_dir)
+
+    def stop(self, flush=True):
+        """計測を止める (flush なら途中のレースの分も書き出す)."""
+        if not self._running:
+            return
+        self._running = False
+        self.metrics.tracker = None
+        self._thread.join(timeout=1.0)
+        if flush:
+            self._flush(partial=True)
+        log.info("プロファイラを停止しました")
+
+    def on_session_event(self, session, event):
+        """ScoringSession の listener (レースが確定したらそのレースの分を書き出す)."""
+        if self._running and event == "race":
+            self.next_race()
+
+    def next_race(self):
+        self._flush()
+        self.race += 1
+        self.remaining -= 1
+        if self.remaining <= 0:
+            self.stop(flush=False)
+
+    def enter_stage(self, name):
+        with self._stage_lock:
+            self._stages.setdefault(threading.get_ident(), []).append(name)
+
+    def exit_stage(self, name):
+        with self._stage_lock:
+            stack = self._stages.get(threading.get_ident())
+            if stack:
+                stack.pop()
+
+    def _loop(self):
+        own = threading.get_ident()
+        while self._running:
+            time.sleep(self.interval)
+            self._sample(own)
+
+    def _sample(self, own):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        frames = sys._current_frames()
+        with self._stage_lock:
+            current = {ident: stack[-1] for ident, stack in self._stages.items() if stack}
+        with self._lock:
+            for ident, frame in frames.items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                key = (current.get(ident, NO_STAGE), names.get(ident, str(ident)), tuple(reversed(stack)))
+                self._counts[key] = self._counts.get(key, 0) + 1
+            self.samples += 1
+
+    def _flush(self, partial=False):
+        """今のレースのサンプルを取り出し、書き出しを専用のスレッドに任せる (Future を返す)."""
+        with self._lock:
+            counts, self._counts = self._counts, {}
+        if not counts:
+            return None
+        suffix = "-partial" if partial else ""
+        path = os.path.join(self._race_dir, f"race-{self.race + 1:03d}{suffix}.folded")
+        return self._writer.submit(self._write, path, self.race, counts)
+
+    def _write(self, path, race, counts):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as f:
+            for (stage, thread_name, stack), count in sorted(counts.items(), key=lambda item: -item[1]):
+                frames = [f"race_{race + 1}", f"stage_{stage}", f"thread_{thread_name}".replace(" ", "_").replace(";", ":")]
+                f.write(";".join(frames + list(stack)) + f" {count}\n")
+        log.info("%s に書き出しました", path)
+        return path
@@ -0,0 +1,394 @@
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import numpy as np
+from PIL import Image
+
+from async_ocr import ExecutorBackend, extract_player_rows_async
+from capture_guard import CaptureGuard, DuplicateCapture
+from metrics import inc, span
+from ocr_backends import VisionBackend, crop_row, local_backend, match_roster, needs_retry, pick_better
+from ocr_limits import LIVE, CostMeter, LimitedBackend, OcrGate, RequestBudget, TokenBucket
+from ocr_resilience import CircuitBreaker, HedgedBackend
+from row_occupancy import row_occupancy
+from scoring_formats import DEFAULT_PROFILE, RACES_PER_WAR, score_teams
+from team_colors import classify_team_colors, grouping_agreement, name_color_teams
+from team_inference import TeamInference, common_tag
+
+log = logging.getLogger(__name__)
+
+# OCR を並列に投げる最大数 (24 行でも 12 行と同じ待ち時間に収める)
+OCR_WORKERS = 24
+
+# OCR のレート制限 (回/秒、バースト) と予算 (None は上限なし)
+OCR_RATE = 15
+OCR_BURST = 24
+OCR_DAILY_LIMIT = 5000
+OCR_SESSION_LIMIT = None
+
+# 名前欄の座標は FHD のリザルト画面に合わせてあるので、他の解像度はこの大きさに揃える
+CAPTURE_SIZE = (1920, 1080)
+
+_ocr_executor = ThreadPoolExecutor(max_workers=OCR_WORKERS)
+
+
+class OcrStack:
+    """レート制限・予算・ヘッジ・サーキットブレーカーを組み合わせた OCR 一式.
+
+    backend を渡すと Vision API の代わりにそれを使う (ローカルのスタンドインなど)。
+    過去画像の一括処理では priority=BACKFILL にして、予算の予備分を今のレースに残す。
+    """
+
+    def __init__(self, budget_path=None, backend=None, fallback=None, rate=OCR_RATE, burst=OCR_BURST,
+                 daily_limit=OCR_DAILY_LIMIT, session_limit=OCR_SESSION_LIMIT, priority=LIVE):
+        self.meter = CostMeter()
+        self.gate = OcrGate(
+            TokenBucket(rate, burst),
+            RequestBudget(daily_limit, session_limit, budget_path),
+            backfill_reserve=burst * 2,  # 今のレース用に残しておく分
+        )
+        # 遅い応答には p95 を過ぎたら保険のリクエストを送り、障害時はローカル OCR に切り替える
+        self.limited = LimitedBackend(backend or VisionBackend(), self.gate, self.meter, priority)
+        self.backend = CircuitBreaker(
+            HedgedBackend(self.limited, max_workers=OCR_WORKERS * 2), fallback=local_backend() if fallback is None else fallback
+        )
+        self.retry_backend = self.backend  # 再 OCR に別のバックエンドを使う場合はここを差し替える
+
+        # asyncio 用 (同期の経路をスレッドプールで await する。ヘッジとフォールバックもそのまま効く)
+        # 取り消された行はゲートの手前で止め、予算を使わない
+        self.async_backend = ExecutorBackend(self.backend, _ocr_executor, cancellable=True)
+
+    def async_retry_backend(self):
+        """asyncio 用の再 OCR のバックエンド (retry_backend を差し替えていればそれを使う)."""
+        if self.retry_backend is self.backend:
+            return self.async_backend
+        return ExecutorBackend(self.retry_backend, _ocr_executor)
+
+    def close(self):
+        self.gate.budget.save()
+
+
+def to_capture_size(image):
+    """720p などのキャプチャを FHD に拡大する (FHD ならそのまま返す)."""
+    if image.size == CAPTURE_SIZE:
+        return image
+    return image.convert("RGB").resize(CAPTURE_SIZE, Image.Resampling.BICUBIC)
+
+
+def decode_image(image_bytes):
+    """画像ファイルのバイト列を PIL 画像にする (スレッド間で共有できるようデコードまで済ませる)."""
+    image = Image.open(io.BytesIO(image_bytes))
+    image.load()
+    return to_capture_size(image)
+
+
+def frame_to_image(frame):
+    """キャプチャした BGR の ndarray を PIL 画像にする."""
+    return to_capture_size(Image.fromarray(np.ascontiguousarray(frame[:, :, ::-1])))
+
+
+def compute_standings(team_total_scores):
+    """合計得点から順位表を作る.
+
+    戻り値は得点順の (順位, チーム名, 得点, 1 つ上のチームとの点差) のリスト。
+    同点は同じ順位にし、先頭のチームの点差は None。
+    """
+    sorted_team_scores = sorted(team_total_scores.items(), key=lambda x: int(x[1]), reverse=True)
+    standings = []
+    previous_score = None
+    rank = 1
+    for i, (team_name, score) in enumerate(sorted_team_scores):
+        score = int(score)
+        if score != previous_score:
+            rank = i + 1
+        gap = None if i == 0 else previous_score - score
+        standings.append((rank, team_name, score, gap))
+        previous_score = score
+    return standings
+
+
+def read_row(image, box, backend, enhance=False):
+    """1 行分をクロップして OCR し、先頭行の OcrResult を返す."""
+    return backend.detect(crop_row(image, box, enhance))
+
+
+def extract_player_rows(image, profile, backend, retry_backend=None, roster=None, on_progress=None):
+    """画像から行ごとの OcrResult を抽出する.
+
+    戻り値は順位順で長さ profile.player_count のリスト。空欄・読めなかった行は None。
+    1 回目は全行を通常の画像で読み、怪しい行だけを拡大画像で読み直す。
+    on_progress(行数) は行を読み終えるたびに呼ばれる。
+    """
+    retry_backend = retry_backend or backend
+    rows = [None] * profile.player_count
+    roster = list(roster or [])
+
+    # 空欄の行 (未完走・切断) は OCR に投げない
+    occupied = row_occupancy(image, profile)
+    skipped = profile.player_count - int(occupied.sum())
+    if skipped and on_progress:
+        on_progress(skipped)
+
+    # 各行の OCR を並列に投げ、順位順に並べ直す
+    futures = {
+        _ocr_executor.submit(read_row, image, box, backend): i
+        for i, box in enumerate(profile.row_boxes)
+        if occupied[i]
+    }
+    for future in as_completed(futures):
+        try:
+            rows[futures[future]] = future.result()
+        except Exception as e:
+            log.warning("%d行目の認識に失敗しました: %s", futures[future] + 1, e)
+        if on_progress:
+            on_progress(1)
+
+    # 信頼度が低い行・名簿に無い行だけを読み直す
+    retries = {
+        _ocr_executor.submit(read_row, image, profile.row_boxes[i], retry_backend, True): i
+        for i in range(profile.player_count)
+        if occupied[i] and needs_retry(rows[i], roster)
+    }
+    inc("ocr_retries", len(retries))
+    for future in as_completed(retries):
+        i = retries[future]
+        try:
+            rows[i] = pick_better(rows[i], future.result())
+        except Exception as e:
+            log.warning("%d行目の再認識に失敗しました: %s", i + 1, e)
+
+    # 名簿の名前に寄せる
+    if roster:
+        for result in rows:
+            if result is not None:
+                result.text = match_roster(result.text, roster) or result.text
+    return rows
+
+
+class ScoringSession:
+    """Tk に依存しない集計エンジン (画像 → OCR → レース結果 → 順位表).
+
+    GUI・CLI・サーバーのどれからも同じように使う。journal を渡すと確定したレースと
+    得点の編集を追記する。listeners には確定・編集のたびに listener(session, event) が呼ばれる。
+
+    race_results と team_total_scores は今の交流戦の分だけを持つ。交流戦は races_per_war
+    レースを確定した後の次のレースで自動的に (または end_war() で手動で) 区切り、
+    終わった交流戦の結果はメモリから捨てる (レースごとの結果はデータベースとジャーナルに残っている)。
+    """
+
+    def __init__(self, profile=DEFAULT_PROFILE, ocr=None, journal=None, races_per_war=RACES_PER_WAR):
+        self.profile = profile
+        self.ocr = ocr or OcrStack()
+        self.journal = journal
+        self.races_per_war = races_per_war  # None なら自動では区切らない
+        self.team_inference = TeamInference(profile.team_count, profile.team_size)
+        self.capture_guard = CaptureGuard(profile)  # 同じリザルト画面の二重キャプチャを OCR の前に見つける
+        self.color_palette = []  # 行の色でチーム分けしたときの「色N」の名前と色 (交流戦の間は変えない)
+        self.current_race = -1  # セッションを通したレース番号 (初期値は -1)
+        self.war = 0  # 今の交流戦の番号 (0 始まり)
+        self.war_start = 0  # 今の交流戦の最初のレース番号
+        self.last_war = None  # 直前に終わった交流戦の (番号, 順位表, 補正)
+        self.race_results = []  # 今の交流戦の各レースの結果 (順位順の名前, チームごとの得点)
+        self.team_total_scores = {}  # 今の交流戦のチームごとの合計得点
+        self.last_teams = []  # 直前に確定したレースの順位順のチーム名 (空欄は None)
+        self.listeners = []
+
+    def set_profile(self, profile):
+        """大会形式を切り替える."""
+        if profile is not self.profile:
+            self.color_palette = []
+        self.profile = profile
+        self.team_inference.configure(profile.team_count, profile.team_size)
+        self.capture_guard.set_profile(profile)
+
+    @property
+    def war_race(self):
+        """今の交流戦の中でのレース番号 (0 始まり、まだ無ければ -1)."""
+        return self.current_race - self.war_start
+
+    def restore(self, state):
+        """ジャーナルから復元した状態を反映する."""
+        self.current_race = state["current_race"]
+        self.war = state.get("war", 0)
+        self.war_start = state.get("war_start", 0)
+        self.race_results = list(state["race_results"])
+        self.team_total_scores = dict(state["team_total_scores"])
+        for name, team_name in state.get("team_overrides", {}).items():
+            self.team_inference.set_override(name, team_name)
+        self._notify("restore")
+
+    def set_override(self, name, team_name):
+        """プレイヤーのチームを手動で指定する."""
+        self.team_inference.set_override(name, team_name)
+        if self.journal is not None:
+            self.journal.append("team_override", name=name, team=team_name.lower())
+
+    def read_rows(self, image, on_progress=None):
+        """画像を OCR して行ごとの OcrResult を返す (同期版)."""
+        self.ocr.meter.set_war(self.war)
+        return extract_player_rows(
+            image, self.profile, self.ocr.backend, self.ocr.retry_backend,
+            self.team_inference.roster(), on_progress,
+        )
+
+    async def read_rows_async(self, image, on_progress=None):
+        """画像を OCR して行ごとの OcrResult を返す (asyncio 版)."""
+        self.ocr.meter.set_war(self.war)
+        return await extract_player_rows_async(
+            image, self.profile, self.ocr.async_backend, self.ocr.async_retry_backend(),
+            roster=self.team_inference.roster(), on_progress=on_progress, executor=_ocr_executor,
+        )
+
+    def check_capture(self, image):
+        """(指紋, 直近に確定したレースと同じ画面ならそのレース番号 or None) を返す (OCR はしない)."""
+        return self.capture_guard.check(to_capture_size(image))
+
+    def ingest_image(self, image, on_progress=None, allow_duplicate=False):
+        """PIL 画像を読み取り、レースとして確定する。(名前のリスト, チームごとの得点) を返す.
+
+        直近に確定したレースと同じ画面なら、OCR する前に DuplicateCapture を送出する。
+        """
+        image = to_capture_size(image)  # 名前欄の座標は FHD に合わせてある
+        fingerprint, duplicate = self.check_capture(image)
+        if duplicate is not None and not allow_duplicate:
+            raise DuplicateCapture(duplicate)
+        rows = self.read_rows(image, on_progress)
+        player_names = [result.text if result else None for result in rows]
+        return player_names, self.commit_race(player_names, image, fingerprint)
+
+    def ingest_bytes(self, image_bytes, on_progress=None, allow_duplicate=False):
+        """画像ファイルのバイト列を読み取り、レースとして確定する."""
+        return self.ingest_image(decode_image(image_bytes), on_progress, allow_duplicate)
+
+    def ingest_frame(self, frame, on_progress=None, allow_duplicate=False):
+        """キャプチャした BGR の ndarray を読み取り、レースとして確定する."""
+        return self.ingest_image(frame_to_image(frame), on_progress, allow_duplicate)
+
+    def row_teams(self, player_names, image=None):
+        """このレースの順位順のチーム名 (空欄は None) を決める.
+
+        行の背景色でチームがはっきり分かれていれば色だけでチーム分けし、名前のタグからの推定はしない
+        (同じ名前が 2 行に読めても行ごとにチームが決まる)。色が無い・弱いときはタグで分ける。
+        手動で指定したチームはどちらよりも優先する。
+        """
+        if not self.profile.is_team_mode:
+            return list(player_names)
+
+        # 名前が読めた行だけを使う (player_names は順位順に並んでいる)
+        rows = [i for i, name in enumerate(player_names) if name]
+        labels = None
+        if image is not None and len(rows) > 1:
+            labels, confident, centers = classify_team_colors(image, self.profile, rows)
+            if labels is not None and confident:
+                names = [player_names[i] for i in rows]
+                color_teams = name_color_teams(
+                    labels, names, self.team_inference.team_of, centers, self.color_palette, common_tag,
+                )
+                self.team_inference.remember(names, color_teams)  # 次のレースで同じ名前を引き継ぐ (名簿にもなる)
+                teams = [None] * len(player_names)
+                for i, name, team_name in zip(rows, names, color_teams):
+                    teams[i] = self.team_inference.overrides.get(name) or team_name
+                return teams
+
+        # チーム名はタグ (共通の接頭辞・接尾辞) から推定する
+        teams = self.team_inference.infer(player_names)
+        if labels is not None:
+            # 色が弱いときは接頭辞によるチーム分けとの一致度だけ確認する
+            agreement = grouping_agreement(labels, [teams[i] for i in rows])
+            if agreement < 0.9:
+                log.info("色とタグのチーム分けが一致しません (一致率 %.2f)", agreement)
+        return teams
+
+    def commit_race(self, player_names, image=None, fingerprint=None):
+        """順位順の名前をレース結果として確定し、チームごとの得点を返す.
+
+        fingerprint (check_capture の指紋) を渡すと、次からの二重キャプチャの判定に使う。
+        """
+        self.maybe_end_war()
+        with span("scoring"):
+            self.last_teams = self.row_teams(player_names, image)
+            race_scores = score_teams(self.profile, self.last_teams)
+
+            # レース結果を保存
+            self.race_results.append((player_names, race_scores))
+            if self.journal is not None:
+                self.journal.append("race", player_names=player_names, race_scores=race_scores)
+
+            # チームごとの合計得点を更新
+            for team_name, score in race_scores.items():
+                self.team_total_scores[team_name] = self.team_total_scores.get(team_name, 0) + score
+        inc("races")
+
+        self.current_race += 1  # レース番号をインクリメント
+        if fingerprint is not None:
+            self.capture_guard.remember(fingerprint, self.current_race)
+        self._notify("race")
+        return race_scores
+
+    def maybe_end_war(self):
+        """今の交流戦が races_per_war レースに達していれば終える (終えたら True)."""
+        if self.races_per_war and len(self.race_results) >= self.races_per_war:
+            self.end_war()
+            return True
+        return False
+
+    def end_war(self):
+        """今の交流戦を終え、次のレースから新しい交流戦にする.
+
+        終わった交流戦は順位表と補正だけを last_war に残し、レース結果と合計得点は捨てる。
+        """
+        self.last_war = (self.war, self.standings(), self.adjustments())
+        if self.journal is not None:
+            self.journal.append("war_end", war=self.war)
+        log.info("第%d交流戦を終了しました (%d レース)", self.war + 1, len(self.race_results))
+        self.war += 1
+        self.war_start = self.current_race + 1
+        self.race_results = []
+        self.team_total_scores = {}
+        self.last_teams = []
+        self.team_inference.reset()  # 相手チームが変わるのでタグの推定はやり直す
+        self.color_palette = []
+        self._notify("war")
+
+    def set_score(self, team_name, score):
+        """チームの合計得点を書き換え、元の値を返す."""
+        old_score = self.team_total_scores.get(team_name)
+        self.team_total_scores[team_name] = int(score)
+        if self.journal is not None:
+            self.journal.append("set_score", team=team_name, score=int(score))
+        self._notify("edit")
+        return old_score
+
+    def adjustments(self):
+        """手動で書き換えた分 (ペナルティなど) をチームごとに返す (合計得点 - レース得点の和、0 は除く)."""
+        race_totals = {}
+        for _, race_scores in self.race_results:
+            for team_name, score in race_scores.items():
+                race_totals[team_name] = race_totals.get(team_name, 0) + score
+        return {
+            team_name: total - race_totals.get(team_name, 0)
+            for team_name, total in self.team_total_scores.items()
+            if total != race_totals.get(team_name, 0)
+        }
+
+    def standings(self):
+        """現在の順位表を返す (compute_standings を参照)."""
+        return compute_standings(self.team_total_scores)
+
+    def _notify(self, event):
+        for listener in list(self.listeners):
+            try:
+                listener(self, event)
+            except Exception as e:
+                log.exception("集計結果の通知に失敗しました: %s", e)
+
+
+def extract_player_names(image_bytes, profile=DEFAULT_PROFILE, ocr=None, roster=None, on_progress=None):
+    """画像からプレイヤー名を抽出する.
+
+    戻り値は順位順で長さ profile.player_count のリスト。空欄・読めなかった行は None。
+    """
+    ocr = ocr or OcrStack()
+    rows = extract_player_rows(decode_image(image_bytes), profile, ocr.backend, ocr.retry_backend, roster, on_progress)
+    return [result.text if result else None for result in rows]
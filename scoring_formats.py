@@ -0,0 +1,99 @@
+import numpy as np
+
+# 順位ごとの得点表
+POINTS_12 = (15, 12, 10, 9, 8, 7, 6, 5, 4, 3, 2, 1)
+POINTS_24 = (15, 12, 10, 9, 9, 8, 8, 7, 7, 6, 6, 6, 5, 5, 5, 4, 4, 4, 3, 3, 3, 2, 2, 1)
+
+# 1 交流戦のレース数
+RACES_PER_WAR = 12
+
+# プレイヤー名領域 (FHD のリザルト画面。画像サイズに合わせて調整が必要)
+NAME_AREA_12 = (1014, 80, 1431, 1000)
+# 24 人のリザルト画面はまだ実測していない。12 人用の領域を 24 行に割っただけの仮の値なので、
+# 24 人の形式は実験的な扱いにして GUI・バッチの選択肢には出さない
+NAME_AREA_24 = NAME_AREA_12
+
+
+class FormatProfile:
+    """得点表・人数・チーム人数・名前欄の配置をまとめた大会形式."""
+
+    def __init__(self, key, label, points, team_size, name_area, experimental=False):
+        self.key = key
+        self.label = label
+        self.points = np.asarray(points, dtype=np.int32)
+        self.player_count = len(points)
+        self.team_size = team_size
+        self.team_count = self.player_count // team_size
+        self.name_area = name_area
+        self.experimental = experimental
+
+        # 行ごとのクロップ範囲は形式ごとに一度だけ計算しておく
+        left, top, right, bottom = name_area
+        height = bottom - top
+        n = self.player_count
+        self.row_boxes = [
+            (left, top + i * height // n, right, top + (i + 1) * height // n)
+            for i in range(n)
+        ]
+
+    @property
+    def is_team_mode(self):
+        return self.team_size > 1
+
+    def team_points(self, team_ids):
+        """順位順のチーム番号配列から、チームごとのレース得点を求める.
+
+        team_ids[rank] はその順位のプレイヤーのチーム番号 (不明・空欄は -1)。
+        得点表を順位で gather し、チーム番号で bincount して合計する。
+        """
+        team_ids = np.asarray(team_ids, dtype=np.intp)
+        points = self.points[: len(team_ids)]
+        valid = team_ids >= 0
+        minlength = int(team_ids.max()) + 1 if valid.any() else 0
+        return np.bincount(team_ids[valid], weights=points[valid], minlength=minlength).astype(np.int64)
+
+
+def _build_profiles():
+    profiles = {}
+    for points, area, suffix, experimental in ((POINTS_12, NAME_AREA_12, "", False),
+                                               (POINTS_24, NAME_AREA_24, "_24", True)):
+        n = len(points)
+        profiles["ffa" + suffix] = FormatProfile("ffa" + suffix, f"個人戦 ({n}人)", points, 1, area, experimental)
+        for size in (2, 3, 4, 6, 8, 12):
+            if n % size or size * 2 > n:
+                continue
+            key = f"{size}v{size}{suffix}"
+            profiles[key] = FormatProfile(key, f"{size}v{size} ({n}人)", points, size, area, experimental)
+    return profiles
+
+
+PROFILES = _build_profiles()
+# 名前欄の配置を実測済みで、GUI やバッチで選べる形式
+SUPPORTED_PROFILES = {key: profile for key, profile in PROFILES.items() if not profile.experimental}
+DEFAULT_PROFILE = PROFILES["6v6"]
+
+
+def score_race(profile, player_names, team_of):
+    """順位順のプレイヤー名からチームごとのレース得点を計算する.
+
+    team_of は名前からチーム名を返す関数。戻り値は {チーム名: 得点}。
+    """
+    if not profile.is_team_mode:
+        return score_teams(profile, player_names)
+    return score_teams(profile, [team_of(name) if name else None for name in player_names])
+
+
+def score_teams(profile, teams):
+    """順位順のチーム名 (空欄は None) からチームごとのレース得点を計算する.
+
+    同じ名前が 2 行に読めても行ごとのチームで数えられるよう、名前ではなく行で受け取る。
+    """
+    team_index = {}
+    team_ids = np.empty(len(teams), dtype=np.intp)
+    for rank, team_name in enumerate(teams):
+        if not team_name:
+            team_ids[rank] = -1
+            continue
+        team_ids[rank] = team_index.setdefault(team_name, len(team_index))
+    totals = profile.team_points(team_ids)
+    return {team_name: int(totals[i]) for team_name, i in team_index.items()}
@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+
+def empty_state():
+    """空のセッション状態を作成する."""
+    return {
+        "session_name": None,  # 結果 DB・アーカイブに記録するセッション名 (再開しても同じ名前を使う)
+        "current_race": -1,
+        "war": 0,  # 今の交流戦の番号 (0 始まり)
+        "war_start": 0,  # 今の交流戦の最初のレース番号
+        "image_paths": [],
+        "race_results": [],
+        "team_total_scores": {},
+        "team_overrides": {},
+    }
+
+
+def apply_record(state, record):
+    """ジャーナルの 1 レコードをセッション状態に適用する."""
+    op = record.get("op")
+    if op == "session":
+        state["session_name"] = record["name"]
+    elif op == "race":
+        state["race_results"].append((record["player_names"], record["race_scores"]))
+        for team_name, score in record["race_scores"].items():
+            state["team_total_scores"][team_name] = state["team_total_scores"].get(team_name, 0) + score
+        state["current_race"] += 1
+    elif op == "set_score":
+        state["team_total_scores"][record["team"]] = int(record["score"])
+    elif op == "image_add":
+        state["image_paths"].append(record["path"])
+    elif op == "team_override":
+        state.setdefault("team_overrides", {})[record["name"]] = record["team"]
+    elif op == "image_pop":
+        if state["image_paths"]:
+            state["image_paths"].pop()
+    elif op == "war_end":
+        # 終わった交流戦の結果はデータベースにあるので、状態からは捨てる
+        state["war"] = record["war"] + 1
+        state["war_start"] = state["current_race"] + 1
+        state["race_results"] = []
+        state["team_total_scores"] = {}
+        state["image_paths"] = []
+    return state
+
+
+class SessionJournal:
+    """確定したレースと編集を追記するクラッシュセーフなジャーナル.
+
+    append() はメモリ上のキューに積むだけで、書き込みと fsync は
+    バックグラウンドスレッドがまとめて行う (グループコミット)。
+    ジャーナルが compact_bytes を超えたらスナップショットに畳み込む。
+    """
+
+    def __init__(self, path, batch_size=32, flush_interval=0.05, compact_bytes=256 * 1024):
+        self.path = path
+        self.snapshot_path = path + ".snapshot"
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.compact_bytes = compact_bytes
+
+        self.state = empty_state()  # 書き込み済みレコードを反映した状態 (スナップショット用)
+        self.seq = 0  # 最後に割り当てたレコード番号
+
+        self._pending = []
+        self._written_seq = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        self._file = None
+        self._thread = None
+        self._valid_size = None  # load() で読めた最後のレコードの末尾 (start() でここまで切り詰める)
+
+    def has_data(self):
+        """復元できるデータが残っているかを返す."""
+        for p in (self.path, self.snapshot_path):
+            if os.path.exists(p) and os.path.getsize(p) > 0:
+                return True
+        return False
+
+    def load(self):
+        """スナップショットとジャーナルを読み込み、セッション状態を復元する."""
+        state = empty_state()
+        seq = 0
+        if os.path.exists(self.snapshot_path):
+            try:
+                with open(self.snapshot_path, "r", encoding="utf-8") as f:
+                    snapshot = json.load(f)
+                state = snapshot["state"]
+                state["race_results"] = [tuple(r) for r in state["race_results"]]
+                seq = snapshot["seq"]
+            except (OSError, ValueError, KeyError) as e:
+                log.warning("スナップショットの読み込みに失敗しました: %s", e)
+        valid_size = None
+        if os.path.exists(self.path):
+            valid_size = 0
+            with open(self.path, "rb") as f:
+                for line in f:
+                    # 書き込み途中でクラッシュした末尾行 (改行まで書けていない行を含む) は捨てる
+                    if not line.endswith(b"\n"):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    valid_size += len(line)
+                    # スナップショット後にジャーナルを切り詰める前に落ちた場合の重複を除く
+                    if record.get("seq", 0) <= seq:
+                        continue
+                    apply_record(state, record)
+                    seq = record["seq"]
+        self.state = state
+        self._valid_size = valid_size
+        self.seq = seq
+        self._written_seq = seq
+        return state
+
+    def reset(self):
+        """ジャーナルとスナップショットを破棄して新しいセッションを始める."""
+        with self._cond:
+            self._pending = []
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            for p in (self.path, self.snapshot_path):
+                if os.path.exists(p):
+                    os.remove(p)
+            self.state = empty_state()
+            self.seq = 0
+            self._written_seq = 0
+            self._valid_size = None
+
+    def start(self):
+        """書き込みスレッドを開始する."""
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # 壊れた末尾行の後ろに追記すると、次の load() でそれ以降のレコードが全部読めなくなる
+        if (self._valid_size is not None and os.path.exists(self.path)
+                and os.path.getsize(self.path) > self._valid_size):
+            log.warning("ジャーナルの壊れた末尾 %d バイトを切り詰めます", os.path.getsize(self.path) - self._valid_size)
+            os.truncate(self.path, self._valid_size)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._thread = threading.Thread(target=self._writer_loop, daemon=True)
+        self._thread.start()
+
+    def append(self, op, **fields):
+        """レコードを追記キューに積む (ホットパスではブロックしない)."""
+        with self._cond:
+            self.seq += 1
+            record = {"seq": self.seq, "op": op, "ts": time.time()}
+            record.update(fields)
+            self._pending.append(record)
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+        return record["seq"]
+
+    def flush(self, timeout=None):
+        """キューに積まれたレコードがディスクに書かれるまで待つ."""
+        with self._cond:
+            target = self.seq
+            self._cond.notify()
+            return self._cond.wait_for(lambda: self._written_seq >= target or self._thread is None, timeout)
+
+    def close(self):
+        """残りのレコードを書き出して書き込みスレッドを止める."""
+        if self._thread is None:
+            return
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        self._thread = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _writer_loop(self):
+        while True:
+            with self._cond:
+                if not self._pending and not self._closed:
+                    self._cond.wait(self.flush_interval)
+                batch = self._pending
+                self._pending = []
+                closed = self._closed
+            # I/O 中はロックを持たないので append() は待たされない
+            if batch:
+                self._write_batch(batch)
+                with self._cond:
+                    self._written_seq = batch[-1]["seq"]
+                    self._cond.notify_all()
+            if closed:
+                return
+
+    def _write_batch(self, batch):
+        # 1 バッチを 1 回の write + fsync で書き込む
+        data = "".join(json.dumps(r, ensure_ascii=False) + "\n" for r in batch)
+        self._file.write(data)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        for record in batch:
+            apply_record(self.state, record)
+
+        if self._file.tell() >= self.compact_bytes:
+            self._compact(batch[-1]["seq"])
+
+    def _compact(self, seq):
+        """現在の状態をスナップショットに書き出し、ジャーナルを空にする."""
+        tmp_path = self.snapshot_path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"seq": seq, "state": self.state}, f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)  # アトミックに差し替え
+        self._file.close()
+        self._file = open(self.path, "w", encoding="utf-8")
+        self._file.flush()
+        os.fsync(self._file.fileno())
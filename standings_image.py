@@ -0,0 +1,142 @@
+import io
+from functools import lru_cache
+
+from PIL import Image, ImageDraw, ImageFont
+
+# 試す TrueType フォント (チーム名や見出しに日本語が入るので CJK のフォントを先に試す)
+FONT_CANDIDATES = (
+    "NotoSansCJK-Bold.ttc", "NotoSansJP-Bold.otf", "meiryob.ttc", "YuGothB.ttc",
+    "ヒラギノ角ゴシック W6.ttc", "DejaVuSans-Bold.ttf", "arialbd.ttf",
+)
+
+# 画像の大きさ (px)
+WIDTH = 960
+HEADER_HEIGHT = 120
+ROW_HEIGHT = 56
+FOOTER_HEIGHT = 24
+# 文字の大きさ (px)
+TITLE_SIZE = 40
+SUBTITLE_SIZE = 22
+HEADING_SIZE = 20
+CELL_SIZE = 28
+
+# (見出し, 基準の x 座標, 揃え)
+COLUMNS = (
+    ("順位", 40, "left"),
+    ("チーム", 140, "left"),
+    ("得点", 600, "right"),
+    ("点差", 740, "right"),
+    ("補正", 900, "right"),
+)
+
+BACKGROUND_TOP = (18, 24, 60)
+BACKGROUND_BOTTOM = (6, 8, 24)
+ROW_COLORS = ((40, 46, 84), (30, 35, 68))
+LEADER_ROW = (120, 96, 24)
+TEXT = (255, 255, 255)
+MUTED = (170, 176, 200)
+PENALTY = (255, 110, 110)
+BONUS = (120, 220, 140)
+
+
+@lru_cache(maxsize=None)
+def load_font(size):
+    """フォントを返す (サイズごとに 1 回だけ読み込む)."""
+    for name in FONT_CANDIDATES:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:  # 古い Pillow はサイズを指定できない
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=4096)
+def text_sprite(text, size, color):
+    """文字列を一度だけ描いた RGBA の画像 (同じ文字列・大きさ・色は描き直さない).
+
+    チーム名・得点・順位はレースが変わってもほとんど同じなので、
+    再描画はキャッシュした画像を貼るだけで済む。返した画像は書き換えないこと。
+    """
+    font = load_font(size)
+    left, top, right, bottom = font.getbbox(text)
+    sprite = Image.new("RGBA", (max(right - left, 1), max(bottom - top, 1)), (0, 0, 0, 0))
+    ImageDraw.Draw(sprite).text((-left, -top), text, font=font, fill=color)
+    return sprite
+
+
+def paste_text(image, text, size, color, x, y, align="left"):
+    """text を (x, 行の中央 y) に貼る (align が right なら x が右端)."""
+    if not text:
+        return
+    sprite = text_sprite(text, size, color)
+    left = x - sprite.width if align == "right" else x
+    image.paste(sprite, (left, y - sprite.height // 2), sprite)
+
+
+@lru_cache(maxsize=8)
+def background(rows):
+    """行数ごとの背景 (グラデーション・見出し・行の帯) を一度だけ描く."""
+    height = HEADER_HEIGHT + rows * ROW_HEIGHT + FOOTER_HEIGHT
+    image = Image.new("RGB", (WIDTH, height))
+    draw = ImageDraw.Draw(image)
+    for y in range(height):
+        t = y / max(height - 1, 1)
+        color = tuple(round(a + (b - a) * t) for a, b in zip(BACKGROUND_TOP, BACKGROUND_BOTTOM))
+        draw.line((0, y, WIDTH, y), fill=color)
+    for i in range(rows):
+        top = HEADER_HEIGHT + i * ROW_HEIGHT
+        fill = LEADER_ROW if i == 0 else ROW_COLORS[i % 2]
+        draw.rectangle((20, top + 2, WIDTH - 20, top + ROW_HEIGHT - 3), fill=fill)
+    for title, x, align in COLUMNS:
+        paste_text(image, title, HEADING_SIZE, MUTED, x, HEADER_HEIGHT - 16, align)
+    return image
+
+
+def _format_adjustment(value):
+    if not value:
+        return "", MUTED
+    return f"{value:+d}", PENALTY if value < 0 else BONUS
+
+
+class StandingsRenderer:
+    """順位表 (点差・ペナルティなどの補正付き) を PNG にする.
+
+    Tk を使わないので、オーバーレイ用サーバーやバッチからも使える。
+    フォント・文字列ごとの描画結果・行数ごとの背景はキャッシュしてあるので、
+    レースごとの再描画は背景のコピーに文字を貼るだけになる。
+    """
+
+    def render(self, standings, adjustments=None, title="", subtitle=""):
+        """[(順位, チーム, 得点, 点差)] から PIL 画像を作る.
+
+        adjustments は {チーム: 手動で足し引きした点} (ペナルティは負の値)。
+        """
+        adjustments = adjustments or {}
+        image = background(len(standings)).copy()
+        paste_text(image, title, TITLE_SIZE, TEXT, 40, 40)
+        paste_text(image, subtitle, SUBTITLE_SIZE, MUTED, WIDTH - 40, 44, "right")
+        for i, (rank, team_name, score, gap) in enumerate(standings):
+            y = HEADER_HEIGHT + i * ROW_HEIGHT + ROW_HEIGHT // 2
+            adjustment, color = _format_adjustment(adjustments.get(team_name, 0))
+            paste_text(image, f"{rank}位", CELL_SIZE, TEXT, COLUMNS[0][1], y)
+            paste_text(image, str(team_name).upper(), CELL_SIZE, TEXT, COLUMNS[1][1], y)
+            paste_text(image, str(score), CELL_SIZE, TEXT, COLUMNS[2][1], y, "right")
+            paste_text(image, "" if gap is None else f"-{gap}", CELL_SIZE, MUTED, COLUMNS[3][1], y, "right")
+            paste_text(image, adjustment, CELL_SIZE, color, COLUMNS[4][1], y, "right")
+        return image
+
+    def render_snapshot(self, snapshot):
+        """standings_server.session_snapshot の辞書から画像を作る."""
+        standings = [(row["rank"], row["team"], row["score"], row["gap"]) for row in snapshot["standings"]]
+        title = f"第{snapshot.get('war', 1)}交流戦"
+        subtitle = f"{snapshot['race']} レース終了" if snapshot.get("race") else ""
+        return self.render(standings, snapshot.get("adjustments"), title, subtitle)
+
+    def snapshot_png(self, snapshot):
+        """render_snapshot の結果を PNG のバイト列にする (速さ優先で圧縮は弱め)."""
+        buffer = io.BytesIO()
+        self.render_snapshot(snapshot).save(buffer, format="PNG", compress_level=1)
+        return buffer.getvalue()
@@ -0,0 +1,309 @@
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+
+from metrics import METRICS
+from scoring_engine import ScoringSession
+from standings_image import StandingsRenderer
+
+# 配信オーバーレイ用サーバーの既定のポート
+DEFAULT_PORT = 8765
+# クライアントごとに溜めておける未送信イベント数 (超えたら切断し、再接続時に全体を送り直す)
+CLIENT_QUEUE_SIZE = 64
+# 接続を保つためのコメント行を送る間隔 (秒)
+HEARTBEAT_INTERVAL = 15
+
+
+def session_snapshot(session, version):
+    """集計結果をオーバーレイ向けの JSON にできる辞書にする."""
+    standings = session.standings()
+    top_score = standings[0][2] if standings else 0
+    return {
+        "version": version,
+        "war": session.war + 1,
+        "race": session.war_race + 1,
+        "format": session.profile.key,
+        "adjustments": session.adjustments(),
+        "standings": [
+            {"rank": rank, "team": team_name, "score": score, "gap": gap, "gap_to_top": top_score - score}
+            for rank, team_name, score, gap in standings
+        ],
+        "races": [
+            {"race": i + 1, "player_names": list(player_names), "race_scores": dict(race_scores)}
+            for i, (player_names, race_scores) in enumerate(session.race_results)
+        ],
+        "updated": time.time(),
+    }
+
+
+def snapshot_diff(old, new):
+    """前回のスナップショットからの差分を作る.
+
+    順位表は小さいので丸ごと、レース結果は増えた分だけを入れる。
+    レースが減った・書き換わった (復元・取り消し) ときは races_reset にして全体を入れる。
+    """
+    diff = {key: new[key] for key in ("version", "war", "race", "format", "standings", "adjustments", "updated")}
+    old_races = old["races"] if old else []
+    if len(new["races"]) >= len(old_races) and new["races"][:len(old_races)] == old_races:
+        diff["races_added"] = new["races"][len(old_races):]
+    else:
+        diff["races_reset"] = True
+        diff["races_added"] = new["races"]
+    return diff
+
+
+def _sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8")
+
+
+class StandingsServer:
+    """順位表・レース結果・点差を JSON と Server-Sent Events で配るローカルサーバー.
+
+    GET /state (全体)・/standings・/races は JSON を返し、GET /events は接続時に
+    snapshot、レースの確定や得点の編集のたびに diff を送り続ける。
+    GET /metrics は metrics の集計を Prometheus のテキスト形式で返し、
+    GET /standings.png は順位表の画像を返す (同じ版の間は描き直さない)。
+    サーバーは専用スレッドの asyncio で動き、Tk のスレッドからは
+    スナップショットを作って渡すだけなので、クライアントが何人いても GUI は待たない。
+    """
+
+    def __init__(self, host="127.0.0.1", port=DEFAULT_PORT, metrics=METRICS):
+        self.host = host
+        self.port = port
+        self.metrics = metrics
+        self.loop = None
+        self.snapshot = None
+        self._server = None
+        self._clients = {}  # クライアントごとの asyncio.Queue -> StreamWriter
+        self._tasks = set()  # 接続ごとのタスク
+        self._thread = None
+        self._version = 0
+        self._renderer = StandingsRenderer()
+        self._png = (None, None)  # (版, PNG のバイト列)
+
+    def start(self):
+        """サーバーのスレッドを起動する (ポートを開けなければ OSError)."""
+        ready = threading.Event()
+        errors = []
+
+        def run():
+            self.loop = asyncio.new_event_loop()
+            try:
+                self._server = self.loop.run_until_complete(
+                    asyncio.start_server(self._handle, self.host, self.port)
+                )
+                self.port = self._server.sockets[0].getsockname()[1]  # port=0 なら空いているポートになる
+            except OSError as e:
+                errors.append(e)
+                ready.set()
+                self.loop.close()
+                return
+            ready.set()
+            self.loop.run_forever()
+            self.loop.close()
+
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        ready.wait()
+        if errors:
+            raise errors[0]
+
+    def stop(self):
+        if self.loop is None or self.loop.is_closed():
+            return
+
+        async def shutdown():
+            self._server.close()
+            for queue in list(self._clients):
+                queue.closed = True
+                if not queue.full():
+                    queue.put_nowait(None)  # ストリームを閉じる
+            if self._tasks:
+                done, pending = await asyncio.wait(self._tasks, timeout=1.0)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+            self.loop.stop()
+
+        asyncio.run_coroutine_threadsafe(shutdown(), self.loop)
+        self._thread.join(timeout=2.0)
+
+    def attach(self, session):
+        """セッションの更新を配信するようにする (今の状態もすぐ配る)."""
+        session.listeners.append(self.on_session_event)
+        self.on_session_event(session, "attach")
+
+    def on_session_event(self, session, event):
+        """ScoringSession の listener (呼び出し元のスレッドでスナップショットだけ作る)."""
+        self._version += 1
+        snapshot = session_snapshot(session, self._version)
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self._publish, snapshot)
+        else:
+            self.snapshot = snapshot
+
+    def _publish(self, snapshot):
+        # 差分は 1 回だけ作ってエンコードし、全クライアントで使い回す
+        payload = _sse_event("diff", snapshot_diff(self.snapshot, snapshot))
+        self.snapshot = snapshot
+        for queue in list(self._clients):
+            try:
+                queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                self._drop(queue)
+
+    def _drop(self, queue):
+        """読むのが遅いクライアントをすぐに切断する (再接続すれば snapshot から受け直せる).
+
+        溜まった古い差分は捨て、ハートビートを待たずにストリームを終わらせる。
+        """
+        writer = self._clients.pop(queue, None)
+        queue.closed = True
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+        if writer is not None:
+            writer.close()
+
+    async def _handle(self, reader, writer):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass  # ヘッダーは使わない
+            parts = request_line.decode("latin-1").split()
+            if len(parts) < 2 or parts[0] not in ("GET", "HEAD"):
+                await self._respond(writer, 405, {"error": "method not allowed"})
+                return
+            path = parts[1].split("?", 1)[0].rstrip("/") or "/"
+            if path == "/events":
+                await self._stream(writer)
+                return
+            if path == "/metrics":
+                await self._respond(writer, 200, self.metrics.prometheus_text(), "text/plain; version=0.0.4; charset=utf-8")
+                return
+            snapshot = self.snapshot or {"version": 0, "war": 1, "race": 0, "format": None, "standings": [], "races": []}
+            if path == "/standings.png":
+                await self._respond(writer, 200, await self._standings_png(snapshot), "image/png")
+                return
+            if path in ("/", "/state"):
+                await self._respond(writer, 200, snapshot)
+            elif path == "/standings":
+                await self._respond(writer, 200, {key: snapshot[key] for key in ("version", "war", "race", "standings")})
+            elif path == "/races":
+                await self._respond(writer, 200, {key: snapshot[key] for key in ("version", "war", "race", "races")})
+            else:
+                await self._respond(writer, 404, {"error": "not found"})
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+            self._tasks.discard(task)
+
+    async def _standings_png(self, snapshot):
+        version, data = self._png
+        if version != snapshot["version"]:
+            # 描画は数 ms だが、イベントの配信を止めないよう別スレッドで行う
+            with self.metrics.span("render_png"):
+                data = await self.loop.run_in_executor(None, self._renderer.snapshot_png, snapshot)
+            self._png = (snapshot["version"], data)
+        return data
+
+    async def _respond(self, writer, status, body, content_type="application/json; charset=utf-8"):
+        if isinstance(body, bytes):
+            data = body
+        elif isinstance(body, str):
+            data = body.encode("utf-8")
+        else:
+            data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        reason = {200: "OK", 404: "Not Found", 405: "Method Not Allowed"}[status]
+        writer.write(
+            f"HTTP/1.1 {status} {reason}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            "Access-Control-Allow-Origin: *\r\n"
+            "Cache-Control: no-store\r\n"
+            "Connection: close\r\n\r\n".encode("latin-1") + data
+        )
+        await writer.drain()
+
+    async def _stream(self, writer):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/event-stream; charset=utf-8\r\n"
+            b"Cache-Control: no-cache\r\n"
+            b"Access-Control-Allow-Origin: *\r\n"
+            b"Connection: keep-alive\r\n\r\n"
+            b"retry: 1000\n\n"
+        )
+        if self.snapshot is not None:
+            writer.write(_sse_event("snapshot", self.snapshot))
+        await writer.drain()
+
+        queue = asyncio.Queue(CLIENT_QUEUE_SIZE)
+        queue.closed = False
+        self._clients[queue] = writer
+        try:
+            while not queue.closed:
+                try:
+                    payload = await asyncio.wait_for(queue.get(), HEARTBEAT_INTERVAL)
+                except asyncio.TimeoutError:
+                    payload = b": heartbeat\n\n"
+                if payload is None:
+                    break
+                writer.write(payload)
+                await writer.drain()
+        finally:
+            self._clients.pop(queue, None)
+
+    @property
+    def client_count(self):
+        return len(self._clients)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ジャーナルの集計結果をオーバーレイ用に配信する")
+    parser.add_argument("--journal", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "mkscan_data", "session.journal"))
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--interval", type=float, default=0.2, help="ジャーナルの更新を確認する間隔 (秒)")
+    args = parser.parse_args()
+
+    from session_journal import SessionJournal
+
+    # GUI とは別プロセスで動かす場合は、ジャーナルが書き足されるたびに読み直す
+    journal = SessionJournal(args.journal)
+    session = ScoringSession()
+    server = StandingsServer(args.host, args.port)
+    server.start()
+    server.attach(session)
+    print(f"http://{args.host}:{args.port}/events で配信しています")
+
+    def stamp():
+        return tuple(
+            (os.path.getmtime(p), os.path.getsize(p)) if os.path.exists(p) else None
+            for p in (journal.path, journal.snapshot_path)
+        )
+
+    last = None
+    try:
+        while True:
+            current = stamp()
+            if current != last:
+                last = current
+                session.restore(journal.load())
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
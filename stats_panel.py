@@ -0,0 +1,69 @@
+import tkinter as tk
+from tkinter import ttk
+
+# (PlayerStats.stats のキー, 見出し, 書式)
+COLUMNS = (
+    ("races", "レース", "{:d}"),
+    ("average_rank", "平均順位", "{:.2f}"),
+    ("consistency", "ばらつき", "{:.2f}"),
+    ("points_above_average", "平均との差", "{:+.2f}"),
+    ("form", "直近", "{:.2f}"),
+)
+
+
+class PlayerStatsPanel:
+    """プレイヤーごとの成績を表示するウィンドウ.
+
+    値は PlayerStats が持っている集計をそのまま表示するだけで、
+    レースが確定したら出たプレイヤーの行だけを書き換える。
+    """
+
+    def __init__(self, master, stats):
+        self.stats = stats
+        self.items = {}  # プレイヤー名 -> Treeview の行
+        self.window = tk.Toplevel(master)
+        self.window.title("選手成績")
+        self.window.withdraw()
+        self.window.protocol("WM_DELETE_WINDOW", self.window.withdraw)
+
+        columns = [key for key, _, _ in COLUMNS]
+        self.tree = ttk.Treeview(self.window, columns=columns, height=16)
+        self.tree.heading("#0", text="プレイヤー")
+        self.tree.column("#0", width=140)
+        for key, title, _ in COLUMNS:
+            self.tree.heading(key, text=title, command=lambda key=key: self.sort(key))
+            self.tree.column(key, width=80, anchor=tk.E)
+        scrollbar = ttk.Scrollbar(self.window, orient=tk.VERTICAL, command=self.tree.yview)
+        self.tree.configure(yscrollcommand=scrollbar.set)
+        self.tree.pack(side=tk.LEFT, fill=tk.BOTH, expand=True)
+        scrollbar.pack(side=tk.RIGHT, fill=tk.Y)
+
+    @property
+    def visible(self):
+        return self.window.winfo_viewable()
+
+    def show(self, names=()):
+        """ウィンドウを出し、names の行を追加・更新する."""
+        self.refresh(names)
+        self.window.deiconify()
+        self.window.lift()
+
+    def refresh(self, names):
+        """names の行だけを今の集計で書き換える (無い行は追加する)."""
+        for name in names:
+            stats = self.stats.stats(name)
+            if stats is None:
+                continue
+            values = [fmt.format(stats[key]) for key, _, fmt in COLUMNS]
+            item = self.items.get(name)
+            if item is None:
+                self.items[name] = self.tree.insert("", "end", text=name, values=values)
+            else:
+                self.tree.item(item, values=values)
+
+    def sort(self, key):
+        """見出しを押した列で並べ替える (表示している値で並べるので集計はしない)."""
+        index = [k for k, _, _ in COLUMNS].index(key)
+        rows = [(float(self.tree.item(item, "values")[index]), item) for item in self.items.values()]
+        for position, (_, item) in enumerate(sorted(rows, reverse=key in ("races", "points_above_average"))):
+            self.tree.move(item, "", position)
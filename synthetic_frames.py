@@ -0,0 +1,193 @@
+import colorsys
+import hashlib
+import io
+import random
+import string
+import threading
+import time
+from functools import lru_cache
+
+import numpy as np
+from PIL import Image, ImageDraw, ImageFont
+
+from ocr_backends import OcrResult, crop_row
+from scoring_engine import CAPTURE_SIZE
+from scoring_formats import DEFAULT_PROFILE, score_race
+
+RESOLUTIONS = {"1080p": (1920, 1080), "720p": (1280, 720)}
+
+# 名前に使う文字 (タグはこの大文字から作る)
+NAME_CHARS = string.ascii_letters + string.digits
+# 名前欄の外側も含めた行の帯の左右端 (FHD 座標)
+ROW_LEFT = 560
+ROW_RIGHT = 1600
+# 個人戦・チームカラー無しのときの行の色
+NEUTRAL_ROW = (70, 70, 82)
+# 試す TrueType フォント (無ければ PIL の既定フォント)
+FONT_CANDIDATES = ("DejaVuSans-Bold.ttf", "arialbd.ttf", "Arial Bold.ttf", "meiryob.ttc", "NotoSansCJK-Bold.ttc")
+
+
+@lru_cache(maxsize=None)
+def load_font(size):
+    """行の高さに合ったフォントを返す (サイズごとに 1 回だけ読み込む)."""
+    for name in FONT_CANDIDATES:
+        try:
+            return ImageFont.truetype(name, size)
+        except OSError:
+            continue
+    try:
+        return ImageFont.load_default(size)
+    except TypeError:  # 古い Pillow はサイズを指定できない
+        return ImageFont.load_default()
+
+
+@lru_cache(maxsize=4)
+def _background(size):
+    # 縦のグラデーション (リザルト画面の暗い背景)
+    width, height = size
+    column = np.linspace((18, 24, 60), (6, 8, 24), height).astype(np.uint8)
+    return Image.fromarray(np.ascontiguousarray(np.broadcast_to(column[:, None, :], (height, width, 3))))
+
+
+def team_palette(count):
+    """色相を等間隔に取ったチームカラーを count 色返す."""
+    return [
+        tuple(int(c * 255) for c in colorsys.hsv_to_rgb(i / count, 0.75, 0.8))
+        for i in range(count)
+    ]
+
+
+class SyntheticScenario:
+    """合成リザルト画面の元になる名簿 (チームタグ・名前・チームカラー).
+
+    tag_style は "prefix" (タグ + 名前)、"suffix" (名前 + タグ)、"mixed" (チームごとに交互)。
+    names を渡すとチームごとの名前のリストをそのまま使う (tags も合わせて渡す)。
+    """
+
+    def __init__(self, profile=DEFAULT_PROFILE, seed=0, tag_style="prefix", tags=None, names=None,
+                 colors=None, color_rows=True):
+        self.profile = profile
+        self.rng = random.Random(seed)
+        self.color_rows = color_rows and profile.is_team_mode
+        team_count = profile.team_count if profile.is_team_mode else profile.player_count
+
+        if names is None:
+            tags = tags or self._random_tags(team_count)
+            names = []
+            for t, tag in enumerate(tags):
+                suffix = tag_style == "suffix" or (tag_style == "mixed" and t % 2)
+                members = []
+                while len(members) < profile.team_size:
+                    body = "".join(self.rng.choice(NAME_CHARS) for _ in range(self.rng.randint(3, 8)))
+                    name = body + tag if suffix else tag + body
+                    if name not in members:
+                        members.append(name)
+                names.append(members)
+        self.tags = list(tags or [members[0] for members in names])
+        self.teams = {name: tag for tag, members in zip(self.tags, names) for name in members}
+        self.colors = dict(zip(self.tags, colors or team_palette(len(self.tags))))
+        self.players = list(self.teams)
+
+    def _random_tags(self, count):
+        tags = []
+        while len(tags) < count:
+            tag = "".join(self.rng.choice(string.ascii_uppercase) for _ in range(2))
+            if tag not in tags:
+                tags.append(tag)
+        return tags
+
+    def race(self, missing=0):
+        """順位順の名前を返す (下から missing 行は空欄 = 切断・未完走)."""
+        order = self.players[:]
+        self.rng.shuffle(order)
+        return order[:len(order) - missing] + [None] * missing
+
+    def truth(self, player_names):
+        """正解データ (名前・チーム・チームごとの得点)."""
+        return {
+            "format": self.profile.key,
+            "player_names": list(player_names),
+            "teams": {name: self.teams[name] for name in player_names if name},
+            "race_scores": score_race(self.profile, player_names, self.teams.get),
+        }
+
+    def render(self, player_names, resolution="1080p", noise=0.0, seed=None):
+        """リザルト画面を描いて PIL 画像にする (FHD で描いてから解像度を合わせる).
+
+        noise はガウスノイズの標準偏差 (画素値)。
+        """
+        image = _background(CAPTURE_SIZE).copy()
+        draw = ImageDraw.Draw(image)
+        left = self.profile.name_area[0]
+        for rank, (name, (_, top, _, bottom)) in enumerate(zip(player_names, self.profile.row_boxes)):
+            if not name:
+                continue
+            color = self.colors[self.teams[name]] if self.color_rows else NEUTRAL_ROW
+            draw.rectangle((ROW_LEFT, top + 1, ROW_RIGHT, bottom - 2), fill=color)
+            font = load_font(min(40, int((bottom - top) * 0.6)))
+            middle = (top + bottom) // 2
+            text = {"fill": (255, 255, 255), "font": font, "anchor": "lm", "stroke_width": 2, "stroke_fill": (0, 0, 0)}
+            draw.text((ROW_LEFT + 30, middle), str(rank + 1), **text)
+            draw.text((left + 12, middle), name, **text)
+            draw.text((ROW_RIGHT - 30, middle), str(int(self.profile.points[rank])), **dict(text, anchor="rm"))
+
+        if resolution != "1080p":
+            image = image.resize(RESOLUTIONS[resolution], Image.Resampling.LANCZOS)
+        if noise:
+            rng = np.random.default_rng(seed)
+            pixels = np.asarray(image, dtype=np.float32)
+            pixels += rng.normal(0.0, noise, pixels.shape).astype(np.float32)
+            image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+        return image
+
+    def frame(self, missing=0, resolution="1080p", noise=0.0, jpeg_quality=None):
+        """1 レース分の (画像ファイルのバイト列, 正解データ) を作る.
+
+        jpeg_quality を指定すると JPEG で圧縮する (キャプチャボードのブロックノイズ)。
+        """
+        player_names = self.race(missing)
+        image = self.render(player_names, resolution, noise, seed=self.rng.getrandbits(32))
+        buffer = io.BytesIO()
+        if jpeg_quality:
+            image.save(buffer, format="JPEG", quality=jpeg_quality)
+        else:
+            image.save(buffer, format="PNG", compress_level=1)
+        truth = self.truth(player_names)
+        truth["resolution"] = resolution
+        return buffer.getvalue(), truth
+
+
+class StubOcrBackend:
+    """合成画像の行クロップに正解の名前を返すローカル OCR (Vision API の代わり).
+
+    register() で画像の行クロップ (PNG のバイト列) と名前を対応付けておき、
+    detect() では latency + [0, jitter) 秒待ってから対応する名前を返す。
+    """
+
+    name = "stub"
+
+    def __init__(self, latency=0.0, jitter=0.0, seed=0):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = 0
+        self._texts = {}
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def register(self, image, profile, player_names):
+        """デコード済みの画像の各行に正解の名前を対応付ける."""
+        texts = {}
+        for box, name in zip(profile.row_boxes, player_names):
+            if name:
+                texts[hashlib.sha1(crop_row(image, box)).digest()] = name
+        with self._lock:
+            self._texts = texts  # 前のレースの分は捨てる
+
+    def detect(self, image_bytes):
+        with self._lock:
+            self.calls += 1
+            delay = self.latency + self.jitter * self._rng.random()
+            text = self._texts.get(hashlib.sha1(image_bytes).digest())
+        if delay:
+            time.sleep(delay)
+        return OcrResult(text, 1.0, backend=self.name) if text else None
@@ -0,0 +1,125 @@
+import numpy as np
+
+# チームカラーとみなすクラスタ中心間の最小距離 (RGB)
+MIN_CENTER_DISTANCE = 30.0
+# 同じチームの行同士の許容ばらつき (RGB)
+MAX_CLUSTER_SPREAD = 15.0
+
+
+def row_signatures(image, profile):
+    """各行の背景色 (チャンネルごとの中央値) を (行数, 3) の配列で返す.
+
+    クロップ範囲は extract_player_names と同じ profile.row_boxes を使う。
+    中央値を取るので文字の画素には引きずられない。
+    """
+    left, top, right, bottom = profile.name_area
+    region = np.asarray(image.convert("RGB"))[top:bottom, left:right:2]
+    signatures = np.empty((profile.player_count, 3), dtype=np.float32)
+    for i, (_, row_top, _, row_bottom) in enumerate(profile.row_boxes):
+        band = region[row_top - top:row_bottom - top:2]
+        signatures[i] = np.median(band.reshape(-1, 3), axis=0)
+    return signatures
+
+
+def _kmeans(points, k, iterations=10):
+    # 最遠点で初期化した小さな k-means
+    centers = [points[0]]
+    for _ in range(1, k):
+        dist = np.min(((points[:, None, :] - np.array(centers)[None]) ** 2).sum(-1), axis=1)
+        centers.append(points[int(np.argmax(dist))])
+    centers = np.array(centers, dtype=np.float32)
+    for _ in range(iterations):
+        labels = np.argmin(((points[:, None, :] - centers[None]) ** 2).sum(-1), axis=1)
+        for j in range(k):
+            members = points[labels == j]
+            if len(members):
+                centers[j] = members.mean(axis=0)
+    return centers
+
+
+def _balanced_assign(points, centers, capacity):
+    # 近い組み合わせから順に、各チームの人数が capacity を超えないよう割り当てる
+    dist = np.sqrt(((points[:, None, :] - centers[None]) ** 2).sum(-1))
+    labels = np.full(len(points), -1, dtype=np.intp)
+    counts = np.zeros(len(centers), dtype=np.intp)
+    for flat in np.argsort(dist, axis=None):
+        row, cluster = divmod(int(flat), len(centers))
+        if labels[row] < 0 and counts[cluster] < capacity:
+            labels[row] = cluster
+            counts[cluster] += 1
+    return labels, dist[np.arange(len(points)), labels]
+
+
+def classify_team_colors(image, profile, rows=None):
+    """行の背景色で行をチームに分ける.
+
+    rows を指定するとその行 (空欄でない行) だけを分類する。
+    (行ごとのクラスタ番号の配列, 色がはっきり分かれているか, クラスタごとの中心の色) を返す。
+    個人戦では (None, False, None)。
+    """
+    if not profile.is_team_mode:
+        return None, False, None
+    signatures = row_signatures(image, profile)
+    if rows is not None:
+        signatures = signatures[rows]
+    team_count = min(profile.team_count, len(signatures))
+    centers = _kmeans(signatures, team_count)
+    labels, spread = _balanced_assign(signatures, centers, profile.team_size)
+
+    center_dist = np.sqrt(((centers[:, None, :] - centers[None]) ** 2).sum(-1))
+    center_dist[np.diag_indices_from(center_dist)] = np.inf
+    confident = bool(center_dist.min() >= MIN_CENTER_DISTANCE and spread.max() <= MAX_CLUSTER_SPREAD)
+    return labels, confident, centers
+
+
+def palette_name(palette, color):
+    """色に「色N」の名前を付ける (palette に近い色があれば同じ名前を使い、無ければ登録する).
+
+    palette は [(名前, 色)] のリストで、呼び出し側が交流戦の間持ち続ける。
+    クラスタの番号はレースごとに変わるので、名前は色そのものに結び付けておく。
+    """
+    color = np.asarray(color, dtype=np.float32)
+    if palette:
+        distances = [float(np.sqrt(((known - color) ** 2).sum())) for _, known in palette]
+        nearest = int(np.argmin(distances))
+        if distances[nearest] < MIN_CENTER_DISTANCE / 2:
+            return palette[nearest][0]
+    name = f"色{len(palette) + 1}"
+    palette.append((name, color))
+    return name
+
+
+def name_color_teams(labels, player_names, team_of, centers=None, palette=None, tag_of=None):
+    """色のクラスタにチーム名を付ける.
+
+    クラスタ内で最も多いチーム名 (team_of) を使い、無ければメンバーの共通のタグ (tag_of)、
+    それも無ければ palette で色ごとに決まる「色N」とする。戻り値は行ごとのチーム名のリスト。
+    """
+    names = {}
+    palette = [] if palette is None else palette
+    for cluster in np.unique(labels):
+        rows = np.flatnonzero(labels == cluster)
+        votes = {}
+        for row in rows:
+            team_name = team_of(player_names[row]) if player_names[row] else None
+            if team_name:
+                votes[team_name] = votes.get(team_name, 0) + 1
+        best = max(votes, key=votes.get) if votes else None
+        if (not best or best in names.values()) and tag_of is not None and len(rows) > 1:
+            best = tag_of([player_names[row] for row in rows])
+        if not best or best in names.values():
+            best = palette_name(palette, centers[cluster]) if centers is not None else f"色{int(cluster) + 1}"
+        names[int(cluster)] = best
+    return [names[int(cluster)] for cluster in labels]
+
+
+def grouping_agreement(labels_a, labels_b):
+    """2 つのチーム分けがどれだけ一致しているか (ペア単位の Rand 指数) を返す."""
+    a = np.asarray(labels_a)
+    b = np.asarray(labels_b)
+    same_a = a[:, None] == a[None, :]
+    same_b = b[:, None] == b[None, :]
+    upper = np.triu_indices(len(a), k=1)
+    if not len(upper[0]):
+        return 1.0
+    return float(np.mean(same_a[upper] == same_b[upper]))
@@ -0,0 +1,181 @@
+class TeamInference:
+    """プレイヤー名をタグ (共通の接頭辞または接尾辞) でチームに分ける.
+
+    接頭辞か接尾辞かはチームごとに決める (同じロビーに両方のチームがいてよい)。
+    推定結果は名前ごとにキャッシュし、同じ交流戦の 2 レース目以降は辞書を引くだけにする。
+    手動で指定したチームは推定より優先される。
+    """
+
+    def __init__(self, team_count=6, team_size=2):
+        self.team_count = team_count
+        self.team_size = team_size
+        self.assignments = {}  # 名前 -> チーム名 (推定結果のキャッシュ)
+        self.overrides = {}  # 名前 -> チーム名 (手動指定)
+        self.tags = {}  # チーム名 -> ("prefix" | "suffix", タグ)
+
+    def configure(self, team_count, team_size):
+        """チーム数・チーム人数を変更し、キャッシュを破棄する."""
+        if (team_count, team_size) != (self.team_count, self.team_size):
+            self.team_count = team_count
+            self.team_size = team_size
+            self.reset()
+
+    def reset(self):
+        """交流戦が変わったときに推定結果を破棄する (手動指定は残す)."""
+        self.assignments = {}
+        self.tags = {}
+
+    def set_override(self, name, team_name):
+        """プレイヤーのチームを手動で指定する."""
+        self.overrides[name] = team_name.lower()
+
+    def roster(self):
+        """この交流戦で既に見た名前の一覧を返す."""
+        return list(dict.fromkeys(list(self.assignments) + list(self.overrides)))
+
+    def team_of(self, name):
+        """キャッシュ済みのチーム名を返す (未知の名前はタグで照合する)."""
+        team_name = self.overrides.get(name) or self.assignments.get(name)
+        if team_name is None:
+            team_name = self._match_tag(name)
+            if team_name is not None:
+                self.assignments[name] = team_name
+        return team_name
+
+    def remember(self, player_names, teams):
+        """ほかの方法 (行の色など) で決めたチームを推定結果としてキャッシュする."""
+        for name, team_name in zip(player_names, teams):
+            if name and team_name:
+                self.assignments.setdefault(name, team_name)
+
+    def infer(self, player_names):
+        """名前のリストに対応するチーム名のリストを返す."""
+        names = [name for name in player_names if name]
+        if any(self.team_of(name) is None for name in names):
+            self._cluster(names)
+        return [self.team_of(name) if name else None for name in player_names]
+
+    def _match_tag(self, name):
+        key = name.lower()
+        best = None
+        best_length = 0
+        for team_name, (mode, tag) in self.tags.items():
+            hit = key.startswith(tag) if mode == "prefix" else key.endswith(tag)
+            if hit and len(tag) > best_length:
+                best = team_name
+                best_length = len(tag)
+        return best
+
+    def _solo_team(self, key, used_names):
+        # 括弧付きの名前にして、名前の一部であるタグのチーム名と重ならないようにする
+        # (それでも既にあるチーム名 (タグ・色・手動指定) と重なれば番号を付ける)
+        existing = used_names | set(self.tags) | set(self.assignments.values()) | set(self.overrides.values())
+        team_name = f"({key})"
+        number = 2
+        while team_name in existing:
+            team_name = f"({key}){number}"
+            number += 1
+        used_names.add(team_name)
+        return team_name
+
+    def _cluster(self, names):
+        # 既知の名前も含めてクラスタリングし直し、キャッシュ済みの割り当ては変えない
+        unknown = [name for name in names if self.team_of(name) is None]
+        pool = list(dict.fromkeys(list(self.assignments) + unknown))
+        keys = [name.lower() for name in pool]
+
+        taken = set()
+        used_names = set()
+        groups = []
+        # 接頭辞か接尾辞かはチームごとに選ぶ (前に付けるチームと後ろに付けるチームが混ざるロビーがある)
+        for (mode, tag), members in tag_candidates(keys, self.team_size):
+            if len(groups) >= self.team_count:
+                break
+            team_name = tag.strip() or tag
+            # 別のチームと同じタグになる分割は採らない
+            if taken.intersection(members) or team_name in used_names:
+                continue
+            taken.update(members)
+            used_names.add(team_name)
+            groups.append((members, mode, tag, team_name))
+        for i in range(len(pool)):
+            if i not in taken:
+                # タグが見つからない名前は 1 人だけのチームにする (先頭 1 文字だとタグのチームに混ざる)
+                groups.append(([i], None, None, self._solo_team(keys[i], used_names)))
+
+        for members, mode, tag, team_name in groups:
+            # 既にキャッシュ済みのメンバーがいればそのチーム名を引き継ぐ
+            for i in members:
+                if pool[i] in self.assignments:
+                    team_name = self.assignments[pool[i]]
+                    break
+            if tag and team_name not in self.tags:
+                self.tags[team_name] = (mode, tag)
+            for i in members:
+                self.assignments.setdefault(pool[i], team_name)
+
+
+def common_tag(names):
+    """全員に共通の接頭辞・接尾辞のうち長い方を小文字で返す (無ければ None)."""
+    keys = [name.lower() for name in names]
+    best = ""
+    for mode_keys in (keys, [key[::-1] for key in keys]):
+        shortest = min(mode_keys, key=len)
+        length = 0
+        while length < len(shortest) - 1 and all(key[length] == shortest[length] for key in mode_keys):
+            length += 1
+        tag = shortest[:length] if mode_keys is keys else shortest[:length][::-1]
+        if len(tag.strip()) > len(best):
+            best = tag.strip()
+    return best or None
+
+
+def trie_nodes(keys, team_size):
+    """ソート済みトライの節のうち 2 人以上 team_size 人以下が通るもの (接頭辞, メンバー) を返す.
+
+    名前をソートしておくと、同じ接頭辞の名前は連続した範囲になる (範囲 = トライの節)。
+    2 人以上の範囲だけを 1 文字ずつ深く分けていくので、1 人しか通らない枝は辿らない。
+    接頭辞は名前の本体が 1 文字以上残る長さまで。
+    """
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    nodes = []
+    stack = [(0, len(order), 0)]  # (範囲の始め, 終わり, 共通の接頭辞の長さ)
+    while stack:
+        lo, hi, depth = stack.pop()
+        i = lo
+        while i < hi:
+            char = keys[order[i]][depth:depth + 1]
+            j = i + 1
+            while j < hi and keys[order[j]][depth:depth + 1] == char:
+                j += 1
+            # 接頭辞そのものの名前は先頭に来るので、本体が残る名前だけがその後ろに続く
+            first = i
+            while first < j and len(keys[order[first]]) <= depth + 1:
+                first += 1
+            count = j - first
+            if count >= 2:
+                if count <= team_size:
+                    nodes.append((keys[order[first]][:depth + 1], order[first:j]))
+                stack.append((first, j, depth + 1))
+            i = j
+    return nodes
+
+
+def tag_candidates(keys, team_size):
+    """タグの候補 ((モード, タグ), メンバーのインデックス列) を良い順に返す.
+
+    接頭辞はソート済みトライ (trie_nodes)、接尾辞は名前を逆さにしたトライから取り、
+    2 人以上 team_size 人以下が共有するものを候補にする。ちょうど team_size 人が共有するもの、
+    次にタグが長いものほど良い。
+    """
+    candidates = [(("prefix", tag), members) for tag, members in trie_nodes(keys, team_size)]
+    candidates += [(("suffix", tag[::-1]), members)
+                   for tag, members in trie_nodes([key[::-1] for key in keys], team_size)]
+    # 同じ長さなら、ちょうど team_size 人の候補が多い (= そのロビーで多く使われている) モードを優先する
+    support = {"prefix": 0, "suffix": 0}
+    for (mode, _), members in candidates:
+        support[mode] += len(members) == team_size
+    candidates.sort(key=lambda item: (
+        len(item[1]) != team_size, -len(item[0][1]), -support[item[0][0]], -len(item[1]), item[0],
+    ))
+    return candidates
@@ -0,0 +1,49 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from capture_guard import CaptureGuard
+from scoring_formats import DEFAULT_PROFILE
+from synthetic_frames import SyntheticScenario
+
+
+def test_same_screen_is_duplicate():
+    """同じリザルト画面はノイズが乗っていても二重キャプチャと判定される."""
+    scenario = SyntheticScenario(DEFAULT_PROFILE, seed=1)
+    names = scenario.race()
+    guard = CaptureGuard(DEFAULT_PROFILE)
+    fingerprint, duplicate = guard.check(scenario.render(names, noise=2.0, seed=1))
+    assert duplicate is None
+    guard.remember(fingerprint, 0)
+
+    _, duplicate = guard.check(scenario.render(names, noise=2.0, seed=2))
+    assert duplicate == 0
+
+
+def test_next_race_is_not_duplicate():
+    """同じ顔ぶれでも順位が違うレースは二重キャプチャにしない."""
+    scenario = SyntheticScenario(DEFAULT_PROFILE, seed=1)
+    guard = CaptureGuard(DEFAULT_PROFILE)
+    for race in range(8):
+        fingerprint, duplicate = guard.check(scenario.render(scenario.race(), noise=2.0, seed=race))
+        assert duplicate is None
+        guard.remember(fingerprint, race)
+
+
+def test_only_recent_races_are_compared():
+    """覚えておくのは直近のレースだけ."""
+    scenario = SyntheticScenario(DEFAULT_PROFILE, seed=3)
+    first = scenario.race()
+    guard = CaptureGuard(DEFAULT_PROFILE, history=2)
+    guard.remember(guard.check(scenario.render(first))[0], 0)
+    for race in range(1, 3):
+        guard.remember(guard.check(scenario.render(scenario.race()))[0], race)
+    assert guard.check(scenario.render(first))[1] is None
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(name, "OK")
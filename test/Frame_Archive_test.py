@@ -0,0 +1,57 @@
+import io
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from frame_archive import FrameArchive, content_hash
+from scoring_formats import DEFAULT_PROFILE
+from synthetic_frames import SyntheticScenario
+
+
+def png_size(image):
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.tell()
+
+
+def bytes_on_disk(archive):
+    return sum(os.path.getsize(path) for path in archive.objects.values())
+
+
+def test_recaptures_shrink_storage_by_an_order_of_magnitude():
+    """ノイズだけ違う同じ画面の撮り直しは、レースをまたいでも 1 つのオブジェクトになる."""
+    scenario = SyntheticScenario(DEFAULT_PROFILE, seed=1)
+    names = scenario.race()
+    frames = [scenario.render(names, noise=2.0, seed=seed) for seed in range(10)]
+    with tempfile.TemporaryDirectory() as directory:
+        archive = FrameArchive(directory)
+        entries = [archive.put(frame, "s", race) for race, frame in enumerate(frames)]
+        assert len(archive.objects) == 1
+        assert all(entry["near_duplicate"] for entry in entries[1:])
+        assert sum(png_size(frame) for frame in frames) >= 10 * bytes_on_disk(archive)
+
+
+def test_different_races_are_kept_apart():
+    """配置が同じでも名前の違うレースは別の画像として保存し、そのまま取り出せる."""
+    scenario = SyntheticScenario(DEFAULT_PROFILE, seed=2)
+    first = scenario.race()
+    swapped = first[:]
+    swapped[5], swapped[6] = swapped[6], swapped[5]
+    frames = [scenario.render(first), scenario.render(swapped), scenario.render(first[:-1] + [None])]
+    with tempfile.TemporaryDirectory() as directory:
+        archive = FrameArchive(directory)
+        for race, frame in enumerate(frames):
+            assert not archive.put(frame, "s", race)["near_duplicate"]
+        assert len(archive.objects) == 3
+        reopened = FrameArchive(directory)
+        for race, frame in enumerate(frames):
+            assert content_hash(reopened.get("s", race)) == content_hash(frame)
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(name, "OK")
@@ -0,0 +1,57 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from golden_corpus import GoldenCorpus, gate, replay, seed_synthetic
+
+
+def seeded_corpus(directory):
+    """合成リザルト画面 2 セッション x 4 レースのコーパスを作り、ベースラインを取る."""
+    corpus = seed_synthetic(directory, sessions=2, races=4)
+    corpus.baseline = replay(corpus, repeat=1)
+    corpus.save()
+    return GoldenCorpus.load(directory)
+
+
+def test_replay_matches_baseline():
+    """記録した応答だけで (ネットワーク無しで) 通り、ベースラインと比べて劣化が無い."""
+    with tempfile.TemporaryDirectory() as directory:
+        corpus = seeded_corpus(directory)
+        assert corpus.baseline["name_accuracy"] == 1.0
+        result = replay(corpus, repeat=1)
+        assert result["unrecorded_crops"] == 0
+        assert result["ocr_calls_per_race"] == corpus.baseline["ocr_calls_per_race"]
+        assert gate(corpus.baseline, result, dict(corpus.tolerances, cpu_ms_per_race=10.0)) == []
+
+
+def test_gate_flags_accuracy_drop():
+    """応答が変わって名前を読み違えると、正解率の低下として落ちる."""
+    with tempfile.TemporaryDirectory() as directory:
+        corpus = seeded_corpus(directory)
+        key = next(key for key, value in corpus.responses.items() if value)
+        corpus.responses[key] = dict(corpus.responses[key], text="???")
+        result = replay(corpus, repeat=1)
+        problems = gate(corpus.baseline, result, dict(corpus.tolerances, cpu_ms_per_race=10.0))
+        assert any("name_accuracy" in problem for problem in problems)
+
+
+def test_gate_flags_cpu_and_ocr_growth():
+    """1 レースの CPU 時間・OCR 回数が許容幅を超えて増えると落ちる."""
+    baseline = {
+        "name_accuracy": 1.0, "standings_accuracy": 1.0, "cpu_ms_per_race": 100.0,
+        "reference_ms": 50.0, "ocr_calls_per_race": 12.0, "unrecorded_crops": 0,
+    }
+    assert gate(baseline, dict(baseline, cpu_ms_per_race=120.0)) == []
+    assert len(gate(baseline, dict(baseline, cpu_ms_per_race=130.0))) == 1
+    # マシンが 2 倍遅ければ CPU 時間も 2 倍まで許す
+    assert gate(baseline, dict(baseline, cpu_ms_per_race=200.0, reference_ms=100.0)) == []
+    assert len(gate(baseline, dict(baseline, ocr_calls_per_race=13.0))) == 1
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(name, "OK")
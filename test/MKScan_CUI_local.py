@@ -1,19 +1,13 @@
-import io
-import re
-from google.cloud import vision
-from PIL import Image, ImageFilter
+import argparse
+import os
+import sys
 
-def detect_text(image_bytes):
-    """Google Vision API を使用して画像からテキストを抽出する."""
-    client = vision.ImageAnnotatorClient()
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-    # バイナリデータをVision API用のImageオブジェクトに変換
-    image = vision.Image(content=image_bytes) 
+from capture_guard import DuplicateCapture
+from scoring_engine import ScoringSession
+from scoring_formats import DEFAULT_PROFILE, PROFILES
 
-    response = client.text_detection(image=image)
-    texts = response.text_annotations
-
-    return texts[0].description.split('\n') if texts else []
 
 def group_players_by_team(player_names, prefix_length=1):
     """プレイヤー名を接頭辞でグループ化し、チーム辞書を作成する."""
@@ -34,70 +28,40 @@ def calculate_team_scores(teams, race_scores):
             team_scores[team_name] += race_scores.get(player_name, 0)
     return team_scores
 
-def main(image_paths):
+def main(image_paths, profile=DEFAULT_PROFILE):
     """メイン処理."""
-    team_total_scores = {}  # チームごとの合計得点を格納する辞書
+    # GUI と同じ集計エンジンを使う (OCR・チーム推定・得点計算)
+    session = ScoringSession(profile)
 
     # 各レースの結果処理
     for image_path in image_paths:
-        # 1. リザルト画像の入力
-        image = Image.open(image_path)
-
-        # 2. プレイヤー名領域を定義
-        player_name_area = (1014, 80, 1431, 1000)
-
-        # 3. プレイヤー名を取得
-        player_names = []
-        for i in range(12):
+        with open(image_path, "rb") as f:
             try:
-                player_name_img = image.crop((player_name_area[0], player_name_area[1] + i * (player_name_area[3] - player_name_area[1]) // 12, player_name_area[2], player_name_area[1] + (i + 1) * (player_name_area[3] - player_name_area[1]) // 12))
-
-                # 画像をメモリ上に保存
-                img_byte_arr = io.BytesIO()
-                player_name_img.save(img_byte_arr, format='PNG')
-                img_byte_arr = img_byte_arr.getvalue()
-
-                #detect_textの結果の先頭要素のみを追加
-                detected_texts = detect_text(img_byte_arr)
-                if detected_texts:  # リストが空でないことを確認
-                    player_names.append(detected_texts[0]) 
-            except IndexError:
-                break
-
-        # 4. 順位に応じた得点をチームに付与
-        race_scores = {}  # 各レースのチームごとの得点を格納する辞書
-        for rank, name in enumerate(player_names):
-            if rank == 0:
-                score = 15
-            elif rank == 1:
-                score = 12
-            else:
-                score = 12 - rank 
-            team_name = name[0].lower()  # チーム名は先頭1文字として取得
-            if team_name not in race_scores:
-                race_scores[team_name] = 0
-            race_scores[team_name] += score
-        
-        # 5. チームごとの合計得点を更新
-        for team_name, score in race_scores.items():
-            if team_name in team_total_scores:
-                team_total_scores[team_name] += score
-            else:
-                team_total_scores[team_name] = score
-
-    # 6. 結果出力
+                player_names, race_scores = session.ingest_bytes(f.read())
+            except DuplicateCapture as e:
+                print(f"{image_path}: {e} (読み飛ばしました)")
+                continue
+        print(f"{session.current_race + 1}レース目: {[name for name in player_names if name]}")
+        print(f"  得点: {race_scores}")
+
+    # 結果出力
     print("---- チームごとの合計得点 ----")
-    sorted_team_scores = sorted(team_total_scores.items(), key=lambda x: x[1], reverse=True)
-    for team_name, score in sorted_team_scores:
-        print(f"{team_name}: {score}pt")
+    for rank, team_name, score, gap in session.standings():
+        gap_text = f" (±{gap})" if gap is not None else ""
+        print(f"{rank}位 {team_name}: {score}pt{gap_text}")
 
 if __name__ == "__main__":
-    image_paths = []
-    while True:
+    parser = argparse.ArgumentParser(description="リザルト画像から得点を集計する")
+    parser.add_argument("images", nargs="*", help="リザルト画像のパス (省略時は対話入力)")
+    parser.add_argument("--format", choices=sorted(PROFILES), default=DEFAULT_PROFILE.key)
+    args = parser.parse_args()
+
+    image_paths = list(args.images)
+    while not args.images:
         path = input("リザルト画像のパスを入力してください (終了するにはEnterキー): ")
         if not path:
             break
         image_paths.append(path)
 
     if image_paths:
-        main(image_paths)
\ No newline at end of file
+        main(image_paths, PROFILES[args.format])
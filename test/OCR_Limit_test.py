@@ -0,0 +1,160 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ocr_limits import (
+    BACKFILL,
+    LIVE,
+    BudgetExceeded,
+    CostMeter,
+    FakeQuotaEndpoint,
+    LimitedBackend,
+    OcrGate,
+    RequestBudget,
+    TokenBucket,
+)
+from ocr_resilience import FaultInjectingBackend
+from scoring_engine import OcrStack, ScoringSession, decode_image
+from scoring_formats import DEFAULT_PROFILE
+from synthetic_frames import SyntheticScenario
+
+
+def make_backend(rate=20, burst=5, session_limit=None, per_minute=1800, total=None):
+    endpoint = FakeQuotaEndpoint(per_minute=per_minute, total=total)
+    gate = OcrGate(TokenBucket(rate, burst), RequestBudget(session_limit=session_limit), backfill_reserve=2)
+    return endpoint, LimitedBackend(endpoint, gate, CostMeter())
+
+
+def test_rate_limit_keeps_under_endpoint_quota():
+    """レート制限があればクォータ付きのエンドポイントでも失敗しない."""
+    endpoint, backend = make_backend(rate=50, burst=5, per_minute=40)
+    start = time.monotonic()
+    threads = [threading.Thread(target=backend.detect, args=(b"x" * 100,)) for _ in range(30)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert endpoint.rejected == 0
+    assert time.monotonic() - start >= (30 - 5) / 50 * 0.9
+    summary = backend.meter.summary()
+    assert summary["requests"] == 30
+    assert summary["bytes"] == 3000
+
+
+def test_budget_stops_requests():
+    """予算を使い切ったら OCR を呼ばずに BudgetExceeded になる."""
+    endpoint, backend = make_backend(session_limit=3)
+    for _ in range(3):
+        backend.detect(b"x")
+    try:
+        backend.detect(b"x")
+    except BudgetExceeded:
+        pass
+    else:
+        raise AssertionError("BudgetExceeded が発生しませんでした")
+    assert len(endpoint.calls) == 3
+
+
+def test_backfill_keeps_reserve_for_live():
+    """バックフィルは予備分を残して止まり、今のレースはその予備を使える."""
+    endpoint, live = make_backend(session_limit=5)
+    backfill = live.with_priority(BACKFILL)
+    for _ in range(3):
+        backfill.detect(b"x")
+    try:
+        backfill.detect(b"x")
+    except BudgetExceeded:
+        pass
+    else:
+        raise AssertionError("バックフィルが予備分まで使いました")
+    live.detect(b"x")
+    live.detect(b"x")
+    assert len(endpoint.calls) == 5
+
+
+class ManualBucket:
+    """テストから 1 つずつトークンを足すトークンバケット (時計に依存しない)."""
+
+    rate = 100.0
+
+    def __init__(self):
+        self.tokens = 0
+
+    def try_take(self, now=None):
+        if self.tokens:
+            self.tokens -= 1
+            return 0.0
+        return 0.01
+
+
+def wait_until(gate, predicate, timeout=5.0):
+    with gate._cond:
+        assert gate._cond.wait_for(predicate, timeout)
+
+
+def test_live_lane_overtakes_backfill():
+    """待っているバックフィルより後から来た今のレースが先に通る."""
+    bucket = ManualBucket()
+    gate = OcrGate(bucket, RequestBudget())
+    endpoint = FakeQuotaEndpoint()
+    live = LimitedBackend(endpoint, gate, CostMeter())
+    backfill = live.with_priority(BACKFILL)
+
+    threads = [threading.Thread(target=backfill.detect, args=(b"x",)) for _ in range(3)]
+    for t in threads:
+        t.start()
+    wait_until(gate, lambda: len(gate._waiting) == 3)
+    threads.append(threading.Thread(target=live.detect, args=(b"x",)))
+    threads[-1].start()
+    wait_until(gate, lambda: len(gate._waiting) == 4)
+
+    # トークンを 1 つずつ足し、ゲートの中で誰の札が抜けたか (= 誰が通ったか) を順に記録する
+    order = []
+    for passed in range(1, 5):
+        with gate._cond:
+            before = set(gate._waiting)
+            bucket.tokens += 1
+            gate._cond.notify_all()
+        wait_until(gate, lambda: len(gate._waiting) == 4 - passed)
+        with gate._cond:
+            (priority, _), = before - set(gate._waiting)
+        order.append(priority)
+    for t in threads:
+        t.join()
+    assert order == [LIVE, BACKFILL, BACKFILL, BACKFILL]
+
+
+def test_cancelled_capture_spends_no_more_budget():
+    """キャプチャを取り消したら、順番待ち・キュー待ちの行は予算を使わずに止まる."""
+    stack = OcrStack(backend=FaultInjectingBackend(latency=0.001, tail_rate=0.0),
+                     rate=2, burst=1, daily_limit=None, session_limit=None)
+    session = ScoringSession(DEFAULT_PROFILE, stack)
+    data, _ = SyntheticScenario(DEFAULT_PROFILE, seed=0).frame()
+    image = decode_image(data)
+
+    async def capture_then_cancel():
+        task = asyncio.ensure_future(session.read_rows_async(image))
+        await asyncio.sleep(0.3)  # 1 行目だけ通り、残りはレート制限で順番待ち
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
+        used = stack.gate.budget.session_used
+        await asyncio.sleep(1.5)  # 取り消さなければこの間に 3 行通る
+        return used
+
+    used = asyncio.run(capture_then_cancel())
+    assert 1 <= used < DEFAULT_PROFILE.player_count
+    assert stack.gate.budget.session_used == used
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(name, "OK")
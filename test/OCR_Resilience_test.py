@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ocr_limits import BudgetExceeded, CostMeter, LimitedBackend, OcrGate, RequestBudget, TokenBucket
+from ocr_resilience import (
+    CircuitBreaker,
+    CircuitOpen,
+    FaultInjectingBackend,
+    HedgedBackend,
+    LatencyHistogram,
+)
+
+
+def test_histogram_quantile():
+    """p95 がバケットの精度の範囲で求まる."""
+    histogram = LatencyHistogram()
+    for i in range(1, 101):
+        histogram.observe(i / 1000)
+    assert 0.09 <= histogram.quantile(0.95) <= 0.12
+
+
+def test_hedging_cuts_tail_latency():
+    """遅い応答が混ざっても保険のリクエストで待ち時間が p95 付近に収まる."""
+    backend = FaultInjectingBackend(latency=0.01, tail_latency=1.0, tail_rate=0.1, seed=1)
+    hedged = HedgedBackend(backend, min_samples=10, default_delay=0.05)
+    worst = 0.0
+    for _ in range(60):
+        start = time.perf_counter()
+        assert hedged.detect(b"x").text == "player"
+        worst = max(worst, time.perf_counter() - start)
+    assert hedged.hedges > 0
+    assert worst < 0.5
+
+
+def test_rate_limit_wait_does_not_trigger_hedges():
+    """レート制限の順番待ちは遅延として数えず、保険のリクエストも送らない."""
+    backend = FaultInjectingBackend(latency=0.001, tail_rate=0.0)
+    limited = LimitedBackend(backend, OcrGate(TokenBucket(10, 1), RequestBudget()), CostMeter())
+    hedged = HedgedBackend(limited, min_samples=1, default_delay=0.05, max_workers=48)
+    with ThreadPoolExecutor(24) as pool:
+        results = list(pool.map(hedged.detect, [b"x"] * 24))  # 24 行で 2 秒以上順番待ちになる
+    assert all(result.text == "player" for result in results)
+    assert hedged.hedges == 0
+    assert backend.calls == 24
+    assert hedged.histogram.quantile(0.95) < 0.05
+
+
+def test_breaker_stays_closed_behind_saturated_gate():
+    """レート制限の順番待ちと予算切れでは、代わりが無くてもブレーカーは開かない."""
+    backend = FaultInjectingBackend(latency=0.001, tail_rate=0.0)
+    gate = OcrGate(TokenBucket(10, 1), RequestBudget(session_limit=24))
+    hedged = HedgedBackend(LimitedBackend(backend, gate, CostMeter()), min_samples=1, default_delay=0.05)
+    breaker = CircuitBreaker(hedged, None, window=10, min_calls=5, min_slow=0.1)
+    with ThreadPoolExecutor(24) as pool:
+        results = list(pool.map(breaker.detect, [b"x"] * 24))  # 24 行で 2 秒以上順番待ちになる
+    assert all(result.text == "player" for result in results)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.histogram.quantile(0.99) < 0.1
+
+    for _ in range(10):
+        try:
+            breaker.detect(b"x")
+        except BudgetExceeded:
+            pass
+        else:
+            raise AssertionError("予算切れなのに通った")
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert backend.calls == 24
+
+
+def test_breaker_switches_to_fallback_and_recovers():
+    """障害中は代わりのバックエンドを使い、復旧後は元に戻る."""
+    primary = FaultInjectingBackend(text="vision", latency=0.001, tail_rate=0.0)
+    fallback = FaultInjectingBackend(text="local", latency=0.001, tail_rate=0.0)
+    breaker = CircuitBreaker(primary, fallback, window=10, min_calls=5, cooldown=0.1)
+
+    primary.outage = True
+    results = [breaker.detect(b"x").text for _ in range(10)]
+    assert breaker.state == CircuitBreaker.OPEN
+    assert all(text == "local" for text in results)
+    calls = primary.calls
+    breaker.detect(b"x")
+    assert primary.calls == calls  # 開いている間は本来のバックエンドを呼ばない
+
+    primary.outage = False
+    time.sleep(0.15)
+    assert breaker.detect(b"x").text == "vision"
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_breaker_fails_fast_without_fallback():
+    """代わりが無ければ待たずに CircuitOpen になる."""
+    primary = FaultInjectingBackend(latency=0.001, tail_rate=0.0)
+    primary.outage = True
+    breaker = CircuitBreaker(primary, None, window=10, min_calls=5, cooldown=60)
+    with ThreadPoolExecutor(4) as executor:
+        futures = [executor.submit(breaker.detect, b"x") for _ in range(10)]
+    errors = [f.exception() for f in futures]
+    assert all(e is not None for e in errors)
+    start = time.perf_counter()
+    try:
+        breaker.detect(b"x")
+    except CircuitOpen:
+        pass
+    assert time.perf_counter() - start < 0.01
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(name, "OK")
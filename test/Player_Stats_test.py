@@ -0,0 +1,115 @@
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from analytics import UNKNOWN_TRACK, PlayerStats, Season
+from results_db import ResultsDB
+from scoring_formats import DEFAULT_PROFILE
+
+POINTS = (15, 12, 10, 9)
+# 順位順の名前 (空欄は None)
+RACES = [
+    ["a", "b", "c", "d"],
+    ["b", "a", "d", "c"],
+    ["c", "a", "b", None],
+    ["a", "c", "b", "d"],
+]
+NAMES = ["a", "b", "c", "d"]
+
+
+def season_of(races):
+    """順位順の名前のリストから Season を作る (1 行 = 1 人の 1 レース)."""
+    player, race, rank, points = [], [], [], []
+    for r, names in enumerate(races):
+        for i, name in enumerate(names):
+            if name:
+                player.append(NAMES.index(name))
+                race.append(r)
+                rank.append(i + 1)
+                points.append(POINTS[i])
+    return Season(NAMES, player, race, rank, points)
+
+
+def test_incremental_stats_match_season_summary():
+    """過去分を Season から読み込み、残りを add_race で足した結果がまとめて集計した結果と一致する."""
+    full = season_of(RACES)
+    summary = full.player_summary()
+
+    stats = PlayerStats.from_season(season_of(RACES[:2]), window=2)
+    for names in RACES[2:]:
+        stats.add_race(names, POINTS)
+
+    loaded = PlayerStats.from_season(full, window=2)
+    for i, name in enumerate(NAMES):
+        row = stats.stats(name)
+        assert row["races"] == summary["races"][i] == loaded.stats(name)["races"]
+        for key in ("average_rank", "consistency", "average_points", "points_above_average"):
+            assert np.isclose(row[key], summary[key][i]), (name, key)
+        for key in ("form", "consistency"):
+            assert np.isclose(row[key], loaded.stats(name)[key]), (name, key)
+
+    # 直近 2 レースの平均順位
+    assert stats.stats("a")["form"] == (2 + 1) / 2
+    assert stats.stats("d")["form"] == (3 + 4) / 2
+
+
+def test_rolling_form_matches_loop():
+    """移動平均が 1 人ずつ数えた直近 window レースの平均順位と一致し、最後の値が PlayerStats の form になる."""
+    season = season_of(RACES)
+    order, player, rolling = season.rolling_form(window=2)
+    history = {}
+    for row, p, value in zip(order, player, rolling):
+        history.setdefault(p, []).append(season.rank[row])
+        assert np.isclose(value, np.mean(history[p][-2:]))
+    stats = PlayerStats.from_season(season, window=2)
+    for i, name in enumerate(NAMES):
+        assert np.isclose(season.current_form(window=2)[i], stats.stats(name)["form"])
+
+
+def test_rolling_form_is_fast_for_thousands_of_players():
+    """5000 人・30 万行の移動平均が 1 秒を十分下回る."""
+    rng = np.random.default_rng(0)
+    rows = 300_000
+    season = Season([f"p{i}" for i in range(5000)], rng.integers(0, 5000, rows), np.arange(rows) // 12,
+                     rng.integers(1, 13, rows), rng.integers(1, 16, rows))
+    season.rolling_form()  # 初回の import などを除く
+    start = time.perf_counter()
+    season.rolling_form()
+    season.current_form()
+    elapsed = time.perf_counter() - start
+    assert elapsed < 0.25, elapsed
+
+
+def test_track_is_recorded_and_split():
+    """record_race に渡したトラックがデータベースに残り、トラック別の成績になる."""
+    with tempfile.TemporaryDirectory() as directory:
+        db = ResultsDB(os.path.join(directory, "results.db"))
+        names = ["a", "b", "c", "d"] + [None] * (DEFAULT_PROFILE.player_count - 4)
+        teams = ["A", "B", "A", "B"] + [None] * (DEFAULT_PROFILE.player_count - 4)
+        for race, track in enumerate(["mario", "peach", None]):
+            db.record_race("s", race, DEFAULT_PROFILE, names if race != 1 else names[1::-1] + names[2:],
+                           teams if race != 1 else teams[1::-1] + teams[2:], {"a": 1, "b": 1}, ts=1000 + race,
+                           track=track)
+        db.flush()
+        season = Season.from_db(db)
+        db.close()
+    assert sorted(season.track_names) == sorted([UNKNOWN_TRACK, "mario", "peach"])
+    counts, average = season.track_splits()
+    a = season.index("a")
+    assert counts[a, season.track_names.index("mario")] == 1
+    assert average[a, season.track_names.index("peach")] == 2
+    assert average[a, season.track_names.index(UNKNOWN_TRACK)] == 1
+    assert sorted(season.team_names) == ["a", "b"]
+    assert season.team_summary()["races"].tolist() == [3, 3]
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(name, "OK")
@@ -0,0 +1,57 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from projection import WinProjection, slot_teams
+from scoring_formats import PROFILES
+
+
+def distributions(teams, strength):
+    """1 位寄りの度合いが strength の順位の分布をチームごとに作る."""
+    return {team: np.linspace(1.0 + strength * (i + 1), 1.0, 12) for i, team in enumerate(teams)}
+
+
+def test_bank_is_built_once_per_war():
+    """交流戦の途中で分布が変わっても bank を作り直さず、次の交流戦で作り直す."""
+    profile = PROFILES["6v6"]
+    projection = WinProjection(simulations=1000, bank_size=256, seed=0)
+    totals = {"A": 100, "B": 90}
+    projection.project(totals, 2, profile, distributions(totals, 0.1), war=0)
+    bank = projection._bank
+    for race in range(3, 8):
+        projection.project(totals, race, profile, distributions(totals, 0.1 * race), war=0)
+        assert projection._bank is bank
+    projection.project(totals, 0, profile, distributions(totals, 0.5), war=1)
+    assert projection._bank is not bank
+
+
+def test_bank_follows_distributions_without_war():
+    """交流戦の番号が無ければ、分布が変わるたびに作り直す."""
+    profile = PROFILES["6v6"]
+    projection = WinProjection(simulations=1000, bank_size=256, seed=0)
+    totals = {"A": 100, "B": 90}
+    projection.project(totals, 2, profile, distributions(totals, 0.1))
+    bank = projection._bank
+    projection.project(totals, 3, profile, distributions(totals, 0.2))
+    assert projection._bank is not bank
+
+
+def test_extra_teams_get_no_slots():
+    """枠の数より多いチームには枠が無く、残りレースで得点しない."""
+    profile = PROFILES["6v6"]
+    slots = slot_teams(profile, 3)
+    assert (slots[:6] == 0).all() and (slots[6:] == 1).all()
+    projection = WinProjection(simulations=1000, bank_size=256, seed=0)
+    rows = projection.project({"A": 100, "B": 100, "C": 300}, 0, profile, war=0)
+    assert (projection._bank[:, 2] == 0).all()
+    assert dict((team, score) for team, score, _, _ in rows) == {"A": 100, "B": 100, "C": 300}
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(name, "OK")
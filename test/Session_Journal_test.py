@@ -0,0 +1,61 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from session_journal import SessionJournal
+
+
+def append_races(journal, count):
+    for _ in range(count):
+        journal.append("race", player_names=["a", "b"], race_scores={"x": 15, "y": 12})
+
+
+def test_resume_after_torn_write_keeps_later_races():
+    """書き込み途中で落ちたジャーナルから再開しても、再開後のレースが次の load() で読める."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "session.journal")
+        journal = SessionJournal(path)
+        journal.start()
+        append_races(journal, 2)
+        journal.close()
+        with open(path, "a", encoding="utf-8") as f:
+            f.write('{"seq": 3, "op": "ra')  # クラッシュで途中まで書けた行
+
+        journal = SessionJournal(path)
+        assert journal.load()["current_race"] == 1
+        journal.start()
+        append_races(journal, 2)
+        journal.close()
+
+        state = SessionJournal(path).load()
+        assert state["current_race"] == 3
+        assert state["team_total_scores"] == {"x": 60, "y": 48}
+
+
+def test_session_name_survives_war_end_and_compaction():
+    """交流戦の終わり・スナップショットへの畳み込みの後も、セッション名とレース番号が続く."""
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "session.journal")
+        journal = SessionJournal(path, compact_bytes=512)
+        journal.start()
+        journal.append("session", name="session-20261019-200000")
+        append_races(journal, 12)
+        journal.append("war_end", war=0)
+        append_races(journal, 3)
+        journal.close()
+        assert os.path.exists(journal.snapshot_path)
+
+        state = SessionJournal(path).load()
+        assert state["session_name"] == "session-20261019-200000"
+        assert state["image_paths"] == []
+        assert state["war"] == 1 and state["war_start"] == 12
+        assert state["current_race"] == 14
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(name, "OK")
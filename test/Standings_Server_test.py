@@ -0,0 +1,105 @@
+import json
+import os
+import socket
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from scoring_engine import OcrStack, ScoringSession
+from scoring_formats import DEFAULT_PROFILE
+from standings_server import StandingsServer
+from synthetic_frames import StubOcrBackend, SyntheticScenario
+
+
+def connect_events(port):
+    sock = socket.create_connection(("127.0.0.1", port), timeout=5)
+    sock.sendall(b"GET /events HTTP/1.1\r\nHost: localhost\r\n\r\n")
+    return sock
+
+
+def read_event(sock, event, buffer=b""):
+    """event の SSE を 1 つ読むまで受信し、(data, 残りのバッファ) を返す."""
+    marker = f"event: {event}\n".encode()
+    while True:
+        start = buffer.find(marker)
+        end = buffer.find(b"\n\n", start) if start >= 0 else -1
+        if end >= 0:
+            data = buffer[start + len(marker):end].decode("utf-8")
+            assert data.startswith("data: ")
+            return json.loads(data[len("data: "):]), buffer[end + 2:]
+        chunk = sock.recv(65536)
+        assert chunk, "接続が閉じられました"
+        buffer += chunk
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def start_server():
+    session = ScoringSession(DEFAULT_PROFILE, OcrStack(backend=StubOcrBackend()))
+    server = StandingsServer(port=0)
+    server.start()
+    server.attach(session)
+    return session, server
+
+
+def test_every_client_receives_the_diff():
+    """複数の SSE クライアントが、レースの確定後にそれぞれ差分を受け取る."""
+    session, server = start_server()
+    sockets = [connect_events(server.port) for _ in range(3)]
+    try:
+        buffers = [read_event(sock, "snapshot")[1] for sock in sockets]
+        wait_for(lambda: server.client_count == 3)
+
+        names = SyntheticScenario(DEFAULT_PROFILE, seed=1).race()
+        race_scores = session.commit_race(names)
+        for sock, buffer in zip(sockets, buffers):
+            diff, _ = read_event(sock, "diff", buffer)
+            assert diff["race"] == 1
+            assert diff["races_added"] == [{"race": 1, "player_names": names, "race_scores": race_scores}]
+            assert sum(row["score"] for row in diff["standings"]) == sum(race_scores.values())
+    finally:
+        for sock in sockets:
+            sock.close()
+        server.stop()
+
+
+def test_dropped_client_is_closed_immediately():
+    """遅いクライアントを切断すると、ハートビートを待たずに接続が閉じられる."""
+    session, server = start_server()
+    slow, other = connect_events(server.port), connect_events(server.port)
+    try:
+        read_event(slow, "snapshot")
+        _, buffer = read_event(other, "snapshot")
+        wait_for(lambda: server.client_count == 2)
+        queue = next(queue for queue, writer in server._clients.items()
+                     if writer.get_extra_info("peername") == slow.getsockname())
+
+        start = time.monotonic()
+        server.loop.call_soon_threadsafe(server._drop, queue)
+        slow.settimeout(2.0)
+        while slow.recv(65536):
+            pass
+        assert time.monotonic() - start < 1.0
+        wait_for(lambda: server.client_count == 1)
+
+        # 残ったクライアントには引き続き配られる
+        session.commit_race(SyntheticScenario(DEFAULT_PROFILE, seed=2).race())
+        diff, _ = read_event(other, "diff", buffer)
+        assert diff["race"] == 1
+    finally:
+        slow.close()
+        other.close()
+        server.stop()
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(name, "OK")
@@ -0,0 +1,108 @@
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from scoring_engine import OcrStack, ScoringSession
+from scoring_formats import PROFILES
+from synthetic_frames import StubOcrBackend, SyntheticScenario
+from team_colors import name_color_teams
+from team_inference import TeamInference
+
+
+def groups(names, teams):
+    grouped = {}
+    for name, team in zip(names, teams):
+        grouped.setdefault(team, set()).add(name)
+    return sorted(sorted(members) for members in grouped.values())
+
+
+def test_mixed_prefix_and_suffix_tags():
+    """接頭辞のチームと接尾辞のチームが混ざったロビーでもタグごとに分かれる."""
+    names = ["ABcat", "ABdog", "ABemu", "kiwiCD", "limeCD", "plumCD",
+             "EFowl", "EFpig", "EFrat", "sunGH", "moonGH", "starGH"]
+    inference = TeamInference(team_count=4, team_size=3)
+    teams = inference.infer(names)
+    assert groups(names, teams) == sorted(sorted(names[i:i + 3]) for i in range(0, 12, 3))
+    assert set(teams) == {"ab", "cd", "ef", "gh"}
+
+
+def test_teams_get_distinct_tags():
+    """別のチームが同じタグ名にまとめられない."""
+    names = ["xa1", "xa2", "xb1", "xb2", "xc1", "xc2", "ya1", "ya2", "yb1", "yb2", "yc1", "yc2"]
+    teams = TeamInference(team_count=6, team_size=2).infer(names)
+    assert len(set(teams)) == 6
+    assert groups(names, teams) == sorted(sorted(names[i:i + 2]) for i in range(0, 12, 2))
+
+
+def test_color_names_stay_stable_across_races():
+    """タグが無い色のチームはクラスタの番号が変わっても同じ「色N」になる."""
+    palette = []
+    red, blue = np.array([200, 30, 30]), np.array([30, 30, 200])
+    first = name_color_teams(np.array([0, 0, 1, 1]), ["a", "b", "c", "d"], lambda name: None,
+                             np.array([red, blue]), palette)
+    second = name_color_teams(np.array([0, 0, 1, 1]), ["a", "b", "c", "d"], lambda name: None,
+                              np.array([blue + 3, red - 3]), palette)
+    assert first == ["色1", "色1", "色2", "色2"]
+    assert second == ["色2", "色2", "色1", "色1"]
+
+
+def test_duplicate_names_are_scored_per_row():
+    """同じ名前が 2 行に読めても、行ごとのチーム (行の色) で得点を数える."""
+    profile = PROFILES["6v6"]
+    scenario = SyntheticScenario(profile, seed=4)
+    truth_names = scenario.race()
+    image = scenario.render(truth_names)
+    truth = scenario.truth(truth_names)
+    # 別のチームの 1 行を、上の行の名前と同じに読み違えた
+    first = truth_names[0]
+    other = next(i for i, name in enumerate(truth_names) if scenario.teams[name] != scenario.teams[first])
+    player_names = list(truth_names)
+    player_names[other] = first
+
+    session = ScoringSession(profile, OcrStack(backend=StubOcrBackend()))
+    race_scores = session.commit_race(player_names, image)
+    teams = session.last_teams
+    assert teams[0] != teams[other]
+    assert sorted(race_scores.values()) == sorted(truth["race_scores"].values())
+    assert sum(race_scores.values()) == sum(profile.points)
+
+    # 色が無ければ同じ名前は同じチームになるが、得点は 2 行とも数える
+    session = ScoringSession(profile, OcrStack(backend=StubOcrBackend()))
+    race_scores = session.commit_race(player_names)
+    assert session.last_teams[0] == session.last_teams[other]
+    assert sum(race_scores.values()) == sum(profile.points)
+
+
+def test_singleton_does_not_join_a_tag_team():
+    """タグの合う相手がいない名前は、先頭の文字が同じタグのチームに混ざらない."""
+    names = ["catk", "dogk", "XYab", "XYcd", "kiwi", "plum"]
+    teams = TeamInference(team_count=3, team_size=2).infer(names)
+    assert teams[:4] == ["k", "k", "xy", "xy"]
+    assert teams[4] not in teams[:4] and teams[5] not in teams[:4]
+    assert teams[4] != teams[5]
+
+
+def test_inference_is_well_under_a_millisecond():
+    """初めて見る 12 人のチーム分け (キャッシュ無し) が 1 レース 1 ms を十分下回る."""
+    lobbies = []
+    for key in ("2v2", "3v3", "4v4", "6v6"):
+        profile = PROFILES[key]
+        for seed in range(50):
+            scenario = SyntheticScenario(profile, seed=seed, tag_style=("prefix", "suffix", "mixed")[seed % 3])
+            lobbies.append((profile, scenario.race()))
+    start = time.perf_counter()
+    for profile, names in lobbies:
+        TeamInference(profile.team_count, profile.team_size).infer(names)
+    per_race = (time.perf_counter() - start) / len(lobbies)
+    assert per_race < 0.0002, per_race
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(name, "OK")
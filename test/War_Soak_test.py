@@ -0,0 +1,128 @@
+import gc
+import os
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from analytics import PlayerStats
+from image_history import ImageHistory
+from projection import WinProjection
+from results_db import ResultsDB
+from scoring_engine import OcrStack, ScoringSession, decode_image
+from scoring_formats import DEFAULT_PROFILE, RACES_PER_WAR
+from session_journal import SessionJournal
+from synthetic_frames import StubOcrBackend, SyntheticScenario
+
+# 6 時間 ≒ 1 交流戦 25 分 x 14
+SOAK_WARS = 14
+# キャッシュなどが温まるまでの交流戦 (ここから後の増え方を見る)
+WARMUP_WARS = 2
+# 温まった後に増えてよいメモリ (バイト)
+GROWTH_LIMIT = 256 * 1024
+
+
+def run_session(directory, wars, on_war=None, profile=DEFAULT_PROFILE):
+    """合成リザルト画面でアプリと同じ流れのセッションを wars 交流戦分回す."""
+    backend = StubOcrBackend()
+    ocr = OcrStack(os.path.join(directory, "budget.json"), backend=backend, rate=10000, burst=10000,
+                   daily_limit=None)
+    journal = SessionJournal(os.path.join(directory, "session.journal"))
+    journal.start()
+    session = ScoringSession(profile, ocr, journal)
+    db = ResultsDB(os.path.join(directory, "results.db"))
+    history = ImageHistory(os.path.join(directory, "images"))
+    stats = PlayerStats()
+    projection = WinProjection(simulations=2000, seed=0)
+    undo_stack = []
+    # 同じ 2 組の対戦を交互に繰り返す (選手が増え続けないように)
+    scenarios = [SyntheticScenario(profile, seed) for seed in range(2)]
+
+    def on_session_event(session, event):
+        if event == "race":
+            stats.add_race(session.race_results[-1][0], session.profile.points)
+        elif event == "war":
+            history.clear()
+            undo_stack.clear()
+            db.flush()
+            journal.flush()
+            if on_war is not None:
+                on_war(session)
+
+    session.listeners.append(on_session_event)
+    try:
+        for race in range(wars * RACES_PER_WAR):
+            scenario = scenarios[session.war % len(scenarios)]
+            data, truth = scenario.frame()
+            image = decode_image(data)
+            backend.register(image, profile, truth["player_names"])
+
+            session.maybe_end_war()
+            path = history.add_path(os.path.join(directory, f"capture_{race:04d}.png"))
+            journal.append("image_add", path=path)
+            player_names, race_scores = session.ingest_image(image)
+            db.record_race("soak", session.current_race, profile, player_names, session.last_teams, race_scores,
+                           war=session.war)
+            undo_stack.append(race_scores)  # アプリの Undo と同じく交流戦の間だけ溜まる
+            projection.project(session.team_total_scores, session.war_race, profile, war=session.war)
+        session.end_war()
+    finally:
+        journal.close()
+        db.close()
+        ocr.close()
+    return session, journal, db
+
+
+def test_memory_stays_flat_over_long_session():
+    """6 時間分の交流戦を回しても、温まった後のメモリが増え続けない."""
+    samples = []
+    baseline = []
+
+    def on_war(session):
+        gc.collect()
+        if session.war == WARMUP_WARS:
+            baseline.append(tracemalloc.take_snapshot())
+        samples.append(tracemalloc.get_traced_memory()[0])
+        assert len(session.race_results) == 0
+
+    tracemalloc.start()
+    try:
+        with tempfile.TemporaryDirectory() as directory:
+            run_session(directory, SOAK_WARS, on_war)
+            gc.collect()
+            final = tracemalloc.take_snapshot()
+    finally:
+        tracemalloc.stop()
+
+    growth = samples[-1] - samples[WARMUP_WARS - 1]
+    # 増えすぎたときだけ、交流戦ごとのメモリと増えた箇所を失敗のメッセージに入れる
+    assert growth < GROWTH_LIMIT, "\n".join(
+        [f"温まった後の増加: {growth / 1024:.1f} KiB", f"交流戦ごとのメモリ (KiB): {[round(s / 1024) for s in samples]}"]
+        + [str(stat) for stat in final.compare_to(baseline[0], "lineno")[:10]]
+    )
+
+
+def test_journal_restores_only_current_war():
+    """ジャーナルから復元すると、終わった交流戦は持たずに今の交流戦から続けられる."""
+    with tempfile.TemporaryDirectory() as directory:
+        session, journal, _ = run_session(directory, 2)
+        state = SessionJournal(journal.path).load()
+        assert state["war"] == session.war == 2
+        assert state["war_start"] == session.war_start == 2 * RACES_PER_WAR
+        assert state["race_results"] == [] and state["image_paths"] == []
+
+        restored = ScoringSession(DEFAULT_PROFILE, OcrStack(backend=StubOcrBackend()))
+        restored.restore(state)
+        assert restored.war_race == -1
+        db = ResultsDB(os.path.join(directory, "results.db"))
+        wars = db.connection.execute("SELECT DISTINCT war FROM races ORDER BY war").fetchall()
+        db.close()
+        assert wars == [(0,), (1,)]
+
+
+if __name__ == "__main__":
+    for name, func in list(globals().items()):
+        if name.startswith("test_"):
+            func()
+            print(name, "OK")